@@ -0,0 +1,90 @@
+"""
+Micro-benchmark for pruning screenshots out of long message histories.
+
+Compares rescanning the whole history on every turn with reusing an ImageIndex
+across turns, over synthetic sessions of 500 turns with one screenshot per turn.
+
+    python -m benchmarks.image_index_bench
+"""
+
+import argparse
+import time
+from typing import Any
+
+from computer_use_demo.images import ImageIndex
+from computer_use_demo.loop import _maybe_filter_to_n_most_recent_images
+
+SCREENSHOT = "A" * 4096
+
+
+def turn(i: int) -> list[Any]:
+    """One assistant tool call and its user tool result with a screenshot."""
+    return [
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"Taking screenshot {i}"},
+                {
+                    "type": "tool_use",
+                    "id": f"toolu_{i}",
+                    "name": "computer",
+                    "input": {"action": "screenshot"},
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": f"toolu_{i}",
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": SCREENSHOT,
+                            },
+                        }
+                    ],
+                }
+            ],
+        },
+    ]
+
+
+def run_session(turns: int, images_to_keep: int, incremental: bool) -> float:
+    messages: list[Any] = [{"role": "user", "content": "Open the browser"}]
+    image_index = ImageIndex() if incremental else None
+    elapsed = 0.0
+    for i in range(turns):
+        messages.extend(turn(i))
+        start = time.perf_counter()
+        _maybe_filter_to_n_most_recent_images(
+            messages, images_to_keep, images_to_keep, image_index=image_index
+        )
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--images-to-keep", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, incremental in (("full rescan", False), ("image index", True)):
+        best = min(
+            run_session(args.turns, args.images_to_keep, incremental)
+            for _ in range(args.repeat)
+        )
+        print(  # noqa: T201
+            f"{name:>12}: {best * 1000:8.2f} ms per session, "
+            f"{best / args.turns * 1e6:8.2f} us per turn"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Benchmark of the sampling loop's own overhead, replaying a recorded session.
+
+Replays a recording made with `replay.SessionRecorder` (or, without one, a synthetic
+session with one screenshot per turn) through `sampling_loop` with the recorded API
+and tool delays scaled by `--speed`; the default of 0 leaves only the time spent in
+the loop itself: history growth, image filtering, prompt cache injection,
+serialization and callbacks.
+
+    python -m benchmarks.replay_bench recording.jsonl
+    python -m benchmarks.replay_bench --turns 100
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import os
+import time
+from pathlib import Path
+from typing import cast
+
+from PIL import Image
+
+from computer_use_demo import replay
+from computer_use_demo.clients import AsyncClient
+from computer_use_demo.images import CacheAlignedEviction
+from computer_use_demo.loop import APIProvider, sampling_loop
+from computer_use_demo.metrics import SessionMetrics
+from computer_use_demo.replay import RecordedToolCall, RecordedTurn, Recording
+
+COMPUTER_TOOL = {
+    "name": "computer",
+    "type": "computer_20250124",
+    "display_width_px": 1024,
+    "display_height_px": 768,
+}
+
+
+def screenshot(width: int = 320, height: int = 240) -> str:
+    """A base64 PNG of random pixels, so that no two screenshots look alike."""
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def synthetic_recording(turns: int) -> Recording:
+    """A session taking one screenshot per turn, then finishing with text."""
+    recording = Recording(
+        model="claude-sonnet-4-20250514",
+        tools=[COMPUTER_TOOL],
+        messages=[{"role": "user", "content": "Open the browser"}],
+    )
+    for i in range(turns):
+        recording.turns.append(
+            RecordedTurn(
+                api_seconds=2.0,
+                response=_message(
+                    f"msg_{i}",
+                    [
+                        {"type": "text", "text": f"Taking screenshot {i}"},
+                        {
+                            "type": "tool_use",
+                            "id": f"toolu_{i}",
+                            "name": "computer",
+                            "input": {"action": "screenshot"},
+                        },
+                    ],
+                    stop_reason="tool_use",
+                ),
+                tools=[
+                    RecordedToolCall(
+                        tool_use_id=f"toolu_{i}",
+                        name="computer",
+                        input={"action": "screenshot"},
+                        seconds=0.5,
+                        result={"base64_image": screenshot()},
+                    )
+                ],
+            )
+        )
+    recording.turns.append(
+        RecordedTurn(
+            api_seconds=1.0,
+            response=_message("msg_done", [{"type": "text", "text": "Done."}]),
+        )
+    )
+    return recording
+
+
+def _message(id: str, content: list[dict], stop_reason: str = "end_turn") -> dict:  # noqa: A002
+    return {
+        "id": id,
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-sonnet-4-20250514",
+        "content": content,
+        "stop_reason": stop_reason,
+        "usage": {"input_tokens": 1_000, "output_tokens": 100},
+    }
+
+
+async def run_session(
+    recording: Recording,
+    *,
+    speed: float,
+    stream: bool,
+    image_eviction: bool,
+) -> tuple[float, replay.ReplayClient]:
+    session = replay.Replay.from_recording(recording, speed=speed)
+    started = time.perf_counter()
+    await sampling_loop(
+        model=recording.model,
+        provider=APIProvider.ANTHROPIC,
+        system_prompt_suffix="",
+        messages=session.messages(),
+        output_callback=replay.output_callback,
+        tool_output_callback=replay.tool_output_callback,
+        api_response_callback=replay.api_response_callback,
+        api_key="",
+        max_tokens=recording.max_tokens,
+        tool_version="computer_use_20250124",
+        stream=stream,
+        image_eviction=CacheAlignedEviction() if image_eviction else None,
+        metrics=SessionMetrics(),
+        tool_collection=session.tool_collection,
+        client=cast(AsyncClient, session.client),
+    )
+    return time.perf_counter() - started, session.client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("recording", type=Path, nargs="?")
+    parser.add_argument(
+        "--turns", type=int, default=50, help="turns of the synthetic session"
+    )
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--image-eviction",
+        action="store_true",
+        help="bound the screenshots in the history with CacheAlignedEviction",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    recording = (
+        Recording.load(args.recording)
+        if args.recording
+        else synthetic_recording(args.turns)
+    )
+    turns = len(recording.turns)
+    best = float("inf")
+    client = None
+    for _ in range(args.repeat):
+        seconds, client = asyncio.run(
+            run_session(
+                recording,
+                speed=args.speed,
+                stream=args.stream,
+                image_eviction=args.image_eviction,
+            )
+        )
+        best = min(best, seconds)
+    assert client is not None
+    print(  # noqa: T201
+        f"{turns} turns: {best * 1000:8.2f} ms per session, "
+        f"{best / turns * 1000:6.2f} ms per turn, "
+        f"{client.request_bytes / client.requests / 1024:8.1f} KiB per request"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for encoding the message history of a request.
+
+Compares encoding the whole history as the SDK does on every turn with
+MessageSerializer, which only encodes what changed since the previous turn, for
+histories with one screenshot per turn.
+
+    python -m benchmarks.serialization_bench
+"""
+
+import argparse
+import base64
+import json
+import os
+import time
+from typing import Any
+
+from anthropic._utils import maybe_transform
+from anthropic.types.beta import message_create_params
+
+from computer_use_demo.loop import _inject_prompt_caching
+from computer_use_demo.serialization import MessageSerializer
+
+from .image_index_bench import turn
+
+
+def screenshot(size: int) -> str:
+    return base64.b64encode(os.urandom(size)).decode()
+
+
+def encode_full(messages: list[Any]) -> bytes:
+    body = maybe_transform(
+        {"messages": messages, "max_tokens": 4096, "model": "model"},
+        message_create_params.MessageCreateParamsNonStreaming,
+    )
+    return json.dumps(body, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def run_session(turns: int, image_bytes: int, incremental: bool) -> list[float]:
+    """Encode time of each turn's request body, in seconds."""
+    messages: list[Any] = [{"role": "user", "content": "Open the browser"}]
+    serializer = MessageSerializer()
+    image = screenshot(image_bytes)
+    timings = []
+    for i in range(turns):
+        new = turn(i)
+        new[1]["content"][0]["content"][0]["source"]["data"] = image
+        messages.extend(new)
+        _inject_prompt_caching(messages)
+        start = time.perf_counter()
+        if incremental:
+            serializer.serialize(messages).render({"max_tokens": 4096, "model": "m"})
+        else:
+            encode_full(messages)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=500)
+    parser.add_argument("--image-bytes", type=int, default=50_000)
+    parser.add_argument("--every", type=int, default=100)
+    args = parser.parse_args()
+
+    full = run_session(args.turns, args.image_bytes, incremental=False)
+    incremental = run_session(args.turns, args.image_bytes, incremental=True)
+    print(f"{'turns':>6} {'full (ms)':>10} {'incremental (ms)':>17}")  # noqa: T201
+    for i in range(args.every - 1, args.turns, args.every):
+        print(  # noqa: T201
+            f"{i + 1:>6} {full[i] * 1000:>10.2f} {incremental[i] * 1000:>17.2f}"
+        )
+    print(  # noqa: T201
+        f"{'total':>6} {sum(full) * 1000:>10.0f} {sum(incremental) * 1000:>17.0f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
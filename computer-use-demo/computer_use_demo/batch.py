@@ -0,0 +1,475 @@
+"""
+Headless batch runner: runs the computer use tasks in a JSONL file concurrently on
+one event loop, each with its own tool collection and display.
+
+    python -m computer_use_demo.batch tasks.jsonl --output-dir runs/nightly \\
+        --max-displays 4 --concurrency 4
+
+Displays are leased from a DisplayPool, which launches up to `--max-displays`
+Xvfb displays on demand; `--displays` lists already running displays to use.
+
+Each line of the tasks file is an object with a unique `id` (letters, digits, `.`,
+`_` and `-`) and a `prompt`, and optionally `model`, `tool_version`, `max_tokens`
+and `system_prompt_suffix` overriding the command line defaults, and a
+`change_region` `[left, top, right, bottom]` whose change ends the wait for the
+screen after each computer action. For every task, `<output-dir>/<id>/` receives
+the transcript, the per-turn metrics as JSONL and the screenshots, and with
+`--record` a recording for `benchmarks.replay_bench`; `<output-dir>/results.jsonl`
+gets one summary line per finished task.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Any, Literal
+
+import httpx
+from anthropic.types.beta import BetaContentBlockParam, BetaMessageParam
+
+from . import tracing
+from .clients import CLIENT_REGISTRY, prewarm_client
+from .displays import Display, DisplayPool
+from .images import DEFAULT_DEDUPE_THRESHOLD, CacheAlignedEviction, ImageStore
+from .loop import APIProvider, sampling_loop
+from .metrics import SessionMetrics
+from .ratelimit import RateLimiter
+from .replay import SessionRecorder
+from .tools import TOOL_GROUPS_BY_VERSION, ToolCollection, ToolResult, ToolVersion
+from .tools.bash import BashTool20250124
+from .tools.computer import (
+    BaseComputerTool,
+    ImageFormat,
+    Region,
+    ScreenshotEncoding,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "claude-sonnet-4-20250514"
+DEFAULT_TOOL_VERSION: ToolVersion = "computer_use_20250124"
+# ids name the task's output directory, so they must not reach outside of it
+TASK_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+
+@dataclass(frozen=True, kw_only=True)
+class BatchTask:
+    id: str
+    prompt: str
+    model: str | None = None
+    tool_version: ToolVersion | None = None
+    max_tokens: int | None = None
+    system_prompt_suffix: str = ""
+    # (left, top, right, bottom) whose change ends the wait after each action
+    change_region: tuple[int, int, int, int] | None = None
+
+    def __post_init__(self):
+        if not isinstance(self.id, str) or not TASK_ID_PATTERN.fullmatch(self.id):
+            raise ValueError(
+                f"task id {self.id!r} must be letters, digits, '.', '_' or '-', "
+                "not starting with '.', '_' or '-'"
+            )
+        if (
+            self.tool_version is not None
+            and self.tool_version not in TOOL_GROUPS_BY_VERSION
+        ):
+            raise ValueError(
+                f"unknown tool_version {self.tool_version!r}, expected one of "
+                + ", ".join(TOOL_GROUPS_BY_VERSION)
+            )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "BatchTask":
+        known = {field.name for field in fields(cls)}
+        data = {key: value for key, value in data.items() if key in known}
+        if data.get("change_region") is not None:
+            data["change_region"] = tuple(data["change_region"])
+        return cls(**data)
+
+
+@dataclass(kw_only=True)
+class BatchConfig:
+    provider: APIProvider = APIProvider.ANTHROPIC
+    api_key: str = ""
+    model: str = DEFAULT_MODEL
+    tool_version: ToolVersion = DEFAULT_TOOL_VERSION
+    max_tokens: int = 4096
+    only_n_most_recent_images: int | None = 3
+    screenshot_dedupe_threshold: int | None = DEFAULT_DEDUPE_THRESHOLD
+    screenshot_encoding: ScreenshotEncoding | None = None
+    trace: bool = False
+    record: bool = False
+    # connect to the API while the first displays start
+    prewarm: bool = False
+
+
+@dataclass(kw_only=True)
+class TaskResult:
+    id: str
+    status: Literal["completed", "error"]
+    display_num: int | None
+    turns: int
+    seconds: float
+    input_tokens: int
+    output_tokens: int
+    cache_hit_ratio: float
+    error: str | None = None
+
+
+def load_tasks(path: Path | str) -> list[BatchTask]:
+    """Load the tasks of a JSONL file, rejecting invalid and duplicate ids."""
+    tasks: list[BatchTask] = []
+    seen: set[str] = set()
+    with Path(path).open() as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                task = BatchTask.from_dict(json.loads(line))
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"{path}:{number}: {e}") from e
+            if task.id in seen:
+                raise ValueError(f"{path}:{number}: duplicate task id {task.id!r}")
+            seen.add(task.id)
+            tasks.append(task)
+    return tasks
+
+
+def build_tool_collection(
+    tool_version: ToolVersion,
+    display: Display | None = None,
+    *,
+    change_region: Region | None = None,
+    screenshot_encoding: ScreenshotEncoding | None = None,
+) -> ToolCollection:
+    """
+    Create the tools of `tool_version`, pointing GUI access at `display`. The
+    computer tool encodes screenshots with `screenshot_encoding` and, if given,
+    waits for `change_region` to change after each action.
+    """
+    tools = []
+    for ToolCls in TOOL_GROUPS_BY_VERSION[tool_version].tools:
+        if issubclass(ToolCls, BaseComputerTool) and display is not None:
+            tools.append(
+                ToolCls(
+                    display_num=display.num,
+                    width=display.width,
+                    height=display.height,
+                    change_region=change_region,
+                    screenshot_encoding=screenshot_encoding,
+                )
+            )
+        elif issubclass(ToolCls, BaseComputerTool):
+            tools.append(
+                ToolCls(
+                    change_region=change_region,
+                    screenshot_encoding=screenshot_encoding,
+                )
+            )
+        elif issubclass(ToolCls, BashTool20250124) and display and display.name:
+            tools.append(ToolCls(env={"DISPLAY": display.name}))
+        else:
+            tools.append(ToolCls())
+    return ToolCollection(*tools)
+
+
+async def run_task(
+    task: BatchTask,
+    *,
+    config: BatchConfig,
+    output_dir: Path,
+    display: Display | None = None,
+    rate_limiter: RateLimiter | None = None,
+) -> TaskResult:
+    """Run one task to completion and write its transcript and metrics."""
+    task_dir = output_dir / task.id
+    task_dir.mkdir(parents=True, exist_ok=True)
+    metrics = SessionMetrics(jsonl_path=task_dir / "metrics.jsonl")
+    errors: list[Exception] = []
+
+    def api_response_callback(
+        request: httpx.Request,
+        response: httpx.Response | object | None,
+        error: Exception | None,
+    ):
+        if error is not None:
+            errors.append(error)
+
+    def output_callback(block: BetaContentBlockParam):
+        if block["type"] == "text":
+            logger.debug("[%s] %s", task.id, block["text"])
+
+    def tool_output_callback(result: ToolResult, tool_use_id: str):
+        if result.error:
+            logger.debug("[%s] tool %s: %s", task.id, tool_use_id, result.error)
+
+    system_prompt_suffix = task.system_prompt_suffix
+    if display is not None and display.name:
+        system_prompt_suffix = (
+            f"{system_prompt_suffix} Your display is {display.name}, use "
+            f"DISPLAY={display.name} instead of DISPLAY=:1 to start GUI applications."
+        ).strip()
+    tool_version = task.tool_version or config.tool_version
+    messages: list[BetaMessageParam] = [{"role": "user", "content": task.prompt}]
+
+    tool_collection: ToolCollection | None = None
+    started = time.perf_counter()
+    # a task whose setup fails is reported like any other failed task
+    try:
+        image_store = ImageStore(task_dir / "images")
+        # with prompt caching, the loop only bounds the images through a policy
+        image_eviction = (
+            CacheAlignedEviction(images_to_keep=config.only_n_most_recent_images)
+            if config.only_n_most_recent_images
+            else None
+        )
+        on_api_response, on_tool_output = api_response_callback, tool_output_callback
+        if config.record:
+            recorder = SessionRecorder(
+                task_dir / "recording.jsonl", metrics=metrics, image_store=image_store
+            )
+            on_api_response = recorder.wrap_api_response(api_response_callback)
+            on_tool_output = recorder.wrap_tool_output(tool_output_callback)
+
+        tool_collection = build_tool_collection(
+            tool_version,
+            display,
+            change_region=task.change_region,
+            screenshot_encoding=config.screenshot_encoding,
+        )
+        messages = await sampling_loop(
+            model=task.model or config.model,
+            provider=config.provider,
+            system_prompt_suffix=system_prompt_suffix,
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=on_tool_output,
+            api_response_callback=on_api_response,
+            api_key=config.api_key,
+            only_n_most_recent_images=config.only_n_most_recent_images,
+            screenshot_dedupe_threshold=config.screenshot_dedupe_threshold,
+            max_tokens=task.max_tokens or config.max_tokens,
+            tool_version=tool_version,
+            image_store=image_store,
+            image_eviction=image_eviction,
+            metrics=metrics,
+            tracer=tracing.Tracer(task_dir / "trace.json") if config.trace else None,
+            tool_collection=tool_collection,
+            rate_limiter=rate_limiter,
+            session_id=task.id,
+        )
+    except Exception as e:
+        logger.exception("[%s] failed", task.id)
+        errors.append(e)
+    finally:
+        # the next task on this display starts with fresh shells
+        for tool in tool_collection.tools if tool_collection is not None else ():
+            if isinstance(tool, BashTool20250124):
+                await tool.pool.aclose()
+    seconds = time.perf_counter() - started
+
+    (task_dir / "transcript.json").write_text(json.dumps(messages, indent=2))
+    totals = metrics.totals()
+    return TaskResult(
+        id=task.id,
+        status="error" if errors else "completed",
+        display_num=display.num if display is not None else None,
+        turns=int(totals["turns"]),
+        seconds=seconds,
+        input_tokens=int(
+            totals["input_tokens"]
+            + totals["cache_read_input_tokens"]
+            + totals["cache_creation_input_tokens"]
+        ),
+        output_tokens=int(totals["output_tokens"]),
+        cache_hit_ratio=totals["cache_hit_ratio"],
+        error=f"{type(errors[-1]).__name__}: {errors[-1]}" if errors else None,
+    )
+
+
+async def run_batch(
+    tasks: Sequence[BatchTask],
+    *,
+    config: BatchConfig,
+    output_dir: Path,
+    concurrency: int,
+    display_pool: DisplayPool | None = None,
+) -> list[TaskResult]:
+    """
+    Run `tasks` with at most `concurrency` running at once. Every running task
+    leases a display of its own from `display_pool`, which defaults to the display
+    configured in the environment. All tasks share one rate limiter. With
+    `config.prewarm`, the API client connects while the first tasks start.
+    """
+    rate_limiter = RateLimiter()
+    prewarm = None
+    if config.prewarm:
+        prewarm = asyncio.create_task(
+            prewarm_client(
+                config.provider,
+                api_key=config.api_key
+                if config.provider == APIProvider.ANTHROPIC
+                else None,
+            )
+        )
+    if display_pool is None:
+        display_pool = DisplayPool(existing=[Display.from_env()])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    limit = asyncio.Semaphore(concurrency)
+    results_path = output_dir / "results.jsonl"
+
+    async def run(task: BatchTask) -> TaskResult:
+        async with limit, display_pool.lease() as display:
+            logger.info("[%s] started on display %s", task.id, display.name)
+            result = await run_task(
+                task,
+                config=config,
+                output_dir=output_dir,
+                display=display,
+                rate_limiter=rate_limiter,
+            )
+        logger.info("[%s] %s in %.1fs", task.id, result.status, result.seconds)
+        with results_path.open("a") as f:
+            f.write(json.dumps(asdict(result)) + "\n")
+        return result
+
+    results = list(await asyncio.gather(*(run(task) for task in tasks)))
+    if prewarm is not None:
+        await prewarm
+    return results
+
+
+def main(argv: Sequence[str] | None = None):
+    parser = argparse.ArgumentParser(
+        description="Run computer use tasks from a JSONL file concurrently."
+    )
+    parser.add_argument("tasks", type=Path, help="JSONL file of tasks")
+    parser.add_argument("--output-dir", type=Path, default=Path("batch_output"))
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--displays",
+        help="comma separated numbers of running X displays to use, "
+        "defaults to DISPLAY_NUM",
+    )
+    parser.add_argument(
+        "--max-displays",
+        type=int,
+        help="launch additional Xvfb displays on demand, up to this many in total",
+    )
+    parser.add_argument(
+        "--provider",
+        type=APIProvider,
+        default=APIProvider(os.getenv("API_PROVIDER") or APIProvider.ANTHROPIC),
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument(
+        "--tool-version",
+        choices=list(TOOL_GROUPS_BY_VERSION),
+        default=DEFAULT_TOOL_VERSION,
+    )
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--only-n-most-recent-images", type=int, default=3)
+    parser.add_argument(
+        "--screenshot-dedupe-threshold",
+        type=int,
+        default=DEFAULT_DEDUPE_THRESHOLD,
+        help="replace screenshots within this many hash bits of the previous one "
+        "with a note, negative to always send them",
+    )
+    parser.add_argument(
+        "--screenshot-format",
+        type=ImageFormat,
+        choices=list(ImageFormat),
+        default=ImageFormat.PNG,
+    )
+    parser.add_argument(
+        "--screenshot-quality", type=int, default=80, help="JPEG/WebP quality, 1-100"
+    )
+    parser.add_argument(
+        "--screenshot-colors",
+        type=int,
+        help="quantize PNG screenshots to a palette of this many colors",
+    )
+    parser.add_argument("--screenshot-grayscale", action="store_true")
+    parser.add_argument(
+        "--trace", action="store_true", help="write a Chrome trace per task"
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="record each task for offline replay (see computer_use_demo.replay)",
+    )
+    parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="open the API connection while the first displays start",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    environment_display = Display.from_env()
+    existing = (
+        [
+            Display(
+                num=int(num),
+                width=environment_display.width,
+                height=environment_display.height,
+            )
+            for num in args.displays.split(",")
+        ]
+        if args.displays
+        else [environment_display]
+    )
+    display_pool = DisplayPool(existing=existing, max_displays=args.max_displays)
+    config = BatchConfig(
+        provider=args.provider,
+        api_key=os.getenv("ANTHROPIC_API_KEY", ""),
+        model=args.model,
+        tool_version=args.tool_version,
+        max_tokens=args.max_tokens,
+        only_n_most_recent_images=args.only_n_most_recent_images,
+        screenshot_dedupe_threshold=args.screenshot_dedupe_threshold
+        if args.screenshot_dedupe_threshold >= 0
+        else None,
+        screenshot_encoding=ScreenshotEncoding(
+            format=args.screenshot_format,
+            quality=args.screenshot_quality,
+            colors=args.screenshot_colors,
+            grayscale=args.screenshot_grayscale,
+        ),
+        trace=args.trace,
+        record=args.record,
+        prewarm=args.prewarm,
+    )
+
+    async def run() -> list[TaskResult]:
+        try:
+            return await run_batch(
+                load_tasks(args.tasks),
+                config=config,
+                output_dir=args.output_dir,
+                concurrency=args.concurrency,
+                display_pool=display_pool,
+            )
+        finally:
+            await display_pool.aclose()
+            await CLIENT_REGISTRY.aclose()
+
+    results = asyncio.run(run())
+    failed = [result.id for result in results if result.status != "completed"]
+    logger.info("%d tasks, %d failed", len(results), len(failed))
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
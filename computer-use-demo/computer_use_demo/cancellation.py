@@ -0,0 +1,104 @@
+"""
+Cooperative cancellation of a sampling loop and the tool calls it started.
+
+A `CancellationToken` is passed to `sampling_loop`, which hands it on to the tool
+collection. Cancelling the token, from any thread, cancels the API request or tool
+calls waiting on it; tools kill the subprocesses they started when they are
+cancelled, and cancelled tool calls return a `ToolCancelled` result so that the
+transcript stays complete.
+"""
+
+import asyncio
+import threading
+from collections.abc import Awaitable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+CANCELLED_ERROR = "tool call was cancelled"
+
+
+class Cancelled(Exception):
+    """Raised by `guard` when its token was cancelled first."""
+
+
+class CancellationToken:
+    """A one-shot cancellation signal that can be set from any thread."""
+
+    def __init__(self):
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = (
+            set()
+        )
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_resolve, future)
+
+    async def wait(self):
+        """Wait until the token is cancelled."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._lock:
+            if self._cancelled:
+                return
+            self._waiters.add(waiter)
+        try:
+            await waiter[1]
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    async def guard(self, awaitable: Awaitable[T]) -> T:
+        """
+        Await `awaitable`, cancelling it and raising `Cancelled` if the token is
+        cancelled first.
+        """
+        if self._cancelled:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise Cancelled
+        task = asyncio.ensure_future(awaitable)
+        cancelled = asyncio.ensure_future(self.wait())
+        try:
+            await asyncio.wait({task, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            await _cancel(task)
+            raise
+        finally:
+            cancelled.cancel()
+        if not task.done():
+            await _cancel(task)
+            raise Cancelled
+        return task.result()
+
+
+async def guard(token: CancellationToken | None, awaitable: Awaitable[T]) -> T:
+    """Await `awaitable` under `token`, if there is one."""
+    if token is None:
+        return await awaitable
+    return await token.guard(awaitable)
+
+
+async def _cancel(task: "asyncio.Future"):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def _resolve(future: "asyncio.Future[None]"):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,236 @@
+"""
+Process-wide registry of long-lived Anthropic API clients.
+
+Building a client per turn pays for connection setup, TLS handshakes and credential
+resolution on every request. The registry keeps one client (and one HTTP keep-alive
+pool) per provider, API key and region so that turns and sessions sharing an event
+loop reuse warm connections. Requests sent by these clients are also scheduled by
+the `RateLimiter` of the calling context, if any (see `ratelimit.py`).
+"""
+
+import asyncio
+import os
+import weakref
+from dataclasses import dataclass, field
+from enum import StrEnum
+from typing import Any
+
+import httpx
+from anthropic import AsyncAnthropic, AsyncAnthropicBedrock, AsyncAnthropicVertex
+from anthropic._compat import model_copy
+from anthropic._models import FinalRequestOptions
+
+from . import ratelimit
+from .serialization import SerializedMessages
+
+AsyncClient = AsyncAnthropic | AsyncAnthropicBedrock | AsyncAnthropicVertex
+
+# keep idle connections around long enough to survive a turn of tool calls
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=20, keepalive_expiry=120.0
+)
+
+
+class APIProvider(StrEnum):
+    ANTHROPIC = "anthropic"
+    BEDROCK = "bedrock"
+    VERTEX = "vertex"
+
+
+class PreSerializingAnthropic(AsyncAnthropic):
+    """
+    AsyncAnthropic client that accepts `SerializedMessages` as the `messages` of a
+    request and splices their JSON into the body instead of encoding them again.
+    """
+
+    accepts_serialized_messages = True
+
+    @property
+    def user_agent(self) -> str:
+        return f"AsyncAnthropic/Python {self._version}"
+
+    # `_build_request`, `model_copy` and `FinalRequestOptions` are SDK internals; the
+    # anthropic range in requirements.txt is the one this override is tested against
+    # and clients_test.py fails if their shape changes.
+    def _build_request(
+        self, options: FinalRequestOptions, *, retries_taken: int = 0
+    ) -> httpx.Request:
+        json_data = options.json_data
+        if not (
+            isinstance(json_data, dict)
+            and isinstance(messages := json_data.get("messages"), SerializedMessages)
+        ):
+            return super()._build_request(options, retries_taken=retries_taken)
+
+        fields = {key: value for key, value in json_data.items() if key != "messages"}
+        fields.update(options.extra_json or {})
+        options = model_copy(options)
+        options.json_data = None
+        options.extra_json = None
+        request = super()._build_request(options, retries_taken=retries_taken)
+        return httpx.Request(
+            request.method,
+            request.url,
+            headers=[
+                (name, value)
+                for name, value in request.headers.raw
+                if name.lower() not in (b"content-length", b"transfer-encoding")
+            ],
+            content=messages.render(fields),
+            extensions=request.extensions,
+        )
+
+
+@dataclass(frozen=True, kw_only=True)
+class ClientKey:
+    provider: APIProvider
+    api_key: str | None = field(default=None, repr=False)
+    region: str | None = None
+
+
+@dataclass(kw_only=True)
+class PoolStats:
+    """Connection pool usage for a single client."""
+
+    requests: int = 0
+    connections_opened: int = 0
+
+    @property
+    def connections_reused(self) -> int:
+        return max(self.requests - self.connections_opened, 0)
+
+
+@dataclass(kw_only=True)
+class _Entry:
+    client: AsyncClient
+    http_client: httpx.AsyncClient
+    stats: PoolStats
+
+
+class ClientRegistry:
+    """
+    Caches API clients by (provider, api key, region).
+
+    httpx connection pools are bound to the event loop that opened them, so clients
+    are cached per running loop. Whoever owns a loop calls `aclose` on it before the
+    loop goes away, or its connections stay open until they are garbage collected.
+    """
+
+    def __init__(self, *, limits: httpx.Limits = DEFAULT_LIMITS, max_retries: int = 4):
+        self.limits = limits
+        self.max_retries = max_retries
+        self._entries: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[ClientKey, _Entry]
+        ] = weakref.WeakKeyDictionary()
+
+    def get(
+        self,
+        provider: APIProvider,
+        *,
+        api_key: str | None = None,
+        region: str | None = None,
+    ) -> AsyncClient:
+        """Return the cached client for the given provider, creating it if needed."""
+        return self._entry(provider, api_key=api_key, region=region).client
+
+    def stats(self) -> dict[ClientKey, PoolStats]:
+        """Pool stats for every client created on the running event loop."""
+        entries = self._entries.get(asyncio.get_running_loop(), {})
+        return {key: entry.stats for key, entry in entries.items()}
+
+    async def prewarm(
+        self,
+        provider: APIProvider,
+        *,
+        api_key: str | None = None,
+        region: str | None = None,
+    ):
+        """Create the client and open a connection to its API host ahead of time."""
+        entry = self._entry(provider, api_key=api_key, region=region)
+        try:
+            await entry.http_client.head(str(entry.client.base_url))
+        except httpx.HTTPError:
+            # a failed prewarm only means the first request pays for the handshake
+            pass
+
+    async def aclose(self):
+        """Close every client created on the running event loop."""
+        entries = self._entries.pop(asyncio.get_running_loop(), {})
+        for entry in entries.values():
+            await entry.http_client.aclose()
+
+    def _entry(
+        self, provider: APIProvider, *, api_key: str | None, region: str | None
+    ) -> _Entry:
+        provider = APIProvider(provider)
+        if provider == APIProvider.VERTEX:
+            region = region or os.environ.get("CLOUD_ML_REGION")
+        elif provider == APIProvider.BEDROCK:
+            region = region or os.environ.get("AWS_REGION")
+        key = ClientKey(provider=provider, api_key=api_key, region=region)
+
+        entries = self._entries.setdefault(asyncio.get_running_loop(), {})
+        if (entry := entries.get(key)) is None:
+            entry = entries[key] = self._create(key)
+        return entry
+
+    def _create(self, key: ClientKey) -> _Entry:
+        stats = PoolStats()
+
+        async def trace(event: str, info: dict[str, Any]):
+            if event == "connection.connect_tcp.complete":
+                stats.connections_opened += 1
+            elif event.endswith(".send_request_headers.started"):
+                stats.requests += 1
+
+        async def add_trace(request: httpx.Request):
+            request.extensions["trace"] = trace
+
+        http_client = httpx.AsyncClient(
+            limits=self.limits,
+            timeout=httpx.Timeout(timeout=600.0, connect=5.0),
+            follow_redirects=True,
+            event_hooks={
+                "request": [add_trace, ratelimit.before_request],
+                "response": [ratelimit.after_response],
+            },
+        )
+        client: AsyncClient
+        if key.provider == APIProvider.ANTHROPIC:
+            client = PreSerializingAnthropic(
+                api_key=key.api_key,
+                max_retries=self.max_retries,
+                http_client=http_client,
+            )
+        elif key.provider == APIProvider.VERTEX:
+            # the SDK raises its own error when no region can be resolved
+            region_kwargs = {"region": key.region} if key.region else {}
+            client = AsyncAnthropicVertex(http_client=http_client, **region_kwargs)
+        else:
+            client = AsyncAnthropicBedrock(
+                aws_region=key.region, http_client=http_client
+            )
+        return _Entry(client=client, http_client=http_client, stats=stats)
+
+
+CLIENT_REGISTRY = ClientRegistry()
+
+
+def get_client(
+    provider: APIProvider,
+    *,
+    api_key: str | None = None,
+    region: str | None = None,
+) -> AsyncClient:
+    """Return a long-lived client from the process-wide registry."""
+    return CLIENT_REGISTRY.get(provider, api_key=api_key, region=region)
+
+
+async def prewarm_client(
+    provider: APIProvider,
+    *,
+    api_key: str | None = None,
+    region: str | None = None,
+):
+    """Connect the process-wide registry's client for `provider` ahead of time."""
+    await CLIENT_REGISTRY.prewarm(provider, api_key=api_key, region=region)
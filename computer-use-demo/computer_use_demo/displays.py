@@ -0,0 +1,250 @@
+"""
+A pool of X displays that sessions lease one at a time, so that one container can
+serve several concurrent computer use sessions.
+"""
+
+import asyncio
+import os
+from collections.abc import AsyncIterator, Sequence
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+DPI = 96
+# display numbers below this are left to the container's own display (:1)
+FIRST_POOL_DISPLAY_NUM = 10
+DEFAULT_IDLE_TIMEOUT = 300.0  # seconds
+XVFB_READY_TIMEOUT = 10.0  # seconds
+
+
+@dataclass(frozen=True, kw_only=True)
+class Display:
+    num: int | None
+    width: int
+    height: int
+
+    @classmethod
+    def from_env(cls) -> "Display":
+        """The display configured by DISPLAY_NUM, WIDTH and HEIGHT."""
+        display_num = os.getenv("DISPLAY_NUM")
+        return cls(
+            num=int(display_num) if display_num else None,
+            width=int(os.getenv("WIDTH") or 0),
+            height=int(os.getenv("HEIGHT") or 0),
+        )
+
+    @property
+    def name(self) -> str | None:
+        return f":{self.num}" if self.num is not None else None
+
+
+class DisplayPool:
+    """
+    Leases displays to sessions, one session per display.
+
+    `existing` displays are already running and are only handed out. Beyond those,
+    up to `max_displays` in total are launched on demand as Xvfb with the same window
+    manager and panel as the main display; it defaults to the number of existing
+    displays, or one if there are none. Released displays are reused by the next
+    lease; launched displays that stay idle for `idle_timeout` seconds are shut down.
+    """
+
+    def __init__(
+        self,
+        *,
+        existing: Sequence[Display] = (),
+        max_displays: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        first_display_num: int = FIRST_POOL_DISPLAY_NUM,
+    ):
+        self.existing = list(existing)
+        self.max_displays = (
+            max_displays if max_displays is not None else len(self.existing) or 1
+        )
+        if self.max_displays < 1:
+            raise ValueError(f"{max_displays=} must be at least 1")
+        self.width = width or int(os.getenv("WIDTH") or 1024)
+        self.height = height or int(os.getenv("HEIGHT") or 768)
+        self.idle_timeout = idle_timeout
+        self.first_display_num = first_display_num
+        # displays that are running or starting, leased or not
+        self._displays: list[Display] = list(self.existing)
+        # (display, loop time it was released), most recently released last
+        self._idle: list[tuple[Display, float]] = [
+            (display, 0.0) for display in reversed(self.existing)
+        ]
+        self._processes: dict[Display, list[asyncio.subprocess.Process]] = {}
+        self._condition = asyncio.Condition()
+        # one timer, due when the longest idle launched display expires
+        self._reaper: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Future] = set()
+
+    @property
+    def size(self) -> int:
+        return len(self._displays)
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[Display]:
+        display = await self.acquire()
+        try:
+            yield display
+        finally:
+            await self.release(display)
+
+    async def acquire(self) -> Display:
+        """Wait for a free display, launching a new one if the pool has room."""
+        async with self._condition:
+            while True:
+                if self._idle:
+                    display, _ = self._idle.pop()
+                    return display
+                if self.size < self.max_displays:
+                    display = Display(
+                        num=self._next_display_num(),
+                        width=self.width,
+                        height=self.height,
+                    )
+                    self._displays.append(display)
+                    break
+                await self._condition.wait()
+        try:
+            await self._start(display)
+        except BaseException:
+            await self._stop(display)
+            async with self._condition:
+                self._displays.remove(display)
+                self._condition.notify()
+            raise
+        return display
+
+    async def release(self, display: Display):
+        loop = asyncio.get_running_loop()
+        async with self._condition:
+            self._idle.append((display, loop.time()))
+            self._condition.notify()
+        if display not in self.existing and self._reaper is None:
+            self._schedule_reap()
+
+    async def reap(self):
+        """Shut down launched displays that have been idle for `idle_timeout`."""
+        now = asyncio.get_running_loop().time()
+        async with self._condition:
+            expired = [
+                display
+                for display, since in self._idle
+                if display not in self.existing and now - since >= self.idle_timeout
+            ]
+            self._idle = [entry for entry in self._idle if entry[0] not in expired]
+            for display in expired:
+                self._displays.remove(display)
+            if expired:
+                self._condition.notify(len(expired))
+        self._schedule_reap()
+        for display in expired:
+            await self._stop(display)
+
+    async def aclose(self):
+        """Shut down every launched display."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        async with self._condition:
+            launched = [d for d in self._displays if d not in self.existing]
+            self._displays = list(self.existing)
+            self._idle = [entry for entry in self._idle if entry[0] in self.existing]
+        for display in launched:
+            await self._stop(display)
+
+    def _schedule_reap(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        idle_since = [
+            since for display, since in self._idle if display not in self.existing
+        ]
+        if idle_since:
+            self._reaper = asyncio.get_running_loop().call_at(
+                min(idle_since) + self.idle_timeout, self._spawn_reap
+            )
+
+    def _spawn_reap(self):
+        self._reaper = None
+        task = asyncio.ensure_future(self.reap())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _next_display_num(self) -> int:
+        in_use = {display.num for display in self._displays}
+        num = self.first_display_num
+        # skip displays started outside the pool, which hold an X lock file
+        while num in in_use or Path(f"/tmp/.X{num}-lock").exists():
+            num += 1
+        return num
+
+    async def _start(self, display: Display):
+        """Start Xvfb, the window manager and the panel on `display`."""
+        processes = self._processes.setdefault(display, [])
+        processes.append(
+            await asyncio.create_subprocess_exec(
+                "Xvfb",
+                f":{display.num}",
+                "-ac",
+                "-screen",
+                "0",
+                f"{display.width}x{display.height}x24",
+                "-retro",
+                "-dpi",
+                str(DPI),
+                "-nolisten",
+                "tcp",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        )
+        await self._wait_until_ready(display)
+        env = {**os.environ, "DISPLAY": f":{display.num}", "XDG_SESSION_TYPE": "x11"}
+        for command in (
+            ["mutter", "--replace", "--sm-disable"],
+            ["tint2", "-c", str(Path.home() / ".config/tint2/tint2rc")],
+        ):
+            processes.append(
+                await asyncio.create_subprocess_exec(
+                    *command,
+                    env=env,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+            )
+
+    async def _wait_until_ready(self, display: Display):
+        async with asyncio.timeout(XVFB_READY_TIMEOUT):
+            while True:
+                process = await asyncio.create_subprocess_exec(
+                    "xdpyinfo",
+                    "-display",
+                    f":{display.num}",
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                if await process.wait() == 0:
+                    return
+                await asyncio.sleep(0.1)
+
+    async def _stop(self, display: Display):
+        processes = self._processes.pop(display, [])
+        # signal them all before waiting, so a cancelled stop (e.g. a reap cancelled
+        # by aclose) still shuts the display down
+        for process in reversed(processes):
+            if process.returncode is None:
+                process.terminate()
+        for process in reversed(processes):
+            await process.wait()
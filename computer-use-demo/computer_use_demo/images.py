@@ -0,0 +1,555 @@
+"""
+Helpers for the screenshots that accumulate in the message history.
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import time
+import weakref
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Literal, TypedDict, cast
+
+from anthropic.types.beta import (
+    BetaImageBlockParam,
+    BetaMessageParam,
+    BetaTextBlockParam,
+    BetaToolResultBlockParam,
+)
+
+from .tools import ToolResult
+from .tools.base import detect_media_type
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_REF_SOURCE = "image_ref"
+MISSING_IMAGE_TEXT = "(screenshot no longer available)"
+DEFAULT_MAX_MEMORY_BYTES = 256 * 1024 * 1024
+
+# prompt cache pricing relative to uncached input tokens
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+CACHE_TTL = 300.0  # seconds
+# roughly width * height / 750 for a WXGA screenshot
+TOKENS_PER_IMAGE = 1_400
+
+# a 32x32 difference hash is fine enough to notice a few typed characters
+HASH_SIZE = 32
+DEFAULT_DEDUPE_THRESHOLD = 2
+
+
+def perceptual_hash(base64_image: str, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash of an image: one bit per horizontally adjacent pixel pair."""
+    assert Image is not None
+    with Image.open(io.BytesIO(base64.b64decode(base64_image))) as image:
+        pixels = list(
+            image.convert("L")
+            .resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+            .getdata()
+        )
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            bits = bits << 1 | (pixels[offset] > pixels[offset + 1])
+    return bits
+
+
+class ScreenshotDeduplicator:
+    """
+    Replaces screenshots that look the same as the previous one with a short note.
+
+    Each kept screenshot's perceptual hash is remembered by tool_use id. A new
+    screenshot whose hash is within `threshold` bits of the last kept one is dropped
+    from the tool result sent to the API.
+    """
+
+    def __init__(self, threshold: int = DEFAULT_DEDUPE_THRESHOLD):
+        self.threshold = threshold
+        self.hashes: dict[str, int] = {}
+        self._last: str | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    async def seed(
+        self,
+        messages: list[BetaMessageParam],
+        image_store: "ImageStore | None" = None,
+    ):
+        """Hash the most recent screenshot already in the history."""
+        if not self.enabled:
+            return
+        for message in reversed(messages):
+            if not isinstance(message["content"], list):
+                continue
+            for block in reversed(message["content"]):
+                if not (isinstance(block, dict) and block["type"] == "tool_result"):
+                    continue
+                block = cast(BetaToolResultBlockParam, block)
+                for item in reversed(list(block.get("content") or [])):
+                    if isinstance(item, dict) and item["type"] == "image":
+                        try:
+                            await self._remember(
+                                block["tool_use_id"],
+                                image_store.get(item["source"]["key"])
+                                if _is_image_ref(item) and image_store is not None
+                                else item["source"]["data"],
+                            )
+                        except (KeyError, OSError):
+                            pass
+                        return
+
+    async def dedupe(self, result: ToolResult, tool_use_id: str) -> ToolResult:
+        """Return `result`, or a copy without its screenshot if the screen is unchanged."""
+        if not self.enabled or not result.base64_image:
+            return result
+        previous = self._last
+        try:
+            image_hash = await self._remember(tool_use_id, result.base64_image)
+        except OSError:
+            return result
+        if (
+            previous is None
+            or (image_hash ^ self.hashes[previous]).bit_count() > self.threshold
+        ):
+            return result
+        # keep comparing against the screenshot the model actually has
+        del self.hashes[tool_use_id]
+        self._last = previous
+        note = f"(screen unchanged since tool_use {previous}, screenshot omitted)"
+        return result.replace(
+            base64_image=None,
+            output=f"{result.output}\n{note}" if result.output else note,
+        )
+
+    async def _remember(self, tool_use_id: str, base64_image: str) -> int:
+        image_hash = await asyncio.to_thread(perceptual_hash, base64_image)
+        self.hashes[tool_use_id] = image_hash
+        self._last = tool_use_id
+        return image_hash
+
+
+class ImageIndex:
+    """
+    Tool result blocks holding images in a message history, oldest first.
+
+    The index only scans messages appended since the last `update`, so counting and
+    pruning images costs time proportional to the new and the evicted blocks rather
+    than to the whole history. Messages are assumed not to gain images after they
+    have been appended. `image_bytes` is the base64 size of the indexed images, with
+    image references resolved through `image_store`.
+    """
+
+    def __init__(self, image_store: "ImageStore | None" = None):
+        self.image_store = image_store
+        self.images = 0
+        self.image_bytes = 0
+        self._messages: list[BetaMessageParam] | None = None
+        self._indexed = 0
+        # (tool_result block, base64 sizes of the images left in it)
+        self._blocks: deque[tuple[Any, deque[int]]] = deque()
+
+    def update(self, messages: list[BetaMessageParam]):
+        """Index the messages appended to `messages` since the previous update."""
+        if messages is not self._messages or len(messages) < self._indexed:
+            self.__init__(self.image_store)
+            self._messages = messages
+        for message in messages[self._indexed :]:
+            if not isinstance(message["content"], list):
+                continue
+            for block in message["content"]:
+                if not (
+                    isinstance(block, dict)
+                    and block.get("type") == "tool_result"
+                    and isinstance(block.get("content"), list)
+                ):
+                    continue
+                sizes = deque(
+                    self._size(item) for item in block["content"] if _is_image(item)
+                )
+                if sizes:
+                    self._blocks.append((block, sizes))
+                    self.images += len(sizes)
+                    self.image_bytes += sum(sizes)
+        self._indexed = len(messages)
+
+    def prune(self, images_to_keep: int, min_removal_threshold: int) -> int:
+        """
+        Remove all but the last `images_to_keep` images in place, in chunks of
+        `min_removal_threshold`, and return how many were removed.
+        """
+        images_to_remove = self.images - images_to_keep
+        images_to_remove -= images_to_remove % min_removal_threshold
+        removed = 0
+        while removed < images_to_remove:
+            block, sizes = self._blocks[0]
+            n = min(len(sizes), images_to_remove - removed)
+            content = []
+            for item in block["content"]:
+                if n and _is_image(item):
+                    n -= 1
+                    removed += 1
+                    self.image_bytes -= sizes.popleft()
+                    continue
+                content.append(item)
+            block["content"] = content
+            if not sizes:
+                self._blocks.popleft()
+        self.images -= removed
+        return removed
+
+    def _size(self, item: dict[str, Any]) -> int:
+        if not _is_image_ref(item):
+            return len(item["source"].get("data", ""))
+        if self.image_store is None:
+            return 0
+        try:
+            return len(self.image_store.get(item["source"]["key"]))
+        except KeyError:
+            return 0
+
+
+class ImageRefSourceParam(TypedDict):
+    """Image source pointing into an ImageStore, used in place of inline base64."""
+
+    type: Literal["image_ref"]
+    key: str
+
+
+class ImageStore:
+    """
+    Content-addressed store for the screenshots referenced by a message history.
+
+    Images are kept base64 encoded in an in-memory LRU bounded by `max_memory_bytes`.
+    With a `directory` every image is also written to disk, so evicted images can be
+    read back; without one, evicted images are gone and are rendered as a short note
+    when the history is materialized. `put` and `externalize` write to disk on the
+    calling thread; on an event loop use `aput` and `aexternalize`.
+    """
+
+    def __init__(
+        self,
+        directory: Path | str | None = None,
+        *,
+        max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    ):
+        self.directory = Path(directory) if directory is not None else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._memory_bytes = 0
+        self._finalizer: weakref.finalize | None = None
+
+    @classmethod
+    def for_session(cls, parent: Path | str, **kwargs: Any) -> "ImageStore":
+        """
+        A store in a new subdirectory of `parent`, which is removed with its images
+        when the store is closed or garbage collected, or the process exits.
+        """
+        Path(parent).mkdir(parents=True, exist_ok=True)
+        store = cls(tempfile.mkdtemp(prefix="session-", dir=parent), **kwargs)
+        store._finalizer = weakref.finalize(
+            store, shutil.rmtree, store.directory, ignore_errors=True
+        )
+        return store
+
+    def close(self):
+        """Remove the directory of a store created by `for_session`."""
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def put(self, base64_image: str) -> str:
+        """Store an image and return its key."""
+        key = _image_key(base64_image)
+        self._write(key, base64_image)
+        self._cache(key, base64_image)
+        return key
+
+    async def aput(self, base64_image: str) -> str:
+        """Like `put`, but writes to disk in a worker thread."""
+        key = _image_key(base64_image)
+        if self.directory is not None and key not in self._memory:
+            await asyncio.to_thread(self._write, key, base64_image)
+        self._cache(key, base64_image)
+        return key
+
+    def get(self, key: str) -> str:
+        """Return the base64 encoded image for `key`, or raise KeyError."""
+        if (base64_image := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            return base64_image
+        if self.directory is not None and (path := self.directory / key).exists():
+            base64_image = base64.b64encode(path.read_bytes()).decode()
+            self._cache(key, base64_image)
+            return base64_image
+        raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._memory or (
+            self.directory is not None and (self.directory / key).exists()
+        )
+
+    def externalize(self, result: ToolResult) -> ToolResult:
+        """Move a result's screenshot into the store, keeping only its key."""
+        if not result.base64_image:
+            return result
+        return result.replace(
+            base64_image=None, image_key=self.put(result.base64_image)
+        )
+
+    async def aexternalize(self, result: ToolResult) -> ToolResult:
+        """Like `externalize`, but writes to disk in a worker thread."""
+        if not result.base64_image:
+            return result
+        return result.replace(
+            base64_image=None, image_key=await self.aput(result.base64_image)
+        )
+
+    def materialize(self, messages: list[BetaMessageParam]) -> list[BetaMessageParam]:
+        """
+        Return `messages` with image references replaced by inline base64 images,
+        ready to be sent to the API. Only the messages, blocks and lists on the path
+        to a reference are copied; `messages` itself is left untouched.
+        """
+        materialized: list[BetaMessageParam] = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list) and any(
+                _has_image_ref(block) for block in content
+            ):
+                message = cast(
+                    BetaMessageParam,
+                    {
+                        **message,
+                        "content": [self._materialize_block(b) for b in content],
+                    },
+                )
+            materialized.append(message)
+        return materialized
+
+    def _materialize_block(self, block: Any) -> Any:
+        if not _has_image_ref(block):
+            return block
+        if block["type"] == "image":
+            return self._materialize_image(block)
+        return {
+            **block,
+            "content": [
+                self._materialize_image(item) if _is_image_ref(item) else item
+                for item in block["content"]
+            ],
+        }
+
+    def _materialize_image(
+        self, block: dict[str, Any]
+    ) -> BetaImageBlockParam | BetaTextBlockParam:
+        try:
+            base64_image = self.get(block["source"]["key"])
+        except KeyError:
+            return BetaTextBlockParam(type="text", text=MISSING_IMAGE_TEXT)
+        materialized = {key: value for key, value in block.items() if key != "source"}
+        materialized["source"] = {
+            "type": "base64",
+            "media_type": detect_media_type(base64_image),
+            "data": base64_image,
+        }
+        return cast(BetaImageBlockParam, materialized)
+
+    def _write(self, key: str, base64_image: str):
+        if self.directory is not None:
+            path = self.directory / key
+            if not path.exists():
+                path.write_bytes(base64.b64decode(base64_image))
+
+    def _cache(self, key: str, base64_image: str):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = base64_image
+        self._memory_bytes += len(base64_image)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+
+def redact_images(value: Any) -> Any:
+    """
+    A copy of a JSON value, e.g. a request body, with every base64 source replaced
+    by an image reference holding only its key.
+    """
+    if isinstance(value, list):
+        return [redact_images(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if value.get("type") == "base64" and isinstance(value.get("data"), str):
+        return ImageRefSourceParam(type=IMAGE_REF_SOURCE, key=_image_key(value["data"]))
+    return {key: redact_images(item) for key, item in value.items()}
+
+
+def _image_key(base64_image: str) -> str:
+    return hashlib.sha256(base64_image.encode()).hexdigest()
+
+
+def _is_image(item: Any) -> bool:
+    return isinstance(item, dict) and item.get("type") == "image"
+
+
+def _is_image_ref(item: Any) -> bool:
+    return (
+        isinstance(item, dict)
+        and item.get("type") == "image"
+        and item["source"]["type"] == IMAGE_REF_SOURCE
+    )
+
+
+def _has_image_ref(block: Any) -> bool:
+    if _is_image_ref(block):
+        return True
+    return (
+        isinstance(block, dict)
+        and block.get("type") == "tool_result"
+        and isinstance(block.get("content"), list)
+        and any(_is_image_ref(item) for item in block["content"])
+    )
+
+
+@dataclass(frozen=True, kw_only=True)
+class EvictionEstimate:
+    """Expected effect of evicting old screenshots, in input-token equivalents."""
+
+    images: int
+    # tokens after the first evicted image that have to be written to the cache again
+    rewrite_tokens: int
+    # extra cost of that rewrite compared to reading the same tokens from the cache
+    rewrite_cost: float
+    # cost of the evicted images if they were read from the cache on every turn
+    saved_per_turn: float
+    cache_expired: bool
+
+    @property
+    def break_even_turns(self) -> float:
+        """Turns after which the eviction has paid for its cache rewrite."""
+        if not self.saved_per_turn:
+            return float("inf")
+        return self.rewrite_cost / self.saved_per_turn
+
+
+@dataclass(kw_only=True)
+class CacheAlignedEviction:
+    """
+    Screenshot eviction policy that works together with prompt caching.
+
+    Removing an image invalidates the cached prefix from that image onwards, so
+    images are only evicted in one large chunk, down to `images_to_keep`, either
+    when the history holds `max_images` or when the cache has most likely expired
+    since the previous request and will be rewritten anyway.
+    """
+
+    images_to_keep: int = 10
+    max_images: int = 30
+    cache_ttl: float = CACHE_TTL
+    tokens_per_image: int = TOKENS_PER_IMAGE
+    last_request_at: float | None = None
+    last_estimate: EvictionEstimate | None = None
+
+    def images_to_evict(
+        self,
+        messages: list[BetaMessageParam],
+        now: float | None = None,
+        *,
+        image_index: ImageIndex | None = None,
+    ) -> int:
+        """
+        How many of the oldest images to evict before the next request. With an
+        `image_index` the history is only estimated when eviction is possible.
+        """
+        now = time.monotonic() if now is None else now
+        if image_index is not None:
+            image_index.update(messages)
+            if image_index.images <= self.images_to_keep or (
+                image_index.images < self.max_images and not self._expired(now)
+            ):
+                return 0
+        estimate = self.last_estimate = self.estimate(messages, now)
+        total = estimate.images + self.images_to_keep
+        if estimate.images > 0 and (estimate.cache_expired or total >= self.max_images):
+            return estimate.images
+        return 0
+
+    def record_request(self, now: float | None = None):
+        self.last_request_at = time.monotonic() if now is None else now
+
+    def estimate(
+        self, messages: list[BetaMessageParam], now: float | None = None
+    ) -> EvictionEstimate:
+        """Estimate the cost and savings of evicting down to `images_to_keep`."""
+        now = time.monotonic() if now is None else now
+        cache_expired = self._expired(now)
+        # (tokens, is_image) per content item, in history order
+        items = [
+            (self.tokens_per_image, True)
+            if isinstance(item, dict) and item.get("type") == "image"
+            else (_estimate_text_tokens(item), False)
+            for message in messages
+            for item in _iter_content(message)
+        ]
+        total_images = sum(1 for _, is_image in items if is_image)
+        evicted = max(total_images - self.images_to_keep, 0)
+        rewrite_tokens = 0
+        seen_images = 0
+        for tokens, is_image in items:
+            if is_image and seen_images < evicted:
+                seen_images += 1
+            elif seen_images:
+                rewrite_tokens += tokens
+        return EvictionEstimate(
+            images=evicted,
+            rewrite_tokens=rewrite_tokens,
+            rewrite_cost=0.0
+            if cache_expired
+            else rewrite_tokens * (CACHE_WRITE_MULTIPLIER - CACHE_READ_MULTIPLIER),
+            saved_per_turn=evicted * self.tokens_per_image * CACHE_READ_MULTIPLIER,
+            cache_expired=cache_expired,
+        )
+
+    def _expired(self, now: float) -> bool:
+        return (
+            self.last_request_at is not None
+            and now - self.last_request_at > self.cache_ttl
+        )
+
+
+def _iter_content(message: BetaMessageParam):
+    if not isinstance(content := message["content"], list):
+        yield content
+        return
+    for block in content:
+        if (
+            isinstance(block, dict)
+            and block.get("type") == "tool_result"
+            and isinstance(block.get("content"), list)
+        ):
+            yield from block["content"]
+        else:
+            yield block
+
+
+def _estimate_text_tokens(item: Any) -> int:
+    # ~4 characters per token is close enough for a cost estimate
+    if isinstance(item, str):
+        return len(item) // 4
+    if isinstance(item, dict) and item.get("type") == "text":
+        return len(item.get("text", "")) // 4
+    return len(json.dumps(item, default=str)) // 4
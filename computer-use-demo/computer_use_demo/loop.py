@@ -2,17 +2,15 @@
 Agentic sampling loop that calls the Anthropic API and local implementation of anthropic-defined computer use tools.
 """
 
+import asyncio
 import platform
+import time
 from collections.abc import Callable
 from datetime import datetime
-from enum import StrEnum
 from typing import Any, cast
 
 import httpx
 from anthropic import (
-    Anthropic,
-    AnthropicBedrock,
-    AnthropicVertex,
     APIError,
     APIResponseValidationError,
     APIStatusError,
@@ -26,11 +24,26 @@ from anthropic.types.beta import (
     BetaTextBlock,
     BetaTextBlockParam,
     BetaToolResultBlockParam,
+    BetaToolUseBlock,
     BetaToolUseBlockParam,
 )
 
+from . import ratelimit, tracing
+from .cancellation import CancellationToken, Cancelled, guard
+from .clients import APIProvider, AsyncClient, get_client
+from .images import (
+    CacheAlignedEviction,
+    ImageIndex,
+    ImageRefSourceParam,
+    ImageStore,
+    ScreenshotDeduplicator,
+)
+from .metrics import SessionMetrics, TurnMetrics
+from .serialization import MessageSerializer
 from .tools import (
     TOOL_GROUPS_BY_VERSION,
+    BaseComputerTool,
+    ScreenshotEncoding,
     ToolCollection,
     ToolResult,
     ToolVersion,
@@ -39,12 +52,6 @@ from .tools import (
 PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
 
 
-class APIProvider(StrEnum):
-    ANTHROPIC = "anthropic"
-    BEDROCK = "bedrock"
-    VERTEX = "vertex"
-
-
 # This system prompt is optimized for the Docker environment in this repository and
 # specific tool combinations enabled.
 # We encourage modifying this system prompt to ensure the model has context for the
@@ -84,154 +91,456 @@ async def sampling_loop(
     tool_version: ToolVersion,
     thinking_budget: int | None = None,
     token_efficient_tools_beta: bool = False,
+    stream: bool = False,
+    screenshot_encoding: ScreenshotEncoding | None = None,
+    screenshot_dedupe_threshold: int | None = None,
+    image_store: ImageStore | None = None,
+    image_eviction: CacheAlignedEviction | None = None,
+    metrics: SessionMetrics | None = None,
+    tracer: tracing.Tracer | None = None,
+    tool_collection: ToolCollection | None = None,
+    client: AsyncClient | None = None,
+    rate_limiter: ratelimit.RateLimiter | None = None,
+    session_id: str | None = None,
+    cancellation: CancellationToken | None = None,
 ):
     """
     Agentic sampling loop for the assistant/tool interaction of computer use.
+
+    With `stream`, text and thinking deltas are sent to `output_callback` as they
+    arrive and each tool_use block is dispatched as soon as its input is complete,
+    overlapping tool execution with the rest of the generation.
+
+    With a `screenshot_dedupe_threshold` (`images.DEFAULT_DEDUPE_THRESHOLD` is a good
+    start), screenshots whose perceptual hash is within that many bits of the
+    previous screenshot are replaced by a short note in the API tool result; by
+    default every screenshot is sent.
+
+    With an `image_store`, screenshots are kept in the store and `messages` (as well
+    as the results passed to `tool_output_callback`) only hold references to them;
+    images are inlined only while building each request.
+
+    When prompt caching is enabled, `only_n_most_recent_images` is ignored so that
+    pruning never breaks the cache; pass an `image_eviction` policy to still bound
+    the number of screenshots by evicting them in large, cache-aligned chunks.
+
+    Token usage, API latency, tool wall times and the images sent on every turn are
+    recorded in `metrics`, when given. With a `tracer`, the API calls, tool calls and
+    callbacks of the session are traced to a Chrome trace event timeline.
+
+    Pass a `tool_collection` to run the tools of `tool_version` with non-default
+    settings, such as a different display; by default a new one is created, whose
+    computer tool encodes screenshots with `screenshot_encoding`.
+    Likewise, `client` replaces the registry's client for `provider` (e.g. with a
+    `replay.ReplayClient`).
+
+    Sessions sharing a `rate_limiter` wait for it before every request (including
+    the SDK's retries) and are served in turn; `session_id` identifies the session
+    to it and defaults to one per call.
+
+    Cancelling `cancellation` stops the loop: a pending API request is abandoned,
+    running tool calls are cancelled (killing their subprocesses) and answered with
+    a cancelled tool result, and the messages so far are returned.
     """
     tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
-    tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
+    # clients are long-lived and shared, so connections stay warm across turns
+    if client is None:
+        client = get_client(
+            provider, api_key=api_key if provider == APIProvider.ANTHROPIC else None
+        )
+    if tool_collection is None:
+        tool_collection = ToolCollection(
+            *(
+                ToolCls(screenshot_encoding=screenshot_encoding)
+                if issubclass(ToolCls, BaseComputerTool)
+                else ToolCls()
+                for ToolCls in tool_group.tools
+            )
+        )
+    elif screenshot_encoding is not None:
+        raise ValueError("pass screenshot_encoding to the tools of tool_collection")
     system = BetaTextBlockParam(
         type="text",
         text=f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}",
     )
+    deduplicator = None
+    if screenshot_dedupe_threshold is not None:
+        deduplicator = ScreenshotDeduplicator(screenshot_dedupe_threshold)
+        await deduplicator.seed(messages, image_store)
+    image_index = ImageIndex(image_store)
+    session_id = session_id or f"session-{id(messages):x}"
+    # the uncached prompt of a turn is about as large as that of the previous turn
+    input_tokens_estimate = 0
+    serializer = None
+    # a class attribute, declared by clients that can send SerializedMessages
+    if getattr(type(client), "accepts_serialized_messages", False):
+        serializer = MessageSerializer(
+            image_store.materialize if image_store is not None else None
+        )
 
-    while True:
-        enable_prompt_caching = False
-        betas = [tool_group.beta_flag] if tool_group.beta_flag else []
-        if token_efficient_tools_beta:
-            betas.append("token-efficient-tools-2025-02-19")
-        image_truncation_threshold = only_n_most_recent_images or 0
-        if provider == APIProvider.ANTHROPIC:
-            client = Anthropic(api_key=api_key, max_retries=4)
-            enable_prompt_caching = True
-        elif provider == APIProvider.VERTEX:
-            client = AnthropicVertex()
-        elif provider == APIProvider.BEDROCK:
-            client = AnthropicBedrock()
-
-        if enable_prompt_caching:
-            betas.append(PROMPT_CACHING_BETA_FLAG)
-            _inject_prompt_caching(messages)
-            # Because cached reads are 10% of the price, we don't think it's
-            # ever sensible to break the cache by truncating images
-            only_n_most_recent_images = 0
-            # Use type ignore to bypass TypedDict check until SDK types are updated
-            system["cache_control"] = {"type": "ephemeral"}  # type: ignore
-
-        if only_n_most_recent_images:
-            _maybe_filter_to_n_most_recent_images(
-                messages,
-                only_n_most_recent_images,
-                min_removal_threshold=image_truncation_threshold,
+    with tracing.activate(tracer):
+        while True:
+            if cancellation is not None and cancellation.cancelled:
+                return messages
+            turn_metrics = metrics.start_turn() if metrics is not None else None
+            enable_prompt_caching = False
+            betas = [tool_group.beta_flag] if tool_group.beta_flag else []
+            if token_efficient_tools_beta:
+                betas.append("token-efficient-tools-2025-02-19")
+            image_truncation_threshold = only_n_most_recent_images or 0
+            if provider == APIProvider.ANTHROPIC:
+                enable_prompt_caching = True
+
+            if enable_prompt_caching:
+                betas.append(PROMPT_CACHING_BETA_FLAG)
+                # Because cached reads are 10% of the price, we don't think it's
+                # sensible to break the cache by truncating images on every turn
+                only_n_most_recent_images = 0
+                if image_eviction is not None:
+                    if image_eviction.images_to_evict(
+                        messages, image_index=image_index
+                    ):
+                        _maybe_filter_to_n_most_recent_images(
+                            messages,
+                            image_eviction.images_to_keep,
+                            min_removal_threshold=1,
+                            image_index=image_index,
+                        )
+                _inject_prompt_caching(messages)
+                # Use type ignore to bypass TypedDict check until SDK types are updated
+                system["cache_control"] = {"type": "ephemeral"}  # type: ignore
+
+            if only_n_most_recent_images:
+                _maybe_filter_to_n_most_recent_images(
+                    messages,
+                    only_n_most_recent_images,
+                    min_removal_threshold=image_truncation_threshold,
+                    image_index=image_index,
+                )
+            extra_body = {}
+            if thinking_budget:
+                # Ensure we only send the required fields for thinking
+                extra_body = {
+                    "thinking": {"type": "enabled", "budget_tokens": thinking_budget}
+                }
+
+            if serializer is not None:
+                # only the messages appended or changed since the last turn are encoded
+                request_messages = cast(
+                    list[BetaMessageParam], serializer.serialize(messages)
+                )
+            elif image_store is not None:
+                request_messages = image_store.materialize(messages)
+            else:
+                request_messages = messages
+            if turn_metrics is not None:
+                image_index.update(messages)
+                turn_metrics.images = image_index.images
+                turn_metrics.image_bytes = image_index.image_bytes
+
+            # tools are started as tasks so that calls the tool collection can schedule
+            # concurrently (e.g. screenshots and file views) overlap
+            tool_tasks: dict[str, asyncio.Future[ToolResult]] = {}
+            api_started = time.perf_counter()
+            rate_limited = ratelimit.scheduled(
+                rate_limiter,
+                session_id,
+                input_tokens=input_tokens_estimate,
+                output_tokens=max_tokens,
             )
-        extra_body = {}
-        if thinking_budget:
-            # Ensure we only send the required fields for thinking
-            extra_body = {
-                "thinking": {"type": "enabled", "budget_tokens": thinking_budget}
-            }
-
-        # Call the API
-        # we use raw_response to provide debug information to streamlit. Your
-        # implementation may be able call the SDK directly with:
-        # `response = client.messages.create(...)` instead.
-        try:
-            raw_response = client.beta.messages.with_raw_response.create(
-                max_tokens=max_tokens,
-                messages=messages,
-                model=model,
-                system=[system],
-                tools=tool_collection.to_params(),
-                betas=betas,
-                extra_body=extra_body,
+            if stream:
+                streamed = False
+                try:
+                    with rate_limited:
+                        response = await _stream_response(
+                            client,
+                            cancellation=cancellation,
+                            output_callback=output_callback,
+                            api_response_callback=api_response_callback,
+                            tool_collection=tool_collection,
+                            tool_tasks=tool_tasks,
+                            turn_metrics=turn_metrics,
+                            max_tokens=max_tokens,
+                            messages=request_messages,
+                            model=model,
+                            system=[system],
+                            tools=tool_collection.to_params(),
+                            betas=betas,
+                            extra_body=extra_body,
+                        )
+                    streamed = True
+                except (APIStatusError, APIResponseValidationError) as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    api_response_callback(e.request, e.response, e)
+                    return messages
+                except APIError as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    api_response_callback(e.request, e.body, e)
+                    return messages
+                except Cancelled as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    return messages
+                finally:
+                    # tools dispatched mid-stream must not outlive a stream that
+                    # failed for any reason, including errors in callbacks
+                    if not streamed:
+                        await _cancel_tool_tasks(tool_tasks)
+            else:
+                # Call the API
+                # we use raw_response to provide debug information to streamlit. Your
+                # implementation may be able call the SDK directly with:
+                # `response = await client.messages.create(...)` instead. The async
+                # clients keep the event loop free while waiting on the model, so tools
+                # and other sessions sharing the loop can make progress.
+                try:
+                    with (
+                        rate_limited,
+                        tracing.span("api_call", "api", model=model),
+                    ):
+                        raw_response = await guard(
+                            cancellation,
+                            client.beta.messages.with_raw_response.create(
+                                max_tokens=max_tokens,
+                                messages=request_messages,
+                                model=model,
+                                system=[system],
+                                tools=tool_collection.to_params(),
+                                betas=betas,
+                                extra_body=extra_body,
+                            ),
+                        )
+                except (APIStatusError, APIResponseValidationError) as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    api_response_callback(e.request, e.response, e)
+                    return messages
+                except APIError as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    api_response_callback(e.request, e.body, e)
+                    return messages
+                except Cancelled as e:
+                    _finish_failed_turn(metrics, turn_metrics, e, api_started)
+                    return messages
+
+                with tracing.span("api_response_callback", "callback"):
+                    api_response_callback(
+                        raw_response.http_response.request,
+                        raw_response.http_response,
+                        None,
+                    )
+
+                with tracing.span("parse_response", "api"):
+                    response = raw_response.parse()
+            if enable_prompt_caching and image_eviction is not None:
+                # only a request that succeeded has written the cache
+                image_eviction.record_request()
+            if rate_limiter is not None:
+                input_tokens_estimate = response.usage.input_tokens + (
+                    response.usage.cache_creation_input_tokens or 0
+                )
+            if turn_metrics is not None:
+                turn_metrics.record_usage(
+                    response.usage, time.perf_counter() - api_started
+                )
+
+            with tracing.span("response_to_params", "api"):
+                response_params = _response_to_params(response)
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": response_params,
+                }
             )
-        except (APIStatusError, APIResponseValidationError) as e:
-            api_response_callback(e.request, e.response, e)
-            return messages
-        except APIError as e:
-            api_response_callback(e.request, e.body, e)
-            return messages
-
-        api_response_callback(
-            raw_response.http_response.request, raw_response.http_response, None
-        )
 
-        response = raw_response.parse()
+            if not stream:
+                # blocks have already been sent to output_callback while streaming
+                tool_use_blocks: list[BetaToolUseBlockParam] = []
+                for content_block in response_params:
+                    with tracing.span("output_callback", "callback"):
+                        output_callback(content_block)
+                    if content_block["type"] == "tool_use":
+                        tool_use_blocks.append(content_block)
+                # with the whole response available, consecutive computer actions can
+                # be fused into a single invocation
+                tool_futures = tool_collection.run_many(
+                    [
+                        (block["name"], cast(dict[str, Any], block["input"]))
+                        for block in tool_use_blocks
+                    ],
+                    cancellation,
+                )
+                for block, future in zip(tool_use_blocks, tool_futures, strict=True):
+                    tool_tasks[block["id"]] = future
+                    if turn_metrics is not None:
+                        turn_metrics.track_tool(
+                            block["id"],
+                            block["name"],
+                            cast(dict[str, Any], block["input"]),
+                            future,
+                        )
+
+            # results are collected in the original tool_use order
+            tool_result_content: list[BetaToolResultBlockParam] = []
+            collected = False
+            try:
+                for tool_use_id, task in tool_tasks.items():
+                    result = await task
+                    api_result = result
+                    if deduplicator is not None:
+                        api_result = await deduplicator.dedupe(result, tool_use_id)
+                    if image_store is not None:
+                        result = await image_store.aexternalize(result)
+                        api_result = await image_store.aexternalize(api_result)
+                    tool_result_content.append(
+                        _make_api_tool_result(api_result, tool_use_id)
+                    )
+                    with tracing.span("tool_output_callback", "callback"):
+                        tool_output_callback(result, tool_use_id)
+                collected = True
+            finally:
+                # the remaining tools must not outlive a turn that failed, e.g. on an
+                # error in a callback or when the loop itself is cancelled
+                if not collected:
+                    await _cancel_tool_tasks(tool_tasks)
+
+            if metrics is not None and turn_metrics is not None:
+                metrics.finish_turn(turn_metrics)
+
+            if not tool_result_content:
+                return messages
+
+            messages.append({"content": tool_result_content, "role": "user"})
+
+
+async def _stream_response(
+    client: AsyncClient,
+    *,
+    output_callback: Callable[[BetaContentBlockParam], None],
+    api_response_callback: Callable[
+        [httpx.Request, httpx.Response | object | None, Exception | None], None
+    ],
+    tool_collection: ToolCollection,
+    tool_tasks: dict[str, "asyncio.Future[ToolResult]"],
+    turn_metrics: TurnMetrics | None = None,
+    cancellation: CancellationToken | None = None,
+    **params: Any,
+) -> BetaMessage:
+    """
+    Stream a response, forwarding deltas to `output_callback` and starting a task in
+    `tool_tasks` for each tool_use block as soon as its input is complete. Raises
+    `Cancelled` if `cancellation` is cancelled before the response is complete.
+    """
+    return await guard(
+        cancellation,
+        _consume_stream(
+            client,
+            output_callback=output_callback,
+            api_response_callback=api_response_callback,
+            tool_collection=tool_collection,
+            tool_tasks=tool_tasks,
+            turn_metrics=turn_metrics,
+            cancellation=cancellation,
+            **params,
+        ),
+    )
 
-        response_params = _response_to_params(response)
-        messages.append(
-            {
-                "role": "assistant",
-                "content": response_params,
-            }
-        )
 
-        tool_result_content: list[BetaToolResultBlockParam] = []
-        for content_block in response_params:
-            output_callback(content_block)
-            if content_block["type"] == "tool_use":
-                result = await tool_collection.run(
-                    name=content_block["name"],
-                    tool_input=cast(dict[str, Any], content_block["input"]),
-                )
-                tool_result_content.append(
-                    _make_api_tool_result(result, content_block["id"])
+async def _consume_stream(
+    client: AsyncClient,
+    *,
+    output_callback: Callable[[BetaContentBlockParam], None],
+    api_response_callback: Callable[
+        [httpx.Request, httpx.Response | object | None, Exception | None], None
+    ],
+    tool_collection: ToolCollection,
+    tool_tasks: dict[str, "asyncio.Future[ToolResult]"],
+    turn_metrics: TurnMetrics | None,
+    cancellation: CancellationToken | None,
+    **params: Any,
+) -> BetaMessage:
+    async with (
+        tracing.span("api_call", "api", model=params.get("model"), stream=True),
+        client.beta.messages.stream(**params) as stream,
+    ):
+        async for event in stream:
+            if event.type == "text":
+                with tracing.span("output_callback", "callback"):
+                    output_callback(BetaTextBlockParam(type="text", text=event.text))
+            elif event.type == "thinking":
+                with tracing.span("output_callback", "callback"):
+                    output_callback(
+                        cast(
+                            BetaContentBlockParam,
+                            {"type": "thinking", "thinking": event.thinking},
+                        )
+                    )
+            elif event.type == "content_block_stop" and isinstance(
+                event.content_block, BetaToolUseBlock
+            ):
+                with tracing.span("output_callback", "callback"):
+                    output_callback(
+                        cast(BetaToolUseBlockParam, event.content_block.model_dump())
+                    )
+                tool_input = cast(dict[str, Any], event.content_block.input)
+                task = tool_tasks[event.content_block.id] = asyncio.create_task(
+                    tool_collection.run(
+                        name=event.content_block.name,
+                        tool_input=tool_input,
+                        cancellation=cancellation,
+                    )
                 )
-                tool_output_callback(result, content_block["id"])
+                if turn_metrics is not None:
+                    turn_metrics.track_tool(
+                        event.content_block.id,
+                        event.content_block.name,
+                        tool_input,
+                        task,
+                    )
+        response = await stream.get_final_message()
+    # the streamed body has already been consumed, so report the parsed message
+    with tracing.span("api_response_callback", "callback"):
+        api_response_callback(stream.response.request, response, None)
+    return response
+
+
+def _finish_failed_turn(
+    metrics: SessionMetrics | None,
+    turn_metrics: TurnMetrics | None,
+    error: Exception,
+    api_started: float,
+):
+    if metrics is None or turn_metrics is None:
+        return
+    turn_metrics.api_seconds = time.perf_counter() - api_started
+    turn_metrics.error = f"{type(error).__name__}: {error}"
+    metrics.finish_turn(turn_metrics)
 
-        if not tool_result_content:
-            return messages
 
-        messages.append({"content": tool_result_content, "role": "user"})
+async def _cancel_tool_tasks(tool_tasks: dict[str, "asyncio.Future[ToolResult]"]):
+    for task in tool_tasks.values():
+        task.cancel()
+    await asyncio.gather(*tool_tasks.values(), return_exceptions=True)
 
 
 def _maybe_filter_to_n_most_recent_images(
     messages: list[BetaMessageParam],
     images_to_keep: int,
     min_removal_threshold: int,
+    image_index: ImageIndex | None = None,
 ):
     """
     With the assumption that images are screenshots that are of diminishing value as
     the conversation progresses, remove all but the final `images_to_keep` tool_result
     images in place, with a chunk of min_removal_threshold to reduce the amount we
-    break the implicit prompt cache.
+    break the implicit prompt cache. Pass the same `image_index` on every turn to
+    avoid rescanning the whole history.
     """
     if images_to_keep is None:
         return messages
 
-    tool_result_blocks = cast(
-        list[BetaToolResultBlockParam],
-        [
-            item
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and item.get("type") == "tool_result"
-        ],
-    )
-
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and content.get("type") == "image"
-    )
-
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
-
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and content.get("type") == "image":
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
+    if image_index is None:
+        image_index = ImageIndex()
+    image_index.update(messages)
+    image_index.prune(images_to_keep, min_removal_threshold)
 
 
 def _response_to_params(
@@ -305,11 +614,24 @@ def _make_api_tool_result(
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
+                        "media_type": result.image_media_type,
                         "data": result.base64_image,
                     },
                 }
             )
+        elif result.image_key:
+            # materialized into a base64 source by ImageStore before sending
+            tool_result_content.append(
+                cast(
+                    BetaImageBlockParam,
+                    {
+                        "type": "image",
+                        "source": ImageRefSourceParam(
+                            type="image_ref", key=result.image_key
+                        ),
+                    },
+                )
+            )
     return {
         "type": "tool_result",
         "content": tool_result_content,
@@ -0,0 +1,124 @@
+"""
+Per-turn usage, latency and cache metrics for a sampling loop session.
+"""
+
+import asyncio
+import json
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+from anthropic.types.beta import BetaUsage
+
+from .tools import ToolResult
+
+
+@dataclass(kw_only=True)
+class ToolCallMetrics:
+    tool_use_id: str
+    name: str
+    action: str | None = None
+    # from the start of the call until its result was available
+    seconds: float = 0.0
+    image_bytes: int = 0
+
+
+@dataclass(kw_only=True)
+class TurnMetrics:
+    """One request to the API and the tool calls it asked for."""
+
+    turn: int
+    started_at: float = field(default_factory=time.time)
+    input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    output_tokens: int = 0
+    api_seconds: float = 0.0
+    # images in the request and their base64 size
+    images: int = 0
+    image_bytes: int = 0
+    tools: list[ToolCallMetrics] = field(default_factory=list)
+    error: str | None = None
+
+    def record_usage(self, usage: BetaUsage, api_seconds: float):
+        self.input_tokens = usage.input_tokens
+        self.cache_read_input_tokens = usage.cache_read_input_tokens or 0
+        self.cache_creation_input_tokens = usage.cache_creation_input_tokens or 0
+        self.output_tokens = usage.output_tokens
+        self.api_seconds = api_seconds
+
+    def track_tool(
+        self,
+        tool_use_id: str,
+        name: str,
+        tool_input: dict[str, Any],
+        future: "asyncio.Future[ToolResult]",
+    ):
+        """Record the wall time of a tool call once `future` completes."""
+        metrics = ToolCallMetrics(
+            tool_use_id=tool_use_id,
+            name=name,
+            action=tool_input.get("action") or tool_input.get("command"),
+        )
+        self.tools.append(metrics)
+        started = time.perf_counter()
+
+        def done(future: "asyncio.Future[ToolResult]"):
+            metrics.seconds = time.perf_counter() - started
+            if not future.cancelled() and future.exception() is None:
+                metrics.image_bytes = future.result().image_size
+
+        future.add_done_callback(done)
+
+
+@dataclass(kw_only=True)
+class SessionMetrics:
+    """
+    Metrics for every turn of a session, with running totals.
+
+    Completed turns are appended to `jsonl_path` as one JSON object per line, and
+    passed to `on_turn` so that a UI can refresh.
+    """
+
+    turns: list[TurnMetrics] = field(default_factory=list)
+    jsonl_path: Path | None = None
+    on_turn: Callable[[TurnMetrics], None] | None = field(default=None, repr=False)
+
+    def start_turn(self) -> TurnMetrics:
+        return TurnMetrics(turn=len(self.turns) + 1)
+
+    def finish_turn(self, turn: TurnMetrics):
+        self.turns.append(turn)
+        if self.jsonl_path is not None:
+            with Path(self.jsonl_path).open("a") as f:
+                f.write(json.dumps(asdict(turn)) + "\n")
+        if self.on_turn is not None:
+            self.on_turn(turn)
+
+    def totals(self) -> dict[str, float]:
+        """Session totals, including the cache hit ratio of input tokens."""
+        totals: dict[str, float] = {
+            "turns": len(self.turns),
+            "input_tokens": sum(t.input_tokens for t in self.turns),
+            "cache_read_input_tokens": sum(
+                t.cache_read_input_tokens for t in self.turns
+            ),
+            "cache_creation_input_tokens": sum(
+                t.cache_creation_input_tokens for t in self.turns
+            ),
+            "output_tokens": sum(t.output_tokens for t in self.turns),
+            "api_seconds": sum(t.api_seconds for t in self.turns),
+            "tool_seconds": sum(c.seconds for t in self.turns for c in t.tools),
+            "image_bytes": sum(t.image_bytes for t in self.turns),
+        }
+        prompt_tokens = (
+            totals["input_tokens"]
+            + totals["cache_read_input_tokens"]
+            + totals["cache_creation_input_tokens"]
+        )
+        totals["cache_hit_ratio"] = (
+            totals["cache_read_input_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        )
+        return totals
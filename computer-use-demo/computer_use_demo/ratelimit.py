@@ -0,0 +1,276 @@
+"""
+A rate limit aware request scheduler shared by the sampling loops of a process.
+
+Without it, every session sends its requests independently and only learns about
+rate limits from 429 responses, which the SDK retries while the other sessions keep
+adding to the load. The scheduler keeps token buckets for requests, input tokens and
+output tokens per minute, synchronised with the `anthropic-ratelimit-*` headers of
+every response, holds all sessions back for `retry-after` after a 429, and hands out
+capacity round robin across sessions so that a busy session cannot starve the rest.
+
+Requests wait for the scheduler in an HTTP request hook of the registry's clients
+(see `clients.py`), so retries made by the SDK are scheduled as well. A sampling
+loop opts in by making its API calls inside `RateLimiter.request(...)`.
+"""
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+WINDOW = 60.0  # seconds, the limits are per minute
+
+_HEADER_PREFIX = "anthropic-ratelimit-"
+
+
+@dataclass(frozen=True, kw_only=True)
+class _Request:
+    limiter: "RateLimiter"
+    session: str
+    input_tokens: int
+    output_tokens: int
+
+
+_REQUEST: ContextVar[_Request | None] = ContextVar("rate_limited_request", default=None)
+
+
+@dataclass(kw_only=True)
+class TokenBucket:
+    """
+    A bucket of `limit` tokens per minute, refilled continuously. Without a limit
+    the bucket never runs dry.
+    """
+
+    limit: float | None = None
+    tokens: float = 0.0
+    updated: float = field(default_factory=time.monotonic)
+
+    def refill(self, now: float):
+        if self.limit is not None:
+            self.tokens = min(
+                self.limit, self.tokens + (now - self.updated) * self.limit / WINDOW
+            )
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available."""
+        if self.limit is None:
+            return 0.0
+        self.refill(now)
+        # a request larger than the whole bucket only waits for a full bucket
+        needed = min(amount, self.limit)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) * WINDOW / self.limit
+
+    def take(self, amount: float, now: float):
+        if self.limit is not None:
+            self.refill(now)
+            self.tokens -= amount
+
+    def sync(self, limit: float, remaining: float, now: float):
+        """Adopt the limit and remaining tokens reported by the API."""
+        self.limit = limit
+        self.tokens = remaining
+        self.updated = now
+
+
+@dataclass(kw_only=True)
+class _Waiter:
+    future: "asyncio.Future[None]"
+    input_tokens: int
+    output_tokens: int
+
+
+class RateLimiter:
+    """
+    Token buckets for requests, input tokens and output tokens per minute, and a
+    fair queue of the requests waiting for them.
+
+    The limits start out as given (None for unknown) and follow the response
+    headers from then on. Input tokens are the caller's estimate of the uncached
+    prompt; output tokens are counted at `max_tokens` until the next response
+    reports what is actually left.
+    """
+
+    def __init__(
+        self,
+        *,
+        requests_per_minute: float | None = None,
+        input_tokens_per_minute: float | None = None,
+        output_tokens_per_minute: float | None = None,
+    ):
+        self.requests = TokenBucket(
+            limit=requests_per_minute, tokens=requests_per_minute or 0.0
+        )
+        self.input_tokens = TokenBucket(
+            limit=input_tokens_per_minute, tokens=input_tokens_per_minute or 0.0
+        )
+        self.output_tokens = TokenBucket(
+            limit=output_tokens_per_minute, tokens=output_tokens_per_minute or 0.0
+        )
+        self.blocked_until = 0.0
+        # waiting requests per session, in the round robin order of the sessions
+        self._queues: dict[str, deque[_Waiter]] = {}
+        self._changed = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+
+    @contextmanager
+    def request(
+        self, session: str, *, input_tokens: int = 0, output_tokens: int = 0
+    ) -> Iterator[None]:
+        """Schedule the API requests sent by the registry's clients in this block."""
+        token = _REQUEST.set(
+            _Request(
+                limiter=self,
+                session=session,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+            )
+        )
+        try:
+            yield
+        finally:
+            _REQUEST.reset(token)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def acquire(
+        self, session: str, *, input_tokens: int = 0, output_tokens: int = 0
+    ):
+        """Wait for the turn of `session` and for room in every bucket."""
+        waiter = _Waiter(
+            future=asyncio.get_running_loop().create_future(),
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        )
+        self._queues.setdefault(session, deque()).append(waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            queue = self._queues.get(session)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[session]
+            self._changed.set()
+            raise
+
+    def observe(self, headers: Mapping[str, str], status_code: int | None = None):
+        """Update the buckets from the rate limit headers of a response."""
+        now = time.monotonic()
+        for name, bucket in (
+            ("requests", self.requests),
+            ("input-tokens", self.input_tokens),
+            ("output-tokens", self.output_tokens),
+        ):
+            limit = _number(headers.get(f"{_HEADER_PREFIX}{name}-limit"))
+            remaining = _number(headers.get(f"{_HEADER_PREFIX}{name}-remaining"))
+            if limit is not None and remaining is not None:
+                bucket.sync(limit, remaining, now)
+        if status_code == 429 or "retry-after" in headers:
+            retry_after = _retry_after(headers)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+        self._changed.set()
+
+    def _delay(self, waiter: _Waiter, now: float) -> float:
+        return max(
+            self.blocked_until - now,
+            self.requests.delay(1, now),
+            self.input_tokens.delay(waiter.input_tokens, now),
+            self.output_tokens.delay(waiter.output_tokens, now),
+        )
+
+    async def _dispatch(self):
+        while self._queues:
+            session, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            if waiter.future.done():
+                queue.popleft()
+                if not queue:
+                    del self._queues[session]
+                continue
+            now = time.monotonic()
+            if (delay := self._delay(waiter, now)) > 0:
+                # new headers may lift the limit before the delay is over
+                self._changed.clear()
+                try:
+                    async with asyncio.timeout(delay):
+                        await self._changed.wait()
+                except TimeoutError:
+                    pass
+                continue
+            self.requests.take(1, now)
+            self.input_tokens.take(waiter.input_tokens, now)
+            self.output_tokens.take(waiter.output_tokens, now)
+            queue.popleft()
+            waiter.future.set_result(None)
+            # move the session to the back of the line
+            del self._queues[session]
+            if queue:
+                self._queues[session] = queue
+
+
+def scheduled(
+    limiter: RateLimiter | None,
+    session: str,
+    *,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+):
+    """Context manager scheduling requests with `limiter`, or doing nothing."""
+    if limiter is None:
+        return nullcontext()
+    return limiter.request(
+        session, input_tokens=input_tokens, output_tokens=output_tokens
+    )
+
+
+async def before_request(request: httpx.Request):
+    """httpx request hook waiting for the rate limiter of the current context."""
+    if (scheduled := _REQUEST.get()) is not None:
+        await scheduled.limiter.acquire(
+            scheduled.session,
+            input_tokens=scheduled.input_tokens,
+            output_tokens=scheduled.output_tokens,
+        )
+
+
+async def after_response(response: httpx.Response):
+    """httpx response hook feeding the response headers to the rate limiter."""
+    if (scheduled := _REQUEST.get()) is not None:
+        scheduled.limiter.observe(response.headers, response.status_code)
+
+
+def _number(value: str | None) -> float | None:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _retry_after(headers: Mapping[str, str]) -> float | None:
+    if (milliseconds := _number(headers.get("retry-after-ms"))) is not None:
+        return milliseconds / 1000
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    if (seconds := _number(value)) is not None:
+        return seconds
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(UTC)).total_seconds(), 0.0)
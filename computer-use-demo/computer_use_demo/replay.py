@@ -0,0 +1,386 @@
+"""
+Record the API responses and tool results of a sampling loop session, and replay
+them through `sampling_loop` offline.
+
+A recording is a JSONL file: a `session` line with the model, tools and first
+messages of the session, then one `turn` line per turn with the API
+response, the API latency and every tool result with its wall time.
+
+Replaying runs the real loop (history growth, image filtering, prompt cache
+injection, serialization, callbacks) against a `ReplayClient` and `ReplayTool`s
+that return the recorded responses and results, after the recorded delays scaled
+by `speed`; with `speed=0` only the loop's own overhead is left.
+"""
+
+import asyncio
+import copy
+import json
+from collections import defaultdict, deque
+from collections.abc import AsyncIterator, Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import httpx
+from anthropic.types.beta import (
+    BetaContentBlockParam,
+    BetaMessage,
+    BetaMessageParam,
+    BetaTextBlock,
+    BetaThinkingBlock,
+)
+
+from .images import ImageStore
+from .metrics import SessionMetrics, TurnMetrics
+from .serialization import SerializedMessages
+from .tools import ToolCollection, ToolResult
+from .tools.base import BaseAnthropicTool
+
+REPLAY_URL = "https://replay.invalid/v1/messages"
+
+
+@dataclass(kw_only=True)
+class RecordedToolCall:
+    tool_use_id: str
+    name: str
+    input: dict[str, Any]
+    seconds: float
+    result: dict[str, Any]
+
+
+@dataclass(kw_only=True)
+class RecordedTurn:
+    api_seconds: float
+    response: dict[str, Any]
+    tools: list[RecordedToolCall] = field(default_factory=list)
+
+
+@dataclass(kw_only=True)
+class Recording:
+    model: str = ""
+    max_tokens: int = 4096
+    tools: list[dict[str, Any]] = field(default_factory=list)
+    messages: list[BetaMessageParam] = field(default_factory=list)
+    turns: list[RecordedTurn] = field(default_factory=list)
+
+    @classmethod
+    def load(cls, path: Path | str) -> "Recording":
+        recording = cls()
+        with Path(path).open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                kind = entry.pop("type")
+                if kind == "session":
+                    recording = cls(**entry)
+                elif kind == "turn":
+                    recording.turns.append(
+                        RecordedTurn(
+                            api_seconds=entry["api_seconds"],
+                            response=entry["response"],
+                            tools=[RecordedToolCall(**t) for t in entry["tools"]],
+                        )
+                    )
+        return recording
+
+    def dump(self, path: Path | str):
+        with Path(path).open("w") as f:
+            session = asdict(self)
+            del session["turns"]
+            f.write(json.dumps({"type": "session", **session}) + "\n")
+            for turn in self.turns:
+                f.write(json.dumps({"type": "turn", **asdict(turn)}) + "\n")
+
+
+class SessionRecorder:
+    """
+    Records a session through the callbacks and metrics of `sampling_loop`.
+
+    Pass `metrics` and the wrapped callbacks to the loop:
+
+        recorder = SessionRecorder("session.jsonl", image_store=image_store)
+        await sampling_loop(
+            ...,
+            api_response_callback=recorder.wrap_api_response(api_response_callback),
+            tool_output_callback=recorder.wrap_tool_output(tool_output_callback),
+            metrics=recorder.metrics,
+        )
+
+    Every turn is appended to `path` as soon as it finishes. Screenshots that the
+    loop moved into `image_store` are written inline so that the recording stands
+    on its own.
+    """
+
+    def __init__(
+        self,
+        path: Path | str,
+        *,
+        metrics: SessionMetrics | None = None,
+        image_store: ImageStore | None = None,
+    ):
+        self.path = Path(path)
+        self.image_store = image_store
+        self.metrics = metrics if metrics is not None else SessionMetrics()
+        self._on_turn = self.metrics.on_turn
+        self.metrics.on_turn = self._record_turn
+        self._started = False
+        self._response: dict[str, Any] | None = None
+        self._results: dict[str, ToolResult] = {}
+
+    def wrap_api_response(
+        self,
+        callback: Callable[
+            [httpx.Request, httpx.Response | object | None, Exception | None], None
+        ],
+    ) -> Callable[
+        [httpx.Request, httpx.Response | object | None, Exception | None], None
+    ]:
+        def api_response_callback(
+            request: httpx.Request,
+            response: httpx.Response | object | None,
+            error: Exception | None,
+        ):
+            if error is None:
+                if not self._started:
+                    self._start(json.loads(request.content))
+                if isinstance(response, httpx.Response):
+                    self._response = response.json()
+                elif isinstance(response, BetaMessage):
+                    self._response = response.model_dump(mode="json", exclude_none=True)
+            callback(request, response, error)
+
+        return api_response_callback
+
+    def wrap_tool_output(
+        self, callback: Callable[[ToolResult, str], None]
+    ) -> Callable[[ToolResult, str], None]:
+        def tool_output_callback(result: ToolResult, tool_use_id: str):
+            self._results[tool_use_id] = result
+            callback(result, tool_use_id)
+
+        return tool_output_callback
+
+    def _start(self, body: dict[str, Any]):
+        self._started = True
+        Recording(
+            model=body.get("model", ""),
+            max_tokens=body.get("max_tokens", 4096),
+            tools=body.get("tools", []),
+            messages=body.get("messages", []),
+        ).dump(self.path)
+
+    def _record_turn(self, turn_metrics: TurnMetrics):
+        if self._response is not None:
+            tool_inputs = {
+                block["id"]: block.get("input", {})
+                for block in self._response.get("content", [])
+                if block.get("type") == "tool_use"
+            }
+            turn = RecordedTurn(
+                api_seconds=turn_metrics.api_seconds,
+                response=self._response,
+                tools=[
+                    RecordedToolCall(
+                        tool_use_id=call.tool_use_id,
+                        name=call.name,
+                        input=tool_inputs.get(call.tool_use_id, {}),
+                        seconds=call.seconds,
+                        result=self._result_dict(call.tool_use_id),
+                    )
+                    for call in turn_metrics.tools
+                    if call.tool_use_id in self._results
+                ],
+            )
+            with self.path.open("a") as f:
+                f.write(json.dumps({"type": "turn", **asdict(turn)}) + "\n")
+        self._response = None
+        self._results.clear()
+        if self._on_turn is not None:
+            self._on_turn(turn_metrics)
+
+    def _result_dict(self, tool_use_id: str) -> dict[str, Any]:
+        result = self._results[tool_use_id]
+        if result.image_key and self.image_store is not None:
+            result = result.replace(
+                base64_image=self.image_store.get(result.image_key), image_key=None
+            )
+        return {key: value for key, value in asdict(result).items() if value}
+
+
+class ReplayTool(BaseAnthropicTool):
+    """
+    Stands in for a recorded tool: returns the recorded results of its calls, in
+    order, after their recorded wall time scaled by `speed`.
+    """
+
+    def __init__(
+        self,
+        params: dict[str, Any],
+        calls: list[RecordedToolCall],
+        *,
+        speed: float = 1.0,
+    ):
+        self.params = params
+        self.name = params["name"]
+        self.speed = speed
+        self._calls = deque(calls)
+
+    def to_params(self) -> Any:
+        return self.params
+
+    async def __call__(self, **kwargs) -> ToolResult:
+        # calls may be started out of order, so prefer the one with the same input
+        call = next((call for call in self._calls if call.input == kwargs), None) or (
+            self._calls[0] if self._calls else None
+        )
+        if call is None:
+            return ToolResult(error=f"no recorded result left for {self.name}")
+        self._calls.remove(call)
+        if self.speed:
+            await asyncio.sleep(call.seconds * self.speed)
+        return ToolResult(**call.result)
+
+
+class _RawResponse:
+    def __init__(self, message: BetaMessage, http_response: httpx.Response):
+        self.message = message
+        self.http_response = http_response
+
+    def parse(self) -> BetaMessage:
+        return self.message
+
+
+class _ReplayStream:
+    """The part of the SDK's message stream that `sampling_loop` uses."""
+
+    def __init__(self, message: BetaMessage, response: httpx.Response, delay: float):
+        self.message = message
+        self.response = response
+        self.delay = delay
+
+    async def __aenter__(self) -> "_ReplayStream":
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        blocks = self.message.content
+        for block in blocks:
+            if self.delay:
+                await asyncio.sleep(self.delay / len(blocks))
+            if isinstance(block, BetaTextBlock):
+                yield SimpleNamespace(type="text", text=block.text)
+            elif isinstance(block, BetaThinkingBlock):
+                yield SimpleNamespace(type="thinking", thinking=block.thinking)
+            yield SimpleNamespace(type="content_block_stop", content_block=block)
+
+    async def get_final_message(self) -> BetaMessage:
+        return self.message
+
+
+class ReplayClient:
+    """
+    Stands in for the API client: answers each request with the next recorded
+    response, after the recorded latency scaled by `speed`.
+
+    Request bodies are encoded like the real client would, so that serialization
+    stays part of what is measured.
+    """
+
+    # like PreSerializingAnthropic, requests may carry SerializedMessages
+    accepts_serialized_messages = True
+
+    def __init__(self, turns: list[RecordedTurn], *, speed: float = 1.0):
+        self.turns = deque(turns)
+        self.speed = speed
+        self.requests = 0
+        self.request_bytes = 0
+        messages = SimpleNamespace(
+            create=self._create,
+            stream=self._stream,
+            with_raw_response=SimpleNamespace(create=self._create_raw),
+        )
+        self.beta = SimpleNamespace(messages=messages)
+
+    async def _create(self, **params: Any) -> BetaMessage:
+        return (await self._create_raw(**params)).parse()
+
+    async def _create_raw(self, **params: Any) -> _RawResponse:
+        turn, request = self._next(params)
+        if self.speed:
+            await asyncio.sleep(turn.api_seconds * self.speed)
+        return _RawResponse(
+            BetaMessage.model_validate(turn.response),
+            httpx.Response(200, json=turn.response, request=request),
+        )
+
+    def _stream(self, **params: Any) -> _ReplayStream:
+        turn, request = self._next(params)
+        return _ReplayStream(
+            BetaMessage.model_validate(turn.response),
+            httpx.Response(200, json=turn.response, request=request),
+            turn.api_seconds * self.speed,
+        )
+
+    def _next(self, params: dict[str, Any]) -> tuple[RecordedTurn, httpx.Request]:
+        if not self.turns:
+            raise RuntimeError("the recording has no responses left")
+        messages = params.pop("messages")
+        params.update(params.pop("extra_body", None) or {})
+        params.pop("betas", None)
+        if isinstance(messages, SerializedMessages):
+            content = messages.render(params)
+        else:
+            content = json.dumps({**params, "messages": messages}).encode()
+        self.requests += 1
+        self.request_bytes += len(content)
+        return self.turns.popleft(), httpx.Request("POST", REPLAY_URL, content=content)
+
+
+@dataclass(kw_only=True)
+class Replay:
+    """A client, tools and first messages replaying a recording."""
+
+    recording: Recording
+    client: ReplayClient
+    tool_collection: ToolCollection
+
+    @classmethod
+    def from_recording(cls, recording: Recording, *, speed: float = 1.0) -> "Replay":
+        calls: dict[str, list[RecordedToolCall]] = defaultdict(list)
+        for turn in recording.turns:
+            for call in turn.tools:
+                calls[call.name].append(call)
+        return cls(
+            recording=recording,
+            client=ReplayClient(recording.turns, speed=speed),
+            tool_collection=ToolCollection(
+                *(
+                    ReplayTool(params, calls[params["name"]], speed=speed)
+                    for params in recording.tools
+                )
+            ),
+        )
+
+    def messages(self) -> list[BetaMessageParam]:
+        """A fresh copy of the messages the recorded session started with."""
+        return copy.deepcopy(self.recording.messages)
+
+
+def output_callback(block: BetaContentBlockParam):
+    """A callback that ignores its arguments, for replays without a UI."""
+
+
+def tool_output_callback(result: ToolResult, tool_use_id: str):
+    """A callback that ignores its arguments, for replays without a UI."""
+
+
+def api_response_callback(
+    request: httpx.Request,
+    response: httpx.Response | object | None,
+    error: Exception | None,
+):
+    """A callback that ignores its arguments, for replays without a UI."""
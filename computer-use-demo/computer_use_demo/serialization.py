@@ -0,0 +1,109 @@
+"""
+Incremental JSON encoding of the message history sent with every request.
+
+A computer use session re-sends its whole history, screenshots included, on every
+turn. MessageSerializer keeps the encoded JSON of each message and only encodes the
+messages that were appended or changed since the previous turn, so the request body
+can be assembled by concatenation.
+"""
+
+import json
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from anthropic.types.beta import BetaMessageParam
+
+
+class SerializedMessages:
+    """A message history already encoded as a JSON array."""
+
+    def __init__(self, parts: list[bytes]):
+        self.parts = parts
+
+    def __len__(self) -> int:
+        return len(self.parts)
+
+    def render(self, fields: dict[str, Any]) -> bytes:
+        """Encode a request body with these messages and the other `fields`."""
+        rest = json.dumps(fields, separators=(",", ":"), ensure_ascii=False).encode()
+        chunks = [b'{"messages":[']
+        for part in self.parts:
+            chunks += (part, b",")
+        if self.parts:
+            chunks.pop()
+        chunks.append(b"]}" if rest == b"{}" else b"]," + rest[1:])
+        # a single join copies the (large) encoded history only once
+        return b"".join(chunks)
+
+
+@dataclass(kw_only=True)
+class _Entry:
+    message: BetaMessageParam
+    fingerprint: tuple[Any, ...]
+    # keeps the fingerprinted objects alive so that their ids stay unique
+    refs: list[Any]
+    json: bytes
+
+
+class MessageSerializer:
+    """
+    Caches the JSON encoding of each message in a history.
+
+    A message is re-encoded when it is replaced, when its content list or one of its
+    blocks is replaced, when a tool_result's content list is replaced (as image
+    pruning does), or when a block gains or loses its cache_control marker. Other
+    in-place edits of already sent messages are not detected.
+    """
+
+    def __init__(
+        self,
+        materialize: Callable[[list[BetaMessageParam]], list[BetaMessageParam]]
+        | None = None,
+    ):
+        self.materialize = materialize
+        self.encoded = 0
+        self._entries: list[_Entry] = []
+
+    def serialize(self, messages: list[BetaMessageParam]) -> SerializedMessages:
+        """Encode `messages`, reusing the cached encoding of unchanged messages."""
+        entries: list[_Entry] = []
+        for i, message in enumerate(messages):
+            fingerprint, refs = _fingerprint(message)
+            if i < len(self._entries):
+                entry = self._entries[i]
+                if entry.message is message and entry.fingerprint == fingerprint:
+                    entries.append(entry)
+                    continue
+            entries.append(
+                _Entry(
+                    message=message,
+                    fingerprint=fingerprint,
+                    refs=refs,
+                    json=self._encode(message),
+                )
+            )
+        self._entries = entries
+        return SerializedMessages([entry.json for entry in entries])
+
+    def _encode(self, message: BetaMessageParam) -> bytes:
+        self.encoded += 1
+        if self.materialize is not None:
+            message = self.materialize([message])[0]
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _fingerprint(message: BetaMessageParam) -> tuple[tuple[Any, ...], list[Any]]:
+    content = message["content"]
+    refs: list[Any] = [message, content]
+    fingerprint: list[Any] = [id(content)]
+    if isinstance(content, list):
+        for block in content:
+            if not isinstance(block, dict):
+                refs.append(block)
+                fingerprint.append(id(block))
+                continue
+            block_content = block.get("content")
+            refs += [block, block_content]
+            fingerprint.append((id(block), id(block_content), "cache_control" in block))
+    return tuple(fingerprint), refs
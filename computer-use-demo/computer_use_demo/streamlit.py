@@ -4,9 +4,12 @@ Entrypoint for streamlit, see https://docs.streamlit.io/
 
 import asyncio
 import base64
+import json
 import os
 import subprocess
+import threading
 import traceback
+import weakref
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta
@@ -25,11 +28,26 @@ from anthropic.types.beta import (
 )
 from streamlit.delta_generator import DeltaGenerator
 
+from computer_use_demo.cancellation import CancellationToken
+from computer_use_demo.clients import CLIENT_REGISTRY
+from computer_use_demo.images import (
+    DEFAULT_DEDUPE_THRESHOLD,
+    CacheAlignedEviction,
+    ImageStore,
+    redact_images,
+)
 from computer_use_demo.loop import (
     APIProvider,
     sampling_loop,
 )
-from computer_use_demo.tools import ToolResult, ToolVersion
+from computer_use_demo.metrics import SessionMetrics
+from computer_use_demo.tools import (
+    ImageFormat,
+    ScreenshotEncoding,
+    ToolResult,
+    ToolVersion,
+)
+from computer_use_demo.tracing import Tracer
 
 PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
     APIProvider.ANTHROPIC: "claude-sonnet-4-20250514",
@@ -75,6 +93,12 @@ MODEL_TO_MODEL_CONF: dict[str, ModelConfig] = {
 
 CONFIG_DIR = PosixPath("~/.anthropic").expanduser()
 API_KEY_FILE = CONFIG_DIR / "api_key"
+# every session gets a subdirectory, removed once its state is dropped (e.g. when the
+# session ends or is reset) or the server exits
+IMAGE_STORE_DIR = PosixPath("/tmp/outputs/images")
+IMAGE_STORE_MEMORY_BYTES = 64 * 1024 * 1024
+# set to write a Chrome trace (https://ui.perfetto.dev) of each session
+TRACE_DIR = os.getenv("TRACE_DIR")
 STREAMLIT_STYLE = """
 <style>
     /* Highlight the stop button in red */
@@ -126,14 +150,39 @@ def setup_state():
         st.session_state.responses = {}
     if "tools" not in st.session_state:
         st.session_state.tools = {}
+    if "image_store" not in st.session_state:
+        st.session_state.image_store = ImageStore.for_session(
+            IMAGE_STORE_DIR, max_memory_bytes=IMAGE_STORE_MEMORY_BYTES
+        )
+    if "image_eviction" not in st.session_state:
+        st.session_state.image_eviction = CacheAlignedEviction()
+    if "metrics" not in st.session_state:
+        st.session_state.metrics = SessionMetrics()
+    if "tracer" not in st.session_state:
+        st.session_state.tracer = (
+            Tracer(
+                PosixPath(TRACE_DIR)
+                / f"session-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+            )
+            if TRACE_DIR
+            else None
+        )
     if "only_n_most_recent_images" not in st.session_state:
         st.session_state.only_n_most_recent_images = 3
     if "custom_system_prompt" not in st.session_state:
         st.session_state.custom_system_prompt = load_from_storage("system_prompt") or ""
     if "hide_images" not in st.session_state:
         st.session_state.hide_images = False
+    if "screenshot_format" not in st.session_state:
+        st.session_state.screenshot_format = ImageFormat.PNG.value
+    if "screenshot_quality" not in st.session_state:
+        st.session_state.screenshot_quality = 80
+    if "screenshot_grayscale" not in st.session_state:
+        st.session_state.screenshot_grayscale = False
     if "token_efficient_tools_beta" not in st.session_state:
         st.session_state.token_efficient_tools_beta = False
+    if "stream" not in st.session_state:
+        st.session_state.stream = True
     if "in_sampling_loop" not in st.session_state:
         st.session_state.in_sampling_loop = False
 
@@ -217,9 +266,30 @@ async def main():
             ),
         )
         st.checkbox("Hide screenshots", key="hide_images")
+        st.radio(
+            "Screenshot format",
+            options=[option.value for option in ImageFormat],
+            key="screenshot_format",
+            format_func=lambda x: x.upper(),
+            horizontal=True,
+            help="JPEG and WebP screenshots are smaller and faster to upload than PNG",
+        )
+        st.number_input(
+            "Screenshot quality",
+            min_value=1,
+            max_value=100,
+            key="screenshot_quality",
+            disabled=st.session_state.screenshot_format == ImageFormat.PNG,
+        )
+        st.checkbox("Grayscale screenshots", key="screenshot_grayscale")
         st.checkbox(
             "Enable token-efficient tools beta", key="token_efficient_tools_beta"
         )
+        st.checkbox(
+            "Stream responses",
+            key="stream",
+            help="Show text as it is generated and start tools as soon as their input is complete",
+        )
         versions = get_args(ToolVersion)
         st.radio(
             "Tool Versions",
@@ -251,6 +321,12 @@ async def main():
                 await asyncio.sleep(1)
                 subprocess.run("./start_all.sh", shell=True)  # noqa: ASYNC221
 
+        metrics_container = st.empty()
+        _render_metrics(metrics_container, st.session_state.metrics)
+        st.session_state.metrics.on_turn = lambda _: _render_metrics(
+            metrics_container, st.session_state.metrics
+        )
+
     if not st.session_state.auth_validated:
         if auth_error := validate_auth(
             st.session_state.provider, st.session_state.api_key
@@ -317,7 +393,9 @@ async def main():
                 model=st.session_state.model,
                 provider=st.session_state.provider,
                 messages=st.session_state.messages,
-                output_callback=partial(_render_message, Sender.BOT),
+                output_callback=_StreamedOutput()
+                if st.session_state.stream
+                else partial(_render_message, Sender.BOT),
                 tool_output_callback=partial(
                     _tool_output_callback, tool_state=st.session_state.tools
                 ),
@@ -328,18 +406,33 @@ async def main():
                 ),
                 api_key=st.session_state.api_key,
                 only_n_most_recent_images=st.session_state.only_n_most_recent_images,
+                screenshot_encoding=ScreenshotEncoding(
+                    format=ImageFormat(st.session_state.screenshot_format),
+                    quality=st.session_state.screenshot_quality,
+                    grayscale=st.session_state.screenshot_grayscale,
+                ),
+                screenshot_dedupe_threshold=DEFAULT_DEDUPE_THRESHOLD,
                 tool_version=st.session_state.tool_versions,
                 max_tokens=st.session_state.output_tokens,
                 thinking_budget=st.session_state.thinking_budget
                 if st.session_state.thinking
                 else None,
                 token_efficient_tools_beta=st.session_state.token_efficient_tools_beta,
+                stream=st.session_state.stream,
+                image_store=st.session_state.image_store,
+                image_eviction=st.session_state.image_eviction,
+                metrics=st.session_state.metrics,
+                tracer=st.session_state.tracer,
+                cancellation=st.session_state.cancellation,
             )
 
 
 def maybe_add_interruption_blocks():
     if not st.session_state.in_sampling_loop:
         return []
+    # stop whatever the interrupted loop is still running
+    if (cancellation := st.session_state.get("cancellation")) is not None:
+        cancellation.cancel()
     # If this function is called while we're in the sampling loop, we can assume that the previous sampling loop was interrupted
     # and we should annotate the conversation with additional context for the model and heal any incomplete tool use calls
     result = []
@@ -363,6 +456,7 @@ def maybe_add_interruption_blocks():
 
 @contextmanager
 def track_sampling_loop():
+    st.session_state.cancellation = CancellationToken()
     st.session_state.in_sampling_loop = True
     yield
     st.session_state.in_sampling_loop = False
@@ -427,12 +521,71 @@ def _api_response_callback(
     Handle an API response by storing it to state and rendering it.
     """
     response_id = datetime.now().isoformat()
-    response_state[response_id] = (request, response)
+    response_state[response_id] = _redact_exchange(request, response)
     if error:
         _render_error(error)
     _render_api_response(request, response, response_id, tab)
 
 
+def _redact_exchange(
+    request: httpx.Request, response: httpx.Response | object | None
+) -> tuple[httpx.Request, httpx.Response | object | None]:
+    """
+    A copy of an API exchange to keep for the whole session: the screenshots in the
+    request body are replaced by their image keys, and a response no longer refers
+    to the original request.
+    """
+    content = request.read()
+    try:
+        content = json.dumps(redact_images(json.loads(content))).encode()
+    except ValueError:
+        pass
+    request = httpx.Request(
+        request.method, request.url, headers=request.headers, content=content
+    )
+    if isinstance(response, httpx.Response):
+        try:
+            body = response.content
+        except httpx.ResponseNotRead:
+            body = b""
+        response = httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            content=body,
+            request=request,
+        )
+    return request, response
+
+
+def _render_metrics(container: DeltaGenerator, metrics: SessionMetrics):
+    """Render session usage totals and the most recent turn to the sidebar."""
+    totals = metrics.totals()
+    with container.container():
+        st.markdown("**Usage**")
+        left, right = st.columns(2)
+        left.metric("Turns", int(totals["turns"]))
+        right.metric("Cache hit ratio", f"{totals['cache_hit_ratio']:.0%}")
+        left.metric("Input tokens", int(totals["input_tokens"]))
+        right.metric("Output tokens", int(totals["output_tokens"]))
+        left.metric("Cache reads", int(totals["cache_read_input_tokens"]))
+        right.metric("Cache writes", int(totals["cache_creation_input_tokens"]))
+        left.metric("API time", f"{totals['api_seconds']:.1f}s")
+        right.metric("Tool time", f"{totals['tool_seconds']:.1f}s")
+        if metrics.turns:
+            turn = metrics.turns[-1]
+            st.caption(
+                f"Last turn: {turn.api_seconds:.1f}s API, {turn.images} images "
+                f"({turn.image_bytes / 1024:.0f} KiB), "
+                + (
+                    ", ".join(
+                        f"{call.action or call.name} {call.seconds:.1f}s"
+                        for call in turn.tools
+                    )
+                    or "no tools"
+                )
+            )
+
+
 def _tool_output_callback(
     tool_output: ToolResult, tool_id: str, tool_state: dict[str, ToolResult]
 ):
@@ -504,8 +657,16 @@ def _render_message(
                     st.markdown(message.output)
             if message.error:
                 st.error(message.error)
-            if message.base64_image and not st.session_state.hide_images:
-                st.image(base64.b64decode(message.base64_image))
+            if not st.session_state.hide_images:
+                if message.base64_image:
+                    st.image(base64.b64decode(message.base64_image))
+                elif image_key := getattr(message, "image_key", None):
+                    try:
+                        base64_image = st.session_state.image_store.get(image_key)
+                    except KeyError:
+                        pass
+                    else:
+                        st.image(base64.b64decode(base64_image))
         elif isinstance(message, dict):
             if message["type"] == "text":
                 st.write(message["text"])
@@ -521,5 +682,65 @@ def _render_message(
             st.markdown(message)
 
 
+class _StreamedOutput:
+    """
+    Output callback for streamed turns: consecutive text or thinking deltas are
+    accumulated into one chat message instead of one message per delta.
+    """
+
+    def __init__(self):
+        self._type: str | None = None
+        self._text = ""
+        self._placeholder: DeltaGenerator | None = None
+
+    def __call__(self, block: BetaContentBlockParam):
+        if block["type"] not in ("text", "thinking"):
+            self._type = None
+            _render_message(Sender.BOT, block)
+            return
+        if block["type"] != self._type or self._placeholder is None:
+            self._type, self._text = block["type"], ""
+            with st.chat_message(Sender.BOT):
+                self._placeholder = st.empty()
+        if block["type"] == "text":
+            self._text += block["text"]
+            self._placeholder.markdown(self._text)
+        else:
+            self._text += cast(dict, block).get("thinking", "")
+            self._placeholder.markdown(f"[Thinking]\n\n{self._text}")
+
+
+class SessionLoop:
+    """
+    An event loop kept in a session's state across reruns.
+
+    `asyncio.run` would start a new loop on every rerun, and API clients, whose
+    connections are bound to the loop that opened them, could not be reused. Once
+    the session's state is dropped, the clients created on the loop are closed and
+    then the loop itself.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        weakref.finalize(self, _close_loop, self.loop)
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+
+def _close_loop(loop: asyncio.AbstractEventLoop):
+    def close():
+        try:
+            loop.run_until_complete(CLIENT_REGISTRY.aclose())
+        finally:
+            loop.close()
+
+    # finalizers run on whichever thread collects the session, which may be running
+    # a loop of its own
+    threading.Thread(target=close, name="close-session-loop", daemon=True).start()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "event_loop" not in st.session_state:
+        st.session_state.event_loop = SessionLoop()
+    st.session_state.event_loop.run(main())
@@ -1,19 +1,30 @@
-from .base import CLIResult, ToolResult
-from .bash import BashTool20241022, BashTool20250124
+from .base import CLIResult, ToolCancelled, ToolResult
+from .bash import BashSessionPool, BashTool20241022, BashTool20250124
 from .collection import ToolCollection
-from .computer import ComputerTool20241022, ComputerTool20250124
+from .computer import (
+    BaseComputerTool,
+    ComputerTool20241022,
+    ComputerTool20250124,
+    ImageFormat,
+    ScreenshotEncoding,
+)
 from .edit import EditTool20241022, EditTool20250124, EditTool20250429
 from .groups import TOOL_GROUPS_BY_VERSION, ToolVersion
 
 __ALL__ = [
+    BashSessionPool,
     BashTool20241022,
     BashTool20250124,
+    BaseComputerTool,
     CLIResult,
     ComputerTool20241022,
     ComputerTool20250124,
     EditTool20241022,
     EditTool20250124,
     EditTool20250429,
+    ImageFormat,
+    ScreenshotEncoding,
+    ToolCancelled,
     ToolCollection,
     ToolResult,
     ToolVersion,
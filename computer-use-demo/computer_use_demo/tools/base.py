@@ -1,3 +1,4 @@
+import base64
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass, fields, replace
 from typing import Any
@@ -19,6 +20,25 @@ class BaseAnthropicTool(metaclass=ABCMeta):
     ) -> BetaToolUnionParam:
         raise NotImplementedError
 
+    def resource_access(self, tool_input: dict[str, Any]) -> "ResourceAccess":
+        """
+        The resource a call with `tool_input` touches, and whether it only reads it.
+        By default nothing is known about a call's effects, so every call is a
+        barrier that runs alone, in order with all other calls.
+        """
+        return ResourceAccess(resource=self.to_params()["name"], barrier=True)
+
+
+@dataclass(kw_only=True, frozen=True)
+class ResourceAccess:
+    """Describes which resource a tool call uses, for scheduling concurrent calls."""
+
+    resource: str
+    read_only: bool = False
+    # the call may change anything, e.g. any file or the display: it waits for every
+    # earlier call and every later call waits for it, whatever their resources
+    barrier: bool = False
+
 
 @dataclass(kw_only=True, frozen=True)
 class ToolResult:
@@ -27,6 +47,8 @@ class ToolResult:
     output: str | None = None
     error: str | None = None
     base64_image: str | None = None
+    # reference to the image in an ImageStore, once base64_image has been moved there
+    image_key: str | None = None
     system: str | None = None
 
     def __bool__(self):
@@ -46,6 +68,7 @@ class ToolResult:
             output=combine_fields(self.output, other.output),
             error=combine_fields(self.error, other.error),
             base64_image=combine_fields(self.base64_image, other.base64_image, False),
+            image_key=combine_fields(self.image_key, other.image_key, False),
             system=combine_fields(self.system, other.system),
         )
 
@@ -53,6 +76,30 @@ class ToolResult:
         """Returns a new ToolResult with the given fields replaced."""
         return replace(self, **kwargs)
 
+    @property
+    def image_media_type(self) -> str | None:
+        """The media type of `base64_image`, detected from its leading bytes."""
+        return detect_media_type(self.base64_image) if self.base64_image else None
+
+    @property
+    def image_size(self) -> int:
+        """The encoded size of `base64_image` in bytes."""
+        if not self.base64_image:
+            return 0
+        return len(self.base64_image) * 3 // 4 - self.base64_image[-2:].count("=")
+
+
+def detect_media_type(base64_image: str) -> str:
+    """Detect the media type of a base64 encoded image from its leading bytes."""
+    header = base64.b64decode(base64_image[:16])
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/png"
+
 
 class CLIResult(ToolResult):
     """A ToolResult that can be rendered as a CLI output."""
@@ -62,6 +109,10 @@ class ToolFailure(ToolResult):
     """A ToolResult that represents a failure."""
 
 
+class ToolCancelled(ToolFailure):
+    """A ToolResult for a call that was cancelled before it completed."""
+
+
 class ToolError(Exception):
     """Raised when a tool encounters an error."""
 
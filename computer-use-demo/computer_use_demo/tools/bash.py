@@ -1,104 +1,631 @@
 import asyncio
+import codecs
+import fcntl
 import os
+import platform
+import re
+import shlex
+import signal
+import termios
+import time
+from collections.abc import AsyncIterator, Callable, Collection, Coroutine
+from contextlib import asynccontextmanager
 from typing import Any, Literal
 
-from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
+from .base import (
+    BaseAnthropicTool,
+    CLIResult,
+    ResourceAccess,
+    ToolError,
+    ToolResult,
+)
+from .run import OutputCapture, kill_process_group, run
+
+# receives the name of the stream ("stdout" or "stderr") and the text read from it
+OutputCallback = Callable[[str, str], None]
+
+DEFAULT_SESSION = "default"
+DEFAULT_MAX_SESSIONS = 8
+DEFAULT_IDLE_TIMEOUT = 300.0  # seconds
+
+# commands that only read files and the state of the system
+READ_ONLY_COMMANDS = frozenset(
+    {
+        "cat",
+        "cut",
+        "df",
+        "du",
+        "echo",
+        "grep",
+        "head",
+        "id",
+        "ls",
+        "nl",
+        "ps",
+        "pwd",
+        "stat",
+        "tail",
+        "tr",
+        "uname",
+        "wc",
+        "which",
+        "whoami",
+    }
+)
+# characters that can redirect output, run other commands or expand to anything
+_UNSAFE_CHARACTERS = frozenset(";&<>$`(){}\n\\!")
+
+# keeps programs run in a PTY from paging or coloring their output
+PTY_ENV = {"TERM": "dumb", "PAGER": "cat", "GIT_PAGER": "cat", "MANPAGER": "cat"}
+
+# CSI and OSC sequences, and the two character escapes
+_ANSI_ESCAPE = re.compile(
+    r"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])"
+)
+# the longest incomplete escape sequence held back for the next read
+_MAX_ESCAPE = 64
+# the number of the read system call, as shown in /proc/<pid>/syscall
+_READ_SYSCALL = {"x86_64": "0", "aarch64": "63"}.get(platform.machine())
+# the end of a line that asks for input
+_PROMPT = re.compile(
+    r"(?:password|passphrase|\[y/n\]|\(y/n\)|\(yes/no[^)]*\)|--more--|\(end\)|[:?>])\s*$",
+    re.IGNORECASE,
+)
 
 
 class _BashSession:
-    """A session of a bash shell."""
+    """
+    A session of a bash shell.
+
+    Output is captured with bounded memory: long outputs are clipped to their head
+    and tail, with the full output spilled to a file, and every chunk is passed to
+    `on_output` as it arrives.
+
+    The shell traps SIGINT, so a command that times out is interrupted by sending
+    SIGINT to the shell's process group, which stops the foreground job and keeps
+    the shell with its state. Background jobs ignore SIGINT and keep running.
+
+    With `pty`, the shell's stdin and stdout are a pseudo-terminal, so programs
+    line-buffer their output instead of holding it back until they exit. ANSI
+    escape sequences are stripped from the output, and a command whose output
+    stalls for `_prompt_delay` seconds on what looks like a prompt, while it reads
+    from the terminal, is interrupted rather than left waiting until it times out.
+    stderr stays a pipe, to keep it apart from stdout.
+    """
 
     _started: bool
     _process: asyncio.subprocess.Process
+    _stdin: asyncio.StreamWriter
+    _stdout: asyncio.StreamReader
+    _stderr: asyncio.StreamReader
 
     command: str = "/bin/bash"
-    _output_delay: float = 0.2  # seconds
+    _read_size: int = 64 * 1024  # bytes
     _timeout: float = 120.0  # seconds
+    _interrupt_grace: float = 5.0  # seconds
+    _prompt_delay: float = 2.0  # seconds
     _sentinel: str = "<<exit>>"
 
-    def __init__(self):
+    def __init__(
+        self,
+        env: dict[str, str] | None = None,
+        on_output: OutputCallback | None = None,
+        *,
+        pty: bool = False,
+    ):
         self._started = False
-        self._timed_out = False
+        # why the shell had to be killed, once it was
+        self._failure: str | None = None
+        self.cancelled = False
+        self.env = env
+        self.on_output = on_output
+        self.pty = pty
+        self._last_read = 0.0
+        # the latest output of each stream, to look for prompts in
+        self._recent: dict[str, str] = {}
 
     async def start(self):
         if self._started:
             return
 
-        self._process = await asyncio.create_subprocess_shell(
-            self.command,
-            preexec_fn=os.setsid,
-            shell=True,
-            bufsize=0,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        if self.pty:
+            await self._start_pty()
+        else:
+            self._process = await asyncio.create_subprocess_shell(
+                self.command,
+                preexec_fn=os.setsid,
+                shell=True,
+                bufsize=0,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env={**os.environ, **self.env} if self.env else None,
+            )
+            # we know these are not None because we created the process with PIPEs
+            assert self._process.stdin
+            assert self._process.stdout
+            self._stdin = self._process.stdin
+            self._stdout = self._process.stdout
+        assert self._process.stderr
+        self._stderr = self._process.stderr
+        # a trap, unlike an ignored signal, is reset to the default in commands
+        self._stdin.write(b"trap : INT\n")
 
         self._started = True
 
-    def stop(self):
-        """Terminate the bash shell."""
-        if not self._started:
-            raise ToolError("Session has not started.")
-        if self._process.returncode is not None:
+    async def _start_pty(self):
+        master, slave = os.openpty()
+        # commands are not echoed or edited as lines, and "\n" is not sent as "\r\n"
+        attrs = termios.tcgetattr(slave)
+        attrs[1] &= ~termios.ONLCR
+        attrs[3] &= ~(termios.ECHO | termios.ICANON)
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        try:
+            self._process = await asyncio.create_subprocess_shell(
+                self.command,
+                preexec_fn=_set_controlling_tty,
+                shell=True,
+                bufsize=0,
+                stdin=slave,
+                stdout=slave,
+                stderr=asyncio.subprocess.PIPE,
+                env={**os.environ, **PTY_ENV, **(self.env or {})},
+            )
+        finally:
+            os.close(slave)
+
+        loop = asyncio.get_running_loop()
+        self._stdout = asyncio.StreamReader()
+        reader = asyncio.StreamReaderProtocol(self._stdout)
+        await loop.connect_read_pipe(lambda: reader, os.fdopen(master, "rb", 0))
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+            os.fdopen(os.dup(master), "wb", 0),
+        )
+        self._stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def close(self):
+        """
+        End the bash shell and wait for it to exit, leaving background jobs running.
+        A shell that does not exit on end of input is killed.
+        """
+        if not self._started or self._process.returncode is not None:
             return
-        self._process.terminate()
+        if self.pty:
+            # a terminal in raw mode has no end of input
+            self._stdin.write(b"exit\n")
+        self._stdin.close()
+        try:
+            async with asyncio.timeout(self._interrupt_grace):
+                await self._process.wait()
+        except asyncio.TimeoutError:
+            await self.kill()
+
+    async def kill(self):
+        """Kill the shell and everything it started."""
+        if self._started:
+            await kill_process_group(self._process)
+            self._stdin.close()
 
-    async def run(self, command: str):
-        """Execute a command in the bash shell."""
+    def interrupt(self):
+        """Send SIGINT to the running command, leaving the shell alive."""
+        if self._started and self._process.returncode is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    async def run(self, command: str, timeout: float | None = None):
+        """
+        Execute a command in the bash shell, interrupting it after `timeout`
+        seconds (by default `_timeout`).
+
+        The model cannot pass `timeout`, as the bash tool's parameters are fixed by
+        the API; it is for callers that run the tool or the session directly.
+        """
         if not self._started:
             raise ToolError("Session has not started.")
+        if self._failure is not None:
+            raise ToolError(f"{self._failure} and must be restarted")
         if self._process.returncode is not None:
             return ToolResult(
                 system="tool must be restarted",
                 error=f"bash has exited with returncode {self._process.returncode}",
             )
-        if self._timed_out:
-            raise ToolError(
-                f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
-            )
 
-        # we know these are not None because we created the process with PIPEs
-        assert self._process.stdin
-        assert self._process.stdout
-        assert self._process.stderr
-
-        # send command to the process
-        self._process.stdin.write(
-            command.encode() + f"; echo '{self._sentinel}'\n".encode()
+        # send command to the process, marking the end of its output on both streams
+        # and passing on its exit status
+        self._stdin.write(
+            command.encode()
+            + f"; printf '{self._sentinel}%d\\n' $?; echo '{self._sentinel}' >&2\n".encode()
         )
-        await self._process.stdin.drain()
+        await self._stdin.drain()
 
         # read output from the process, until the sentinel is found
+        timeout = timeout if timeout is not None else self._timeout
+        stdout, stderr = self._capture("stdout"), self._capture("stderr")
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._last_read = loop.time()
+        self._recent = {"stdout": "", "stderr": ""}
+        reads = asyncio.gather(
+            self._read_until_sentinel(self._stdout, stdout, "stdout"),
+            self._read_until_sentinel(self._stderr, stderr, "stderr"),
+        )
+        interrupted = None
         try:
-            async with asyncio.timeout(self._timeout):
-                while True:
-                    await asyncio.sleep(self._output_delay)
-                    # if we read directly from stdout/stderr, it will wait forever for
-                    # EOF. use the StreamReader buffer directly instead.
-                    output = self._process.stdout._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
-                    if self._sentinel in output:
-                        # strip the sentinel and break
-                        output = output[: output.index(self._sentinel)]
-                        break
-        except asyncio.TimeoutError:
-            self._timed_out = True
-            raise ToolError(
-                f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
-            ) from None
+            while True:
+                remaining = deadline - loop.time()
+                if self.pty:
+                    # wake up when the output has stalled for long enough
+                    stalled = loop.time() - self._last_read
+                    if stalled < self._prompt_delay:
+                        remaining = min(remaining, self._prompt_delay - stalled)
+                    else:
+                        remaining = min(remaining, self._prompt_delay)
+                done, _ = await asyncio.wait([reads], timeout=max(remaining, 0))
+                if done:
+                    break
+                if loop.time() >= deadline:
+                    interrupted = f"command timed out after {timeout} seconds"
+                    failure = f"timed out: bash has not returned in {timeout} seconds"
+                elif prompt := self._waiting_prompt():
+                    interrupted = f"command was waiting for input at {prompt!r}"
+                    failure = f"bash is waiting for input at {prompt!r}"
+                else:
+                    continue
+                self.interrupt()
+                done, _ = await asyncio.wait([reads], timeout=self._interrupt_grace)
+                if not done:
+                    # the command ignores SIGINT, so the shell goes with it
+                    self._failure = failure
+                    await self._abort(reads)
+                    raise ToolError(f"{failure} and must be restarted")
+                break
+            status, _ = reads.result()
+        except asyncio.CancelledError:
+            # the command cannot be interrupted on its own, so the shell goes with it
+            self.cancelled = True
+            await self._abort(reads)
+            raise
+        except EOFError:
+            await self._process.wait()
+            return ToolResult(
+                system="tool must be restarted",
+                error=f"bash has exited with returncode {self._process.returncode}",
+            )
+        finally:
+            stdout.close()
+            stderr.close()
+        seconds = time.perf_counter() - started
 
+        output, error = stdout.getvalue(), stderr.getvalue()
         if output.endswith("\n"):
             output = output[:-1]
-
-        error = self._process.stderr._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
         if error.endswith("\n"):
             error = error[:-1]
 
-        # clear the buffers so that the next output can be read correctly
-        self._process.stdout._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
-        self._process.stderr._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
+        system = _exit_message(status, seconds)
+        if interrupted:
+            system = f"{interrupted} and was interrupted ({system})"
+        return CLIResult(output=output, error=error, system=system)
+
+    async def _abort(self, reads: "asyncio.Future"):
+        await self.kill()
+        reads.cancel()
+        try:
+            await reads
+        except (asyncio.CancelledError, EOFError):
+            pass
+
+    def _capture(self, name: str) -> OutputCapture:
+        on_output = self.on_output
+        return OutputCapture(
+            f"bash_{name}",
+            on_chunk=(lambda text: on_output(name, text)) if on_output else None,
+        )
+
+    def _waiting_prompt(self) -> str | None:
+        """The prompt the command is waiting at, if its output stalled on one."""
+        if asyncio.get_running_loop().time() - self._last_read < self._prompt_delay:
+            return None
+        for recent in self._recent.values():
+            line = _strip_ansi(recent.rsplit("\n", 1)[-1]).strip()
+            if line and _PROMPT.search(line) and self._reading_terminal():
+                return line
+        return None
+
+    def _reading_terminal(self) -> bool:
+        """
+        Whether a process of the session is blocked reading from the terminal. On
+        platforms where this cannot be told, any process may be.
+        """
+        if _READ_SYSCALL is None:
+            return True
+        for pid in os.listdir("/proc"):
+            try:
+                if not pid.isdigit() or os.getsid(int(pid)) != self._process.pid:
+                    continue
+                with open(f"/proc/{pid}/syscall") as f:
+                    syscall = f.read().split()
+                if syscall[:1] == [_READ_SYSCALL] and os.readlink(
+                    f"/proc/{pid}/fd/{int(syscall[1], 16)}"
+                ).startswith("/dev/pts/"):
+                    return True
+            except (OSError, IndexError, ValueError):
+                # the process has exited, or is not ours to inspect
+                continue
+        return False
+
+    async def _read(self, stream: asyncio.StreamReader) -> bytes:
+        try:
+            data = await stream.read(self._read_size)
+        except OSError:
+            # reading a PTY fails once its other end is closed
+            return b""
+        self._last_read = asyncio.get_running_loop().time()
+        return data
+
+    async def _read_until_sentinel(
+        self, stream: asyncio.StreamReader, capture: OutputCapture, name: str
+    ) -> int:
+        """
+        Read and decode `stream` as it arrives into `capture`, until the sentinel,
+        returning the exit status that follows it on the same line (0 if none).
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # the end of the previous read, in case the sentinel straddles two reads
+        carry = ""
+        while True:
+            if not (data := await self._read(stream)):
+                raise EOFError
+            text = decoder.decode(data)
+            self._recent[name] = (self._recent[name] + text)[-256:]
+            window = carry + text
+            if self.pty:
+                window = _strip_ansi(window)
+            if (index := window.find(self._sentinel)) != -1:
+                capture.write(window[:index])
+                rest = window[index + len(self._sentinel) :]
+                while "\n" not in rest:
+                    if not (data := await self._read(stream)):
+                        raise EOFError
+                    rest += decoder.decode(data)
+                status = rest.split("\n", 1)[0]
+                return int(status) if status.isdigit() else 0
+            split = len(window) - self._sentinel_prefix(window)
+            if self.pty:
+                # hold back an escape sequence that may end in the next read
+                escape = window.rfind("\x1b", max(split - _MAX_ESCAPE, 0))
+                if escape != -1:
+                    split = min(split, escape)
+            capture.write(window[:split])
+            carry = window[split:]
+
+    def _sentinel_prefix(self, text: str) -> int:
+        """The length of the longest end of `text` that starts the sentinel."""
+        for length in range(min(len(self._sentinel) - 1, len(text)), 0, -1):
+            if self._sentinel.startswith(text[-length:]):
+                return length
+        return 0
+
 
-        return CLIResult(output=output, error=error)
+def _set_controlling_tty():
+    """Start a new session, with the PTY on stdin as its controlling terminal."""
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+def _exit_message(status: int, seconds: float) -> str:
+    return f"exit status {status} after {seconds:.2f}s"
+
+
+def _strip_ansi(text: str) -> str:
+    return _ANSI_ESCAPE.sub("", text)
+
+
+class BashSessionPool:
+    """
+    Named bash sessions, backed by shells that are started ahead of time.
+
+    `use` leases the session with a given name, taking a warm shell for a new one;
+    a shell runs one command at a time, so concurrent leases of the same name wait
+    their turn. `restart` swaps a session for a warm shell, so neither waits for
+    bash and the user's profile to start. After a shell is taken, up to `warm` spare shells
+    are started in the background.
+
+    The bash tool only uses the default session, since its parameters are fixed
+    by the API and the model cannot name one; other sessions are for callers that
+    drive the pool directly, e.g. to run a server next to the model's shell.
+
+    At most `max_sessions` shells, spare, starting or not, are alive at once: at
+    the limit, the least recently used idle named session is stopped to make room.
+    Named sessions are also stopped once idle for `idle_timeout` seconds. The
+    default session is never stopped by the pool.
+    """
+
+    def __init__(
+        self,
+        *,
+        env: dict[str, str] | None = None,
+        on_output: OutputCallback | None = None,
+        pty: bool = False,
+        warm: int = 1,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+    ):
+        self.env = env
+        self.on_output = on_output
+        self.pty = pty
+        self.warm = warm
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: dict[str, _BashSession] = {}
+        # loop time each idle session was last released, least recently used first
+        self._idle_since: dict[str, float] = {}
+        self._spares: list[_BashSession] = []
+        self._starting = 0
+        # held while a session is leased, restarted or being started
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._tasks: set[asyncio.Future] = set()
+        # a single timer, set for when the next idle named session expires
+        self._reaper: asyncio.TimerHandle | None = None
+
+    @property
+    def size(self) -> int:
+        """The number of shells that are alive or starting."""
+        return len(self._sessions) + len(self._spares) + self._starting
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._sessions)
+
+    async def cwd(self, name: str = DEFAULT_SESSION) -> str | None:
+        """
+        The working directory of the session called `name`, or None when its shell
+        cannot tell. A session that has not started yet starts in ours.
+        """
+        if name not in self._sessions:
+            return os.getcwd()
+        try:
+            async with self.use(name) as session:
+                result = await session.run("pwd")
+        except ToolError:
+            return None
+        return None if result.error else result.output
+
+    @asynccontextmanager
+    async def use(self, name: str = DEFAULT_SESSION) -> AsyncIterator[_BashSession]:
+        """Lease the session called `name`, starting it if needed."""
+        async with self._lock(name):
+            session = self._sessions.get(name)
+            if session is None or session.cancelled:
+                if session is not None:
+                    # a cancelled command took its shell down with it
+                    self._stop(name)
+                session = await self._take(name)
+            self._idle_since.pop(name, None)
+            try:
+                yield session
+            finally:
+                if self._sessions.get(name) is session:
+                    self._release(name)
+
+    async def restart(self, name: str = DEFAULT_SESSION):
+        """Replace the session called `name` with a fresh shell."""
+        async with self._lock(name):
+            if name in self._sessions:
+                self._stop(name)
+            await self._take(name)
+            self._release(name)
+
+    async def prewarm(self):
+        """Start the spare shells now, rather than after the first one is taken."""
+        self._refill()
+        await asyncio.gather(*self._tasks)
+
+    def reap(self):
+        """Stop named sessions that have been idle for `idle_timeout`."""
+        now = asyncio.get_running_loop().time()
+        for name, since in list(self._idle_since.items()):
+            if name != DEFAULT_SESSION and now - since >= self.idle_timeout:
+                self._stop(name)
+        self._schedule_reap()
+
+    async def aclose(self):
+        """Kill every shell, spare or not, with the commands they started."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        # spares that are starting are killed with the rest once they have started
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        sessions = [*self._sessions.values(), *self._spares]
+        self._sessions.clear()
+        self._idle_since.clear()
+        self._spares.clear()
+        for session in sessions:
+            await session.kill()
+
+    async def _take(self, name: str) -> _BashSession:
+        if self._spares:
+            session = self._spares.pop()
+        else:
+            self._make_room(name)
+            session = self._new_session()
+            await session.start()
+        self._sessions[name] = session
+        self._refill()
+        return session
+
+    def _make_room(self, name: str):
+        if self.size < self.max_sessions:
+            return
+        # the least recently used idle session, other than the default one
+        idle = next((n for n in self._idle_since if n != DEFAULT_SESSION), None)
+        if idle is None:
+            raise ToolError(
+                f"cannot start bash session {name!r}: all {self.max_sessions} "
+                "shells are in use"
+            )
+        self._stop(idle)
+
+    def _release(self, name: str):
+        self._idle_since[name] = asyncio.get_running_loop().time()
+        if name != DEFAULT_SESSION and self._reaper is None:
+            self._schedule_reap()
+
+    def _schedule_reap(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        # sessions are idle since in order, so the first named one expires first
+        since = next(
+            (t for n, t in self._idle_since.items() if n != DEFAULT_SESSION), None
+        )
+        if since is not None:
+            self._reaper = asyncio.get_running_loop().call_at(
+                since + self.idle_timeout, self.reap
+            )
+
+    def _lock(self, name: str) -> asyncio.Lock:
+        return self._locks.setdefault(name, asyncio.Lock())
+
+    def _stop(self, name: str):
+        self._idle_since.pop(name, None)
+        # a held lock still guards the name, e.g. for a lease restarting it
+        if (lock := self._locks.get(name)) is not None and not lock.locked():
+            del self._locks[name]
+        self._spawn(self._sessions.pop(name).close())
+
+    def _new_session(self) -> _BashSession:
+        return _BashSession(self.env, self.on_output, pty=self.pty)
+
+    def _refill(self):
+        while (
+            len(self._spares) + self._starting < self.warm
+            and self.size < self.max_sessions
+        ):
+            self._starting += 1
+            self._spawn(self._start_spare())
+
+    def _spawn(self, coroutine: Coroutine[Any, Any, None]):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _start_spare(self):
+        session = self._new_session()
+        try:
+            await session.start()
+            # wait for the profile to be read, so that the first command is quick
+            await session.run("true")
+        except BaseException:
+            await session.kill()
+            raise
+        finally:
+            self._starting -= 1
+        self._spares.append(session)
 
 
 class BashTool20250124(BaseAnthropicTool):
@@ -107,13 +634,35 @@ class BashTool20250124(BaseAnthropicTool):
     The tool parameters are defined by Anthropic and are not editable.
     """
 
-    _session: _BashSession | None
-
     api_type: Literal["bash_20250124"] = "bash_20250124"
     name: Literal["bash"] = "bash"
 
-    def __init__(self):
-        self._session = None
+    def __init__(
+        self,
+        *,
+        env: dict[str, str] | None = None,
+        on_output: OutputCallback | None = None,
+        pty: bool = False,
+        pool: BashSessionPool | None = None,
+        read_only_commands: Collection[str] = READ_ONLY_COMMANDS,
+    ):
+        """
+        `env` is added to the environment of the shell, e.g. to set DISPLAY.
+        `on_output` receives the output of commands as it arrives. With `pty`,
+        commands run in a pseudo-terminal. These are ignored when a `pool` of
+        sessions is given.
+
+        A pipeline of `read_only_commands`, with no redirections, substitutions or
+        command lists, runs in a process of its own in the shell's working
+        directory, concurrently with other calls that only read. Pass an empty set
+        to run every command in the shell.
+        """
+        self.pool = (
+            pool
+            if pool is not None
+            else BashSessionPool(env=env, on_output=on_output, pty=pty)
+        )
+        self.read_only_commands = frozenset(read_only_commands)
         super().__init__()
 
     def to_params(self) -> Any:
@@ -122,26 +671,70 @@ class BashTool20250124(BaseAnthropicTool):
             "name": self.name,
         }
 
+    def resource_access(self, tool_input: dict[str, Any]) -> ResourceAccess:
+        resource = f"bash:{DEFAULT_SESSION}"
+        if not tool_input.get("restart") and self.is_read_only(
+            tool_input.get("command")
+        ):
+            return ResourceAccess(resource=resource, read_only=True)
+        # any other command can change any file or start any program, so it is a
+        # barrier ordered against all other calls
+        return ResourceAccess(resource=resource, barrier=True)
+
+    def is_read_only(self, command: str | None) -> bool:
+        """Whether `command` is a pipeline of read-only commands and nothing more."""
+        if not command or _UNSAFE_CHARACTERS.intersection(command):
+            return False
+        for segment in command.split("|"):
+            try:
+                words = shlex.split(segment)
+            except ValueError:
+                return False
+            if not words or words[0] not in self.read_only_commands:
+                return False
+        return True
+
     async def __call__(
-        self, command: str | None = None, restart: bool = False, **kwargs
+        self,
+        command: str | None = None,
+        restart: bool = False,
+        timeout: float | None = None,
+        **kwargs,
     ):
-        if restart:
-            if self._session:
-                self._session.stop()
-            self._session = _BashSession()
-            await self._session.start()
+        """
+        Run `command` in the default session of the pool, which is started on
+        first use and kept between calls.
 
+        `timeout` is not part of the tool's parameters, which are fixed by the API,
+        so only callers that run the tool directly can set it.
+        """
+        if restart:
+            await self.pool.restart()
             return ToolResult(system="tool has been restarted.")
 
-        if self._session is None:
-            self._session = _BashSession()
-            await self._session.start()
-
         if command is not None:
-            return await self._session.run(command)
+            if self.is_read_only(command) and (cwd := await self.pool.cwd()):
+                return await self._run_read_only(command, cwd, timeout)
+            async with self.pool.use() as bash:
+                return await bash.run(command, timeout)
 
         raise ToolError("no command provided.")
 
+    async def _run_read_only(self, command: str, cwd: str, timeout: float | None):
+        started = time.perf_counter()
+        try:
+            status, output, error = await run(
+                f"exec < /dev/null; cd {shlex.quote(cwd)} && {command}",
+                timeout=timeout if timeout is not None else _BashSession._timeout,
+            )
+        except TimeoutError as exc:
+            raise ToolError(str(exc)) from exc
+        return CLIResult(
+            output=output.removesuffix("\n"),
+            error=error.removesuffix("\n"),
+            system=_exit_message(status, time.perf_counter() - started),
+        )
+
 
 class BashTool20241022(BashTool20250124):
     api_type: Literal["bash_20250124"] = "bash_20250124"  # pyright: ignore[reportIncompatibleVariableOverride]
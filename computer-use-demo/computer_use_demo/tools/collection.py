@@ -1,34 +1,183 @@
 """Collection classes for managing multiple tools."""
 
+import asyncio
+from collections.abc import Sequence
+from contextlib import asynccontextmanager
 from typing import Any
 
 from anthropic.types.beta import BetaToolUnionParam
 
+from ..cancellation import CANCELLED_ERROR, CancellationToken, Cancelled, guard
+from ..tracing import span
 from .base import (
     BaseAnthropicTool,
+    ResourceAccess,
+    ToolCancelled,
     ToolError,
     ToolFailure,
     ToolResult,
 )
 
 
+class _ResourceSchedule:
+    """Completion futures of the calls currently queued on a single resource."""
+
+    def __init__(self):
+        self.last_write: asyncio.Future[None] | None = None
+        self.reads: list[asyncio.Future[None]] = []
+
+
 class ToolCollection:
-    """A collection of anthropic-defined tools."""
+    """
+    A collection of anthropic-defined tools.
+
+    Calls may be started concurrently. Each call declares the resource it uses
+    (display, bash session, file path); read-only calls on a resource run together,
+    while a mutating call waits for every earlier call on that resource and blocks
+    every later one. Calls on different resources do not wait for each other, except
+    for barriers: calls whose effects cannot be scoped to a resource, such as bash
+    commands, wait for every earlier call and block every later one.
+    """
 
     def __init__(self, *tools: BaseAnthropicTool):
         self.tools = tools
         self.tool_map = {tool.to_params()["name"]: tool for tool in tools}
+        self._schedules: dict[str, _ResourceSchedule] = {}
+        # the latest barrier, and every call that has not finished yet
+        self._barrier: asyncio.Future[None] | None = None
+        self._unfinished: set[asyncio.Future[None]] = set()
 
     def to_params(
         self,
     ) -> list[BetaToolUnionParam]:
         return [tool.to_params() for tool in self.tools]
 
-    async def run(self, *, name: str, tool_input: dict[str, Any]) -> ToolResult:
+    async def run(
+        self,
+        *,
+        name: str,
+        tool_input: dict[str, Any],
+        cancellation: CancellationToken | None = None,
+    ) -> ToolResult:
         tool = self.tool_map.get(name)
         if not tool:
             return ToolFailure(error=f"Tool {name} is invalid")
+
+        async def call() -> ToolResult:
+            async with self._scheduled(tool.resource_access(tool_input)):
+                return await tool(**tool_input)
+
         try:
-            return await tool(**tool_input)
+            with span(
+                f"tool {name}",
+                "tools",
+                action=tool_input.get("action") or tool_input.get("command"),
+            ):
+                return await guard(cancellation, call())
         except ToolError as e:
             return ToolFailure(error=e.message)
+        except Cancelled:
+            return ToolCancelled(error=CANCELLED_ERROR)
+
+    def run_many(
+        self,
+        calls: Sequence[tuple[str, dict[str, Any]]],
+        cancellation: CancellationToken | None = None,
+    ) -> list["asyncio.Future[ToolResult]"]:
+        """
+        Start (name, tool_input) calls in order and return a future for each result.
+        Consecutive calls that their tool can fuse, such as computer mouse and
+        keyboard actions, are executed together as a single scheduled call.
+        """
+        futures: list[asyncio.Future[ToolResult]] = []
+        start = 0
+        while start < len(calls):
+            name, tool_input = calls[start]
+            tool = self.tool_map.get(name)
+            can_fuse = getattr(tool, "can_fuse", None)
+            end = start + 1
+            if can_fuse is not None and can_fuse(tool_input):
+                while (
+                    end < len(calls)
+                    and calls[end][0] == name
+                    and can_fuse(calls[end][1])
+                ):
+                    end += 1
+            if end - start > 1:
+                fused = asyncio.create_task(
+                    self._run_fused(
+                        tool, [call[1] for call in calls[start:end]], cancellation
+                    )
+                )
+                futures.extend(
+                    asyncio.create_task(_nth_result(fused, index))
+                    for index in range(end - start)
+                )
+            else:
+                futures.append(
+                    asyncio.create_task(
+                        self.run(
+                            name=name, tool_input=tool_input, cancellation=cancellation
+                        )
+                    )
+                )
+            start = end
+        return futures
+
+    async def _run_fused(
+        self,
+        tool: Any,
+        tool_inputs: list[dict[str, Any]],
+        cancellation: CancellationToken | None = None,
+    ) -> list[ToolResult]:
+        async def call() -> list[ToolResult]:
+            async with self._scheduled(tool.resource_access(tool_inputs[0])):
+                return await tool.run_fused(tool_inputs)
+
+        try:
+            with span(f"tool {tool.name}", "tools", fused=len(tool_inputs)):
+                return await guard(cancellation, call())
+        except ToolError as e:
+            return [ToolFailure(error=e.message) for _ in tool_inputs]
+        except Cancelled:
+            return [ToolCancelled(error=CANCELLED_ERROR) for _ in tool_inputs]
+
+    @asynccontextmanager
+    async def _scheduled(self, access: ResourceAccess):
+        # queue before the first await so calls are ordered by when they started
+        dependencies, done = self._schedule(access)
+        try:
+            if dependencies:
+                await asyncio.wait(dependencies)
+            yield
+        finally:
+            done.set_result(None)
+
+    def _schedule(
+        self, access: ResourceAccess
+    ) -> tuple[list[asyncio.Future[None]], asyncio.Future[None]]:
+        """Queue a call on its resource, returning what it must wait for."""
+        done = asyncio.get_running_loop().create_future()
+        unfinished = list(self._unfinished)
+        self._unfinished.add(done)
+        done.add_done_callback(self._unfinished.discard)
+        if access.barrier:
+            self._barrier = done
+            return [future for future in unfinished if not future.done()], done
+
+        schedule = self._schedules.setdefault(access.resource, _ResourceSchedule())
+        dependencies = [] if schedule.last_write is None else [schedule.last_write]
+        if self._barrier is not None:
+            dependencies.append(self._barrier)
+        if access.read_only:
+            schedule.reads = [read for read in schedule.reads if not read.done()]
+            schedule.reads.append(done)
+        else:
+            dependencies.extend(schedule.reads)
+            schedule.last_write = done
+            schedule.reads = []
+        return [future for future in dependencies if not future.done()], done
+
+
+async def _nth_result(task: "asyncio.Task[list[ToolResult]]", index: int) -> ToolResult:
+    return (await task)[index]
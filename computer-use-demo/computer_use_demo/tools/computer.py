@@ -1,22 +1,39 @@
 import asyncio
 import base64
+import hashlib
+import io
 import os
 import shlex
 import shutil
+import time
+from dataclasses import dataclass
 from enum import StrEnum
 from pathlib import Path
-from typing import Literal, TypedDict, cast, get_args
+from typing import Any, Literal, TypedDict, cast, get_args
 from uuid import uuid4
 
 from anthropic.types.beta import BetaToolComputerUse20241022Param, BetaToolUnionParam
 
-from .base import BaseAnthropicTool, ToolError, ToolResult
-from .run import run
-
-OUTPUT_DIR = "/tmp/outputs"
+try:
+    from PIL import Image, ImageGrab
+except ImportError:
+    # without Pillow, screenshots fall back to gnome-screenshot/scrot + convert
+    Image = ImageGrab = None
+
+from ..tracing import span
+from .base import (
+    BaseAnthropicTool,
+    ResourceAccess,
+    ToolError,
+    ToolFailure,
+    ToolResult,
+)
+from .run import OUTPUT_DIR, run
 
 TYPING_DELAY_MS = 12
 TYPING_GROUP_SIZE = 50
+# printed by run_fused after each action that succeeded
+FUSED_ACTION_DONE = "<<fused action done>>"
 
 Action_20241022 = Literal[
     "key",
@@ -43,6 +60,9 @@ Action_20250124 = (
     ]
 )
 
+# actions that observe the screen without changing it
+READ_ONLY_ACTIONS = frozenset({"screenshot", "cursor_position", "wait"})
+
 ScrollDirection = Literal["up", "down", "left", "right"]
 
 
@@ -73,6 +93,49 @@ class ScalingSource(StrEnum):
     API = "api"
 
 
+# (left, top, right, bottom) in API coordinates
+Region = tuple[int, int, int, int]
+
+
+class ImageFormat(StrEnum):
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+
+
+@dataclass(frozen=True, kw_only=True)
+class ScreenshotEncoding:
+    """How screenshots are encoded before they are sent to the model."""
+
+    format: ImageFormat = ImageFormat.PNG
+    # 0 (fastest, largest) to 9 (slowest, smallest)
+    png_compress_level: int = 6
+    # quantize to a palette of this many colors, PNG only
+    colors: int | None = None
+    grayscale: bool = False
+    # JPEG/WebP quality, 1-100
+    quality: int = 80
+
+
+DEFAULT_SCREENSHOT_ENCODING = ScreenshotEncoding()
+
+
+def encode_image(image: "Image.Image", encoding: ScreenshotEncoding) -> bytes:
+    """Encode a PIL image according to `encoding`."""
+    if encoding.grayscale:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if encoding.format == ImageFormat.PNG:
+        if encoding.colors:
+            image = image.quantize(colors=encoding.colors)
+        image.save(buffer, format="PNG", compress_level=encoding.png_compress_level)
+    else:
+        image.save(buffer, format=encoding.format.upper(), quality=encoding.quality)
+    return buffer.getvalue()
+
+
 class ComputerToolOptions(TypedDict):
     display_height_px: int
     display_width_px: int
@@ -94,8 +157,17 @@ class BaseComputerTool:
     height: int
     display_num: int | None
 
+    # upper bound on how long to wait for the screen to settle after an action
     _screenshot_delay = 2.0
+    # the screen counts as settled once it has not changed for this long
+    _settle_window = 0.5
+    _settle_interval = 0.05
     _scaling_enabled = True
+    _in_process_capture = ImageGrab is not None
+    # after in-process capture fails, screenshots go through a subprocess for this
+    # long before it is tried again
+    _in_process_retry_after = 30.0  # seconds
+    _in_process_failed_at: float | None = None
 
     @property
     def options(self) -> ComputerToolOptions:
@@ -108,14 +180,34 @@ class BaseComputerTool:
             "display_number": self.display_num,
         }
 
-    def __init__(self):
+    def __init__(
+        self,
+        *,
+        screenshot_encoding: ScreenshotEncoding | None = None,
+        display_num: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+        change_region: Region | None = None,
+    ):
+        """
+        The display and its size default to the DISPLAY_NUM, WIDTH and HEIGHT
+        environment variables.
+
+        With a `change_region` (in API coordinates), the screenshot after an action
+        is taken as soon as that region changes rather than once the whole screen
+        has settled, e.g. when only one application's window matters.
+        """
         super().__init__()
 
-        self.width = int(os.getenv("WIDTH") or 0)
-        self.height = int(os.getenv("HEIGHT") or 0)
+        self.screenshot_encoding = screenshot_encoding or DEFAULT_SCREENSHOT_ENCODING
+        self.change_region = change_region
+        self.width = width or int(os.getenv("WIDTH") or 0)
+        self.height = height or int(os.getenv("HEIGHT") or 0)
         assert self.width and self.height, "WIDTH, HEIGHT must be set"
-        if (display_num := os.getenv("DISPLAY_NUM")) is not None:
-            self.display_num = int(display_num)
+        if display_num is None and (env_display_num := os.getenv("DISPLAY_NUM")):
+            display_num = int(env_display_num)
+        if display_num is not None:
+            self.display_num = display_num
             self._display_prefix = f"DISPLAY=:{self.display_num} "
         else:
             self.display_num = None
@@ -131,44 +223,17 @@ class BaseComputerTool:
         coordinate: tuple[int, int] | None = None,
         **kwargs,
     ):
-        if action in ("mouse_move", "left_click_drag"):
-            if coordinate is None:
-                raise ToolError(f"coordinate is required for {action}")
-            if text is not None:
-                raise ToolError(f"text is not accepted for {action}")
-
-            x, y = self.validate_and_get_coordinates(coordinate)
-
-            if action == "mouse_move":
-                command_parts = [self.xdotool, f"mousemove --sync {x} {y}"]
-                return await self.shell(" ".join(command_parts))
-            elif action == "left_click_drag":
-                command_parts = [
-                    self.xdotool,
-                    f"mousedown 1 mousemove --sync {x} {y} mouseup 1",
-                ]
-                return await self.shell(" ".join(command_parts))
-
-        if action in ("key", "type"):
-            if text is None:
-                raise ToolError(f"text is required for {action}")
-            if coordinate is not None:
-                raise ToolError(f"coordinate is not accepted for {action}")
-            if not isinstance(text, str):
-                raise ToolError(output=f"{text} must be a string")
-
-            if action == "key":
-                command_parts = [self.xdotool, f"key -- {text}"]
-                return await self.shell(" ".join(command_parts))
-            elif action == "type":
+        commands = self.xdotool_commands(
+            action=action, text=text, coordinate=coordinate, **kwargs
+        )
+        if commands is not None:
+            if action == "type":
                 results: list[ToolResult] = []
-                for chunk in chunks(text, TYPING_GROUP_SIZE):
-                    command_parts = [
-                        self.xdotool,
-                        f"type --delay {TYPING_DELAY_MS} -- {shlex.quote(chunk)}",
-                    ]
+                for command in commands:
                     results.append(
-                        await self.shell(" ".join(command_parts), take_screenshot=False)
+                        await self.shell(
+                            f"{self.xdotool} {command}", take_screenshot=False
+                        )
                     )
                 screenshot_base64 = (await self.screenshot()).base64_image
                 return ToolResult(
@@ -176,15 +241,12 @@ class BaseComputerTool:
                     error="".join(result.error or "" for result in results),
                     base64_image=screenshot_base64,
                 )
+            return await self.shell(
+                f"{self.xdotool} {' '.join(commands)}",
+                wait_for_change=self.change_region,
+            )
 
-        if action in (
-            "left_click",
-            "right_click",
-            "double_click",
-            "middle_click",
-            "screenshot",
-            "cursor_position",
-        ):
+        if action in ("screenshot", "cursor_position"):
             if text is not None:
                 raise ToolError(f"text is not accepted for {action}")
             if coordinate is not None:
@@ -205,12 +267,113 @@ class BaseComputerTool:
                     int(output.split("Y=")[1].split("\n")[0]),
                 )
                 return result.replace(output=f"X={x},Y={y}")
-            else:
-                command_parts = [self.xdotool, f"click {CLICK_BUTTONS[action]}"]
-                return await self.shell(" ".join(command_parts))
 
         raise ToolError(f"Invalid action: {action}")
 
+    def xdotool_commands(
+        self,
+        *,
+        action: Action_20241022,
+        text: str | None = None,
+        coordinate: tuple[int, int] | None = None,
+        **kwargs,
+    ) -> list[str] | None:
+        """
+        Validate an action that only drives the mouse and keyboard and return its
+        xdotool commands, or None for actions that do anything else.
+        """
+        if action in ("mouse_move", "left_click_drag"):
+            if coordinate is None:
+                raise ToolError(f"coordinate is required for {action}")
+            if text is not None:
+                raise ToolError(f"text is not accepted for {action}")
+
+            x, y = self.validate_and_get_coordinates(coordinate)
+
+            if action == "mouse_move":
+                return [f"mousemove --sync {x} {y}"]
+            return [f"mousedown 1 mousemove --sync {x} {y} mouseup 1"]
+
+        if action in ("key", "type"):
+            if text is None:
+                raise ToolError(f"text is required for {action}")
+            if coordinate is not None:
+                raise ToolError(f"coordinate is not accepted for {action}")
+            if not isinstance(text, str):
+                raise ToolError(output=f"{text} must be a string")
+
+            if action == "key":
+                return [f"key -- {text}"]
+            return [
+                f"type --delay {TYPING_DELAY_MS} -- {shlex.quote(chunk)}"
+                for chunk in chunks(text, TYPING_GROUP_SIZE)
+            ]
+
+        if action in ("left_click", "right_click", "double_click", "middle_click"):
+            if text is not None:
+                raise ToolError(f"text is not accepted for {action}")
+            if coordinate is not None:
+                raise ToolError(f"coordinate is not accepted for {action}")
+            return [f"click {CLICK_BUTTONS[action]}"]
+
+        return None
+
+    def can_fuse(self, tool_input: dict[str, Any]) -> bool:
+        """Whether a call can be fused with neighbouring calls by `run_fused`."""
+        try:
+            return self.xdotool_commands(**tool_input) is not None
+        except (ToolError, TypeError):
+            return False
+
+    async def run_fused(self, tool_inputs: list[dict[str, Any]]) -> list[ToolResult]:
+        """
+        Run consecutive input-only actions as a single shell command that stops at
+        the first failing xdotool invocation. Only the last action waits for the
+        screen to settle and takes a screenshot; the others get a short
+        acknowledgement. If an action fails, it gets the error and the actions after
+        it are reported as not run.
+        """
+        steps = [
+            " && ".join(
+                f"{self.xdotool} {command}"
+                for command in self.xdotool_commands(**tool_input) or []
+            )
+            + f" && echo {shlex.quote(FUSED_ACTION_DONE)}"
+            for tool_input in tool_inputs
+        ]
+        result = await self.shell(
+            " && ".join(steps), wait_for_change=self.change_region
+        )
+        *outputs, rest = (result.output or "").split(f"{FUSED_ACTION_DONE}\n")
+        actions = [tool_input["action"] for tool_input in tool_inputs]
+        results: list[ToolResult] = [
+            ToolResult(
+                output=output
+                or f"{action} done, see the last action of this sequence for the "
+                "resulting screenshot"
+            )
+            for action, output in zip(actions, outputs, strict=False)
+        ]
+        if len(outputs) == len(actions):
+            results[-1] = result.replace(output=outputs[-1] or None)
+            return results
+        failed = actions[len(outputs)]
+        results.append(
+            ToolFailure(output=rest or None, error=result.error or f"{failed} failed")
+        )
+        results.extend(
+            ToolFailure(error=f"{action} was not run because {failed} failed")
+            for action in actions[len(results) :]
+        )
+        return results
+
+    def resource_access(self, tool_input: dict[str, Any]) -> ResourceAccess:
+        read_only = tool_input.get("action") in READ_ONLY_ACTIONS
+        # input can make the focused application write files or start programs
+        return ResourceAccess(
+            resource="display", read_only=read_only, barrier=not read_only
+        )
+
     def validate_and_get_coordinates(self, coordinate: tuple[int, int] | None = None):
         if not isinstance(coordinate, list) or len(coordinate) != 2:
             raise ToolError(f"{coordinate} must be a tuple of length 2")
@@ -221,6 +384,30 @@ class BaseComputerTool:
 
     async def screenshot(self):
         """Take a screenshot of the current screen and return the base64 encoded image."""
+        with span("screenshot", "computer", in_process=self._captures_in_process):
+            return await self._screenshot()
+
+    @property
+    def _captures_in_process(self) -> bool:
+        return self._in_process_capture and (
+            self._in_process_failed_at is None
+            or time.monotonic() - self._in_process_failed_at
+            >= self._in_process_retry_after
+        )
+
+    async def _screenshot(self):
+        if self._captures_in_process:
+            try:
+                # grabbing, resizing and encoding are CPU bound, keep them off the loop
+                base64_image = await asyncio.to_thread(self._capture_in_process)
+            except OSError:
+                # e.g. Pillow built without XCB support or the display is briefly
+                # unreachable, so this screenshot falls back to a subprocess
+                self._in_process_failed_at = time.monotonic()
+            else:
+                self._in_process_failed_at = None
+                return ToolResult(base64_image=base64_image)
+
         output_dir = Path(OUTPUT_DIR)
         output_dir.mkdir(parents=True, exist_ok=True)
         path = output_dir / f"screenshot_{uuid4().hex}.png"
@@ -243,22 +430,139 @@ class BaseComputerTool:
 
         if path.exists():
             return result.replace(
-                base64_image=base64.b64encode(path.read_bytes()).decode()
+                base64_image=await asyncio.to_thread(self._encode_file, path)
             )
         raise ToolError(f"Failed to take screenshot: {result.error}")
 
-    async def shell(self, command: str, take_screenshot=True) -> ToolResult:
-        """Run a shell command and return the output, error, and optionally a screenshot."""
+    @property
+    def _xdisplay(self) -> str | None:
+        return f":{self.display_num}" if self.display_num is not None else None
+
+    def _capture_in_process(self) -> str:
+        """Grab the framebuffer over the X connection and encode it in memory."""
+        assert Image is not None and ImageGrab is not None
+        with span("capture", "computer"):
+            image = ImageGrab.grab(xdisplay=self._xdisplay)
+        with span("encode", "computer", format=self.screenshot_encoding.format):
+            if self._scaling_enabled:
+                size = self.scale_coordinates(
+                    ScalingSource.COMPUTER, self.width, self.height
+                )
+                if image.size != size:
+                    image = image.resize(size, Image.Resampling.LANCZOS)
+            data = encode_image(image, self.screenshot_encoding)
+        return base64.b64encode(data).decode()
+
+    def _encode_file(self, path: Path) -> str:
+        """Base64 encode a captured PNG, re-encoding it if another encoding is set."""
+        data = path.read_bytes()
+        if (
+            Image is not None
+            and self.screenshot_encoding != DEFAULT_SCREENSHOT_ENCODING
+        ):
+            with (
+                span("encode", "computer", format=self.screenshot_encoding.format),
+                Image.open(io.BytesIO(data)) as image,
+            ):
+                data = encode_image(image, self.screenshot_encoding)
+        return base64.b64encode(data).decode()
+
+    async def shell(
+        self,
+        command: str,
+        take_screenshot=True,
+        *,
+        wait_for_change: Region | None = None,
+    ) -> ToolResult:
+        """
+        Run a shell command and return the output, error, and optionally a screenshot.
+
+        Before the screenshot, wait until the screen has settled or, with
+        `wait_for_change`, until that region differs from how it looked before the
+        command ran. Either wait is capped at `_screenshot_delay`.
+        """
+        baseline = None
+        if take_screenshot and wait_for_change is not None:
+            baseline = await self._frame_signature(wait_for_change)
         _, stdout, stderr = await run(command)
         base64_image = None
 
         if take_screenshot:
-            # delay to let things settle before taking a screenshot
-            await asyncio.sleep(self._screenshot_delay)
+            if baseline is not None:
+                with span("wait_for_change", "computer"):
+                    await self.wait_for_change(wait_for_change, baseline=baseline)
+            else:
+                with span("settle", "computer"):
+                    await self.wait_for_settle()
             base64_image = (await self.screenshot()).base64_image
 
         return ToolResult(output=stdout, error=stderr, base64_image=base64_image)
 
+    async def wait_for_settle(self):
+        """Wait until the screen has been stable for `_settle_window` seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._screenshot_delay
+        previous = None
+        stable_since = loop.time()
+        while (now := loop.time()) < deadline:
+            signature = await self._frame_signature()
+            if signature is None:
+                # no cheap way to sample frames, fall back to a fixed delay
+                await asyncio.sleep(max(deadline - now, 0))
+                return
+            now = loop.time()
+            if signature != previous:
+                previous, stable_since = signature, now
+            elif now - stable_since >= self._settle_window:
+                return
+            await asyncio.sleep(self._settle_interval)
+
+    async def wait_for_change(
+        self,
+        region: Region | None = None,
+        *,
+        baseline: bytes | None = None,
+        timeout: float | None = None,
+    ) -> bool:
+        """
+        Wait until `region` (or the whole screen) differs from `baseline`, or from
+        its current contents. Returns whether a change was seen before the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (
+            self._screenshot_delay if timeout is None else timeout
+        )
+        if baseline is None:
+            baseline = await self._frame_signature(region)
+        while (now := loop.time()) < deadline:
+            signature = await self._frame_signature(region)
+            if signature is None or baseline is None:
+                await asyncio.sleep(max(deadline - now, 0))
+                return False
+            if signature != baseline:
+                return True
+            await asyncio.sleep(self._settle_interval)
+        return False
+
+    async def _frame_signature(self, region: Region | None = None) -> bytes | None:
+        """A hash of the current frame, or None if frames cannot be grabbed cheaply."""
+        if not self._captures_in_process:
+            return None
+        bbox = None
+        if region is not None:
+            left, top = self.scale_coordinates(ScalingSource.API, *region[:2])
+            right, bottom = self.scale_coordinates(ScalingSource.API, *region[2:])
+            bbox = (left, top, right, bottom)
+        try:
+            return await asyncio.to_thread(self._grab_signature, bbox)
+        except OSError:
+            return None
+
+    def _grab_signature(self, bbox: tuple[int, int, int, int] | None) -> bytes:
+        assert ImageGrab is not None
+        image = ImageGrab.grab(bbox=bbox, xdisplay=self._xdisplay)
+        return hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
     def scale_coordinates(self, source: ScalingSource, x: int, y: int):
         """Scale coordinates to a target maximum resolution."""
         if not self._scaling_enabled:
@@ -313,14 +617,57 @@ class ComputerTool20250124(BaseComputerTool, BaseAnthropicTool):
         key: str | None = None,
         **kwargs,
     ):
+        if action in ("hold_key", "wait"):
+            if duration is None or not isinstance(duration, (int, float)):
+                raise ToolError(f"{duration=} must be a number")
+            if duration < 0:
+                raise ToolError(f"{duration=} must be non-negative")
+            if duration > 100:
+                raise ToolError(f"{duration=} is too long.")
+
+            if action == "hold_key":
+                if text is None:
+                    raise ToolError(f"text is required for {action}")
+                escaped_keys = shlex.quote(text)
+                command_parts = [
+                    self.xdotool,
+                    f"keydown {escaped_keys}",
+                    f"sleep {duration}",
+                    f"keyup {escaped_keys}",
+                ]
+                return await self.shell(
+                    " ".join(command_parts), wait_for_change=self.change_region
+                )
+
+            if action == "wait":
+                await asyncio.sleep(duration)
+                return await self.screenshot()
+
+        return await super().__call__(
+            action=action,
+            text=text,
+            coordinate=coordinate,
+            scroll_direction=scroll_direction,
+            scroll_amount=scroll_amount,
+            key=key,
+            **kwargs,
+        )
+
+    def xdotool_commands(
+        self,
+        *,
+        action: Action_20250124,
+        text: str | None = None,
+        coordinate: tuple[int, int] | None = None,
+        scroll_direction: ScrollDirection | None = None,
+        scroll_amount: int | None = None,
+        key: str | None = None,
+        **kwargs,
+    ) -> list[str] | None:
         if action in ("left_mouse_down", "left_mouse_up"):
             if coordinate is not None:
                 raise ToolError(f"coordinate is not accepted for {action=}.")
-            command_parts = [
-                self.xdotool,
-                f"{'mousedown' if action == 'left_mouse_down' else 'mouseup'} 1",
-            ]
-            return await self.shell(" ".join(command_parts))
+            return [f"{'mousedown' if action == 'left_mouse_down' else 'mouseup'} 1"]
         if action == "scroll":
             if scroll_direction is None or scroll_direction not in get_args(
                 ScrollDirection
@@ -330,10 +677,10 @@ class ComputerTool20250124(BaseComputerTool, BaseAnthropicTool):
                 )
             if not isinstance(scroll_amount, int) or scroll_amount < 0:
                 raise ToolError(f"{scroll_amount=} must be a non-negative int")
-            mouse_move_part = ""
+            command_parts = []
             if coordinate is not None:
                 x, y = self.validate_and_get_coordinates(coordinate)
-                mouse_move_part = f"mousemove --sync {x} {y}"
+                command_parts.append(f"mousemove --sync {x} {y}")
             scroll_button = {
                 "up": 4,
                 "down": 5,
@@ -341,38 +688,12 @@ class ComputerTool20250124(BaseComputerTool, BaseAnthropicTool):
                 "right": 7,
             }[scroll_direction]
 
-            command_parts = [self.xdotool, mouse_move_part]
             if text:
                 command_parts.append(f"keydown {text}")
             command_parts.append(f"click --repeat {scroll_amount} {scroll_button}")
             if text:
                 command_parts.append(f"keyup {text}")
-
-            return await self.shell(" ".join(command_parts))
-
-        if action in ("hold_key", "wait"):
-            if duration is None or not isinstance(duration, (int, float)):
-                raise ToolError(f"{duration=} must be a number")
-            if duration < 0:
-                raise ToolError(f"{duration=} must be non-negative")
-            if duration > 100:
-                raise ToolError(f"{duration=} is too long.")
-
-            if action == "hold_key":
-                if text is None:
-                    raise ToolError(f"text is required for {action}")
-                escaped_keys = shlex.quote(text)
-                command_parts = [
-                    self.xdotool,
-                    f"keydown {escaped_keys}",
-                    f"sleep {duration}",
-                    f"keyup {escaped_keys}",
-                ]
-                return await self.shell(" ".join(command_parts))
-
-            if action == "wait":
-                await asyncio.sleep(duration)
-                return await self.screenshot()
+            return [" ".join(command_parts)]
 
         if action in (
             "left_click",
@@ -383,20 +704,18 @@ class ComputerTool20250124(BaseComputerTool, BaseAnthropicTool):
         ):
             if text is not None:
                 raise ToolError(f"text is not accepted for {action}")
-            mouse_move_part = ""
+            command_parts = []
             if coordinate is not None:
                 x, y = self.validate_and_get_coordinates(coordinate)
-                mouse_move_part = f"mousemove --sync {x} {y}"
+                command_parts.append(f"mousemove --sync {x} {y}")
 
-            command_parts = [self.xdotool, mouse_move_part]
             if key:
                 command_parts.append(f"keydown {key}")
             command_parts.append(f"click {CLICK_BUTTONS[action]}")
             if key:
                 command_parts.append(f"keyup {key}")
+            return [" ".join(command_parts)]
 
-            return await self.shell(" ".join(command_parts))
-
-        return await super().__call__(
-            action=action, text=text, coordinate=coordinate, key=key, **kwargs
+        return super().xdotool_commands(
+            action=action, text=text, coordinate=coordinate, **kwargs
         )
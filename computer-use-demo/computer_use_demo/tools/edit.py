@@ -2,7 +2,13 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Any, Literal, get_args
 
-from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
+from .base import (
+    BaseAnthropicTool,
+    CLIResult,
+    ResourceAccess,
+    ToolError,
+    ToolResult,
+)
 from .run import maybe_truncate, run
 
 Command_20250124 = Literal[
@@ -43,6 +49,9 @@ class EditTool20250124(BaseAnthropicTool):
             "type": self.api_type,
         }
 
+    def resource_access(self, tool_input: dict[str, Any]) -> ResourceAccess:
+        return _file_access(tool_input)
+
     async def __call__(
         self,
         *,
@@ -316,6 +325,9 @@ class EditTool20250429(BaseAnthropicTool):
             "type": self.api_type,
         }
 
+    def resource_access(self, tool_input: dict[str, Any]) -> ResourceAccess:
+        return _file_access(tool_input)
+
     async def __call__(
         self,
         *,
@@ -559,3 +571,11 @@ class EditTool20250429(BaseAnthropicTool):
 
 class EditTool20241022(EditTool20250124):
     api_type: Literal["text_editor_20250429"] = "text_editor_20250429"  # pyright: ignore[reportIncompatibleVariableOverride]
+
+
+def _file_access(tool_input: dict[str, Any]) -> ResourceAccess:
+    # spellings of the same file, e.g. through "..", "." or a symlink, share a key
+    path = Path(str(tool_input.get("path", ""))).resolve()
+    return ResourceAccess(
+        resource=f"file:{path}", read_only=tool_input.get("command") == "view"
+    )
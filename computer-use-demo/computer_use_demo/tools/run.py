@@ -1,6 +1,16 @@
 """Utility to run shell commands asynchronously with a timeout."""
 
 import asyncio
+import os
+import signal
+from collections.abc import Callable
+from pathlib import Path
+from typing import IO
+from uuid import uuid4
+
+from ..tracing import span
+
+OUTPUT_DIR = "/tmp/outputs"
 
 TRUNCATED_MESSAGE: str = "<response clipped><NOTE>To save on context only part of this file has been shown to you. You should retry this tool after you have searched inside the file with `grep -n` in order to find the line numbers of what you are looking for.</NOTE>"
 MAX_RESPONSE_LEN: int = 16000
@@ -15,28 +25,128 @@ def maybe_truncate(content: str, truncate_after: int | None = MAX_RESPONSE_LEN):
     )
 
 
+class OutputCapture:
+    """
+    Collects the output of a command with bounded memory.
+
+    Up to `head_size + tail_size` characters are kept in memory. Beyond that the
+    whole output is spilled to a file in `output_dir`, and only its first
+    `head_size` and last `tail_size` characters are kept. Every chunk is also
+    passed to `on_chunk` as it arrives.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        head_size: int = MAX_RESPONSE_LEN // 2,
+        tail_size: int = MAX_RESPONSE_LEN // 2,
+        output_dir: str | Path = OUTPUT_DIR,
+        on_chunk: Callable[[str], None] | None = None,
+    ):
+        self.name = name
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.output_dir = Path(output_dir)
+        self.on_chunk = on_chunk
+        self.size = 0
+        self.spill_path: Path | None = None
+        self._head = ""
+        self._tail: list[str] = []
+        self._tail_len = 0
+        self._spill: IO[str] | None = None
+
+    def write(self, text: str):
+        if not text:
+            return
+        if self.on_chunk is not None:
+            self.on_chunk(text)
+        self.size += len(text)
+        if self._spill is None and self.size > self.head_size + self.tail_size:
+            self._start_spill()
+        if self._spill is not None:
+            self._spill.write(text)
+        if len(self._head) < self.head_size:
+            text = self._keep_head(text)
+        self._tail.append(text)
+        self._tail_len += len(text)
+        if self._spill is not None and self._tail_len > 2 * self.tail_size:
+            # compact every so often rather than on each chunk
+            tail = "".join(self._tail)[-self.tail_size :]
+            self._tail, self._tail_len = [tail], len(tail)
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+    def getvalue(self) -> str:
+        """The output, or its head and tail with a note on where the rest went."""
+        tail = "".join(self._tail)
+        if self.spill_path is None:
+            return self._head + tail
+        tail = tail[-self.tail_size :]
+        omitted = self.size - len(self._head) - len(tail)
+        return (
+            f"{self._head}\n<output clipped: {omitted} characters omitted, the full "
+            f"output is in {self.spill_path}>\n{tail}"
+        )
+
+    def _keep_head(self, text: str) -> str:
+        room = self.head_size - len(self._head)
+        self._head += text[:room]
+        return text[room:]
+
+    def _start_spill(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.spill_path = self.output_dir / f"{self.name}_{uuid4().hex}.log"
+        self._spill = self.spill_path.open("w")
+        self._spill.write(self._head + "".join(self._tail))
+
+
 async def run(
     cmd: str,
     timeout: float | None = 120.0,  # seconds
     truncate_after: int | None = MAX_RESPONSE_LEN,
 ):
-    """Run a shell command asynchronously with a timeout."""
+    """
+    Run a shell command asynchronously with a timeout.
+
+    The command runs in a process group of its own, which is killed as a whole when
+    it times out or the calling task is cancelled.
+    """
     process = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True,
     )
 
     try:
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        with span("subprocess", "tools", cmd=cmd):
+            stdout, stderr = await asyncio.wait_for(
+                process.communicate(), timeout=timeout
+            )
         return (
             process.returncode or 0,
             maybe_truncate(stdout.decode(), truncate_after=truncate_after),
             maybe_truncate(stderr.decode(), truncate_after=truncate_after),
         )
     except asyncio.TimeoutError as exc:
-        try:
-            process.kill()
-        except ProcessLookupError:
-            pass
+        await kill_process_group(process)
         raise TimeoutError(
             f"Command '{cmd}' timed out after {timeout} seconds"
         ) from exc
+    except asyncio.CancelledError:
+        await kill_process_group(process)
+        raise
+
+
+async def kill_process_group(process: asyncio.subprocess.Process):
+    """Kill a process started as a session leader, with its children, and reap it."""
+    # children may outlive the shell and hold its pipes, so kill the group even
+    # when the shell itself has exited
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
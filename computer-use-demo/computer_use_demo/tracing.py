@@ -0,0 +1,157 @@
+"""
+Opt-in timeline tracing in the Chrome trace event format, viewable in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing.
+
+Spans are recorded by the tracer active in the current context, so tool calls
+started as asyncio tasks and work moved to threads with `asyncio.to_thread` are
+attributed to the session that started them. Without an active tracer `span`
+returns a shared no-op context manager.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+_TRACER: ContextVar["Tracer | None"] = ContextVar("tracer", default=None)
+_NO_SPAN = nullcontext()
+
+
+class Span:
+    """A complete ("X") trace event, recorded when the span exits."""
+
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add(self.name, self.category, self.start, end, self.args)
+
+    async def __aenter__(self) -> "Span":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+
+class Tracer:
+    """
+    Collects the spans of a session and writes them as Chrome trace event JSON.
+
+    Each asyncio task and each thread outside the event loop gets its own track, so
+    overlapping tool calls do not interleave on one timeline.
+    """
+
+    def __init__(self, path: Path | str | None = None):
+        self.path = Path(path) if path is not None else None
+        self.events: list[dict[str, Any]] = []
+        self._origin = time.perf_counter_ns()
+        self._pid = os.getpid()
+        # tasks are dropped once they are garbage collected; their tids are not reused
+        self._task_tracks: weakref.WeakKeyDictionary[asyncio.Task, int] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._thread_tracks: dict[int, int] = {}
+        self._tids = itertools.count(1)
+
+    def span(self, name: str, category: str = "", **args: Any) -> Span:
+        return Span(self, name, category, args)
+
+    def add(
+        self,
+        name: str,
+        category: str,
+        start_ns: int,
+        end_ns: int,
+        args: dict[str, Any] | None = None,
+    ):
+        event: dict[str, Any] = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start_ns - self._origin) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": self._pid,
+            "tid": self._track(),
+        }
+        if args:
+            event["args"] = {key: _jsonable(value) for key, value in args.items()}
+        self.events.append(event)
+
+    @contextmanager
+    def activate(self):
+        """Record spans in this context with this tracer, then write the trace."""
+        token = _TRACER.set(self)
+        try:
+            yield self
+        finally:
+            _TRACER.reset(token)
+            if self.path is not None:
+                self.write(self.path)
+
+    def to_json(self) -> dict[str, Any]:
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    def write(self, path: Path | str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.to_json()))
+
+    def _track(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        tracks: Any = self._task_tracks if task is not None else self._thread_tracks
+        key = task if task is not None else threading.get_ident()
+        if (tid := tracks.get(key)) is None:
+            tid = tracks[key] = next(self._tids)
+            name = (
+                task.get_name() if task is not None else threading.current_thread().name
+            )
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        return tid
+
+
+def span(name: str, category: str = "", **args: Any) -> Span | nullcontext:
+    """Time a block with the active tracer, if any."""
+    if (tracer := _TRACER.get()) is None:
+        return _NO_SPAN
+    return tracer.span(name, category, **args)
+
+
+def activate(tracer: Tracer | None):
+    """Context manager activating `tracer`, or doing nothing without one."""
+    return tracer.activate() if tracer is not None else _NO_SPAN
+
+
+def _jsonable(value: Any) -> Any:
+    if value is None or isinstance(value, str | int | float | bool):
+        return value
+    return str(value)
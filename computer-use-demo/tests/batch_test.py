@@ -0,0 +1,170 @@
+import asyncio
+import json
+import re
+from unittest import mock
+
+import pytest
+
+from computer_use_demo.batch import (
+    APIProvider,
+    BatchConfig,
+    BatchTask,
+    build_tool_collection,
+    load_tasks,
+    main,
+    run_batch,
+)
+from computer_use_demo.displays import Display, DisplayPool
+from computer_use_demo.images import DEFAULT_DEDUPE_THRESHOLD
+from computer_use_demo.tools import ImageFormat, ScreenshotEncoding
+
+
+def test_build_tool_collection_uses_display():
+    tools = build_tool_collection(
+        "computer_use_20250124",
+        Display(num=7, width=1280, height=800),
+        change_region=(0, 0, 100, 50),
+        screenshot_encoding=ScreenshotEncoding(format=ImageFormat.JPEG),
+    )
+    assert tools.tool_map["computer"].display_num == 7  # type: ignore
+    assert (
+        tools.tool_map["computer"].screenshot_encoding.format  # type: ignore
+        == ImageFormat.JPEG
+    )
+    assert tools.tool_map["computer"].change_region == (0, 0, 100, 50)  # type: ignore
+    assert tools.tool_map["computer"].width == 1280  # type: ignore
+    assert tools.tool_map["bash"].pool.env == {"DISPLAY": ":7"}  # type: ignore
+
+
+def test_load_tasks_ignores_unknown_fields(tmp_path):
+    path = tmp_path / "tasks.jsonl"
+    path.write_text(
+        '{"id": "a", "prompt": "open firefox", "tags": ["smoke"]}\n\n'
+        '{"id": "b", "prompt": "open xterm", "max_tokens": 1024,'
+        ' "change_region": [0, 0, 100, 50]}\n'
+    )
+    assert load_tasks(path) == [
+        BatchTask(id="a", prompt="open firefox"),
+        BatchTask(
+            id="b", prompt="open xterm", max_tokens=1024, change_region=(0, 0, 100, 50)
+        ),
+    ]
+
+
+async def test_run_batch_leases_displays(tmp_path):
+    running: dict[str, int] = {}
+    max_running = 0
+
+    async def fake_sampling_loop(*, messages, tool_collection, **kwargs):
+        nonlocal max_running
+        assert kwargs["screenshot_dedupe_threshold"] == DEFAULT_DEDUPE_THRESHOLD
+        assert kwargs["image_eviction"].images_to_keep == 3
+        display_num = tool_collection.tool_map["computer"].display_num
+        assert display_num not in running.values()
+        running[messages[0]["content"]] = display_num
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        del running[messages[0]["content"]]
+        if messages[0]["content"] == "fail":
+            kwargs["api_response_callback"](None, None, RuntimeError("overloaded"))
+        return [*messages, {"role": "assistant", "content": "done"}]
+
+    tasks = [BatchTask(id=str(i), prompt=str(i)) for i in range(4)]
+    tasks.append(BatchTask(id="4", prompt="fail"))
+    with mock.patch("computer_use_demo.batch.sampling_loop", fake_sampling_loop):
+        results = await run_batch(
+            tasks,
+            config=BatchConfig(),
+            output_dir=tmp_path,
+            concurrency=3,
+            display_pool=DisplayPool(
+                existing=[
+                    Display(num=1, width=1024, height=768),
+                    Display(num=2, width=1024, height=768),
+                ]
+            ),
+        )
+
+    assert max_running == 2
+    assert [result.status for result in results] == ["completed"] * 4 + ["error"]
+    assert results[-1].error == "RuntimeError: overloaded"
+    transcript = json.loads((tmp_path / "0" / "transcript.json").read_text())
+    assert transcript[-1] == {"role": "assistant", "content": "done"}
+    summary = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert sorted(json.loads(line)["id"] for line in summary) == list("01234")
+
+
+async def test_run_batch_reports_failed_task_setup(tmp_path):
+    async def fake_sampling_loop(*, messages, **kwargs):
+        return messages
+
+    def fake_build_tool_collection(tool_version, display, **kwargs):
+        if tool_version == "computer_use_20241022":
+            raise OSError("no such display")
+        return build_tool_collection(tool_version, display, **kwargs)
+
+    with (
+        mock.patch("computer_use_demo.batch.sampling_loop", fake_sampling_loop),
+        mock.patch(
+            "computer_use_demo.batch.build_tool_collection",
+            fake_build_tool_collection,
+        ),
+    ):
+        results = await run_batch(
+            [
+                BatchTask(id="a", prompt="a", tool_version="computer_use_20241022"),
+                BatchTask(id="b", prompt="b"),
+            ],
+            config=BatchConfig(),
+            output_dir=tmp_path,
+            concurrency=2,
+            display_pool=DisplayPool(existing=[Display(num=1, width=1024, height=768)]),
+        )
+
+    assert [result.status for result in results] == ["error", "completed"]
+    assert results[0].error == "OSError: no such display"
+    assert (tmp_path / "a" / "transcript.json").exists()
+
+
+async def test_run_batch_prewarms_the_client(tmp_path):
+    async def fake_sampling_loop(*, messages, **kwargs):
+        return messages
+
+    with (
+        mock.patch("computer_use_demo.batch.sampling_loop", fake_sampling_loop),
+        mock.patch("computer_use_demo.batch.prewarm_client") as prewarm,
+    ):
+        await run_batch(
+            [BatchTask(id="a", prompt="a")],
+            config=BatchConfig(api_key="key", prewarm=True),
+            output_dir=tmp_path,
+            concurrency=1,
+            display_pool=DisplayPool(existing=[Display(num=1, width=1024, height=768)]),
+        )
+    prewarm.assert_awaited_once_with(APIProvider.ANTHROPIC, api_key="key")
+
+
+@pytest.mark.parametrize(
+    "line,error",
+    [
+        ('{"id": "../etc", "prompt": "x"}', "must be letters"),
+        ('{"id": "", "prompt": "x"}', "must be letters"),
+        ('{"id": "a/b", "prompt": "x"}', "must be letters"),
+        ('{"id": "a", "prompt": "x"}', "duplicate task id 'a'"),
+        (
+            '{"id": "b", "prompt": "x", "tool_version": "computer_use_1999"}',
+            "unknown tool_version 'computer_use_1999'",
+        ),
+    ],
+)
+def test_load_tasks_rejects_unsafe_and_duplicate_ids(tmp_path, line, error):
+    path = tmp_path / "tasks.jsonl"
+    path.write_text('{"id": "a", "prompt": "x"}\n' + line + "\n")
+    with pytest.raises(ValueError, match=f":2: .*{re.escape(error)}"):
+        load_tasks(path)
+
+
+def test_main_rejects_unknown_tool_version(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / "tasks.jsonl"), "--tool-version", "computer_use_1999"])
+    assert "invalid choice: 'computer_use_1999'" in capsys.readouterr().err
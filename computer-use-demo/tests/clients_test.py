@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+from unittest import mock
+
+import httpx
+from anthropic import AsyncAnthropic
+
+from computer_use_demo.clients import APIProvider, ClientRegistry
+
+
+async def test_registry_reuses_clients():
+    registry = ClientRegistry()
+    client = registry.get(APIProvider.ANTHROPIC, api_key="key-1")
+
+    assert registry.get(APIProvider.ANTHROPIC, api_key="key-1") is client
+    assert registry.get(APIProvider.ANTHROPIC, api_key="key-2") is not client
+    assert len(registry.stats()) == 2
+    await registry.aclose()
+
+
+def test_registry_scopes_clients_to_event_loop():
+    registry = ClientRegistry()
+
+    async def get():
+        return registry.get(APIProvider.ANTHROPIC, api_key="key")
+
+    assert asyncio.run(get()) is not asyncio.run(get())
+
+
+async def test_registry_pool_stats():
+    registry = ClientRegistry()
+    registry.get(APIProvider.ANTHROPIC, api_key="key")
+    ((key, stats),) = registry.stats().items()
+    entry = registry._entry(APIProvider.ANTHROPIC, api_key="key", region=None)
+
+    request = entry.http_client.build_request("GET", "https://example.com")
+    await entry.http_client._event_hooks["request"][0](request)
+    trace = request.extensions["trace"]
+    await trace("connection.connect_tcp.complete", {})
+    await trace("http11.send_request_headers.started", {})
+    await trace("http11.send_request_headers.started", {})
+
+    assert key.provider == APIProvider.ANTHROPIC
+    assert "key" not in repr(key)
+    assert stats.connections_opened == 1
+    assert stats.connections_reused == 1
+    await registry.aclose()
+
+
+def test_sdk_internals_match_pre_serializing_override():
+    from anthropic._compat import model_copy
+    from anthropic._models import FinalRequestOptions
+
+    parameters = inspect.signature(AsyncAnthropic._build_request).parameters
+    assert list(parameters) == ["self", "options", "retries_taken"], (
+        "AsyncAnthropic._build_request changed; update PreSerializingAnthropic "
+        "and the anthropic pin in requirements.txt"
+    )
+    assert parameters["retries_taken"].kind is inspect.Parameter.KEYWORD_ONLY
+    assert {"json_data", "extra_json"} <= set(FinalRequestOptions.model_fields)
+    options = FinalRequestOptions(method="post", url="/v1/messages", json_data={})
+    assert model_copy(options) is not options
+
+
+async def test_registry_prewarm_connects_the_cached_client():
+    registry = ClientRegistry()
+    with mock.patch.object(
+        httpx.AsyncClient, "head", new_callable=mock.AsyncMock
+    ) as head:
+        await registry.prewarm(APIProvider.ANTHROPIC, api_key="key")
+        head.side_effect = httpx.ConnectError("unreachable")
+        # a failed prewarm is left to the first request
+        await registry.prewarm(APIProvider.ANTHROPIC, api_key="key")
+
+    client = registry.get(APIProvider.ANTHROPIC, api_key="key")
+    assert head.call_args_list == [mock.call(str(client.base_url))] * 2
+    assert len(registry.stats()) == 1
+    await registry.aclose()
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from computer_use_demo.displays import Display, DisplayPool
+
+
+class FakeDisplayPool(DisplayPool):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started: list[int | None] = []
+        self.stopped: list[int | None] = []
+
+    async def _start(self, display: Display):
+        await asyncio.sleep(0)
+        self.started.append(display.num)
+
+    async def _stop(self, display: Display):
+        self.stopped.append(display.num)
+
+
+async def test_pool_hands_out_existing_displays_first():
+    main = Display(num=1, width=1024, height=768)
+    pool = FakeDisplayPool(existing=[main], max_displays=2, first_display_num=90)
+
+    first = await pool.acquire()
+    second = await pool.acquire()
+    assert first == main
+    assert (second.num, second.width, second.height) == (90, 1024, 768)
+    assert pool.started == [90]
+
+    await pool.release(second)
+    assert await pool.acquire() == second
+    assert pool.started == [90]
+
+
+async def test_pool_waits_for_a_free_display():
+    pool = FakeDisplayPool(max_displays=1, first_display_num=90)
+    display = await pool.acquire()
+    waiter = asyncio.create_task(pool.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    await pool.release(display)
+    assert await waiter == display
+    assert pool.size == 1
+
+
+async def test_pool_recycles_idle_displays():
+    pool = FakeDisplayPool(max_displays=2, idle_timeout=0.01, first_display_num=90)
+    async with pool.lease():
+        pass
+    assert (pool.size, pool.idle) == (1, 1)
+
+    await asyncio.sleep(0.05)
+    assert pool.stopped == [90]
+    assert (pool.size, pool.idle) == (0, 0)
+
+    async with pool.lease() as display:
+        assert display.num == 90
+    await pool.aclose()
+    assert pool.stopped == [90, 90]
+
+
+def test_pool_needs_room_for_a_display():
+    assert DisplayPool().max_displays == 1
+    with pytest.raises(ValueError, match="must be at least 1"):
+        DisplayPool(max_displays=0)
+
+
+async def test_pool_keeps_one_reap_timer():
+    pool = FakeDisplayPool(max_displays=2, idle_timeout=10, first_display_num=90)
+    first, second = await pool.acquire(), await pool.acquire()
+    await pool.release(first)
+    reaper = pool._reaper
+    await pool.release(second)
+    assert reaper is not None and pool._reaper is reaper
+
+    pool.idle_timeout = 0
+    pool._schedule_reap()
+    await asyncio.sleep(0.01)
+    assert pool.stopped == [90, 91]
+    assert pool._reaper is None and not pool._tasks
+    await pool.aclose()
@@ -0,0 +1,236 @@
+import base64
+import gc
+import io
+
+from PIL import Image, ImageDraw
+
+from computer_use_demo.images import (
+    MISSING_IMAGE_TEXT,
+    CacheAlignedEviction,
+    ImageIndex,
+    ImageStore,
+    ScreenshotDeduplicator,
+    perceptual_hash,
+)
+from computer_use_demo.loop import (
+    _make_api_tool_result,
+    _maybe_filter_to_n_most_recent_images,
+)
+from computer_use_demo.tools import ToolResult
+
+
+def screenshot(text: str = "") -> str:
+    image = Image.new("RGB", (1024, 768), "white")
+    ImageDraw.Draw(image).text((100, 100), text, fill="black", font_size=24)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_perceptual_hash_sees_small_changes():
+    assert perceptual_hash(screenshot("hello")) == perceptual_hash(screenshot("hello"))
+    assert perceptual_hash(screenshot("hello")) != perceptual_hash(screenshot("hi"))
+
+
+async def test_dedupe_replaces_unchanged_screenshot():
+    deduplicator = ScreenshotDeduplicator()
+    first = ToolResult(base64_image=screenshot("hello"))
+    assert await deduplicator.dedupe(first, "1") is first
+
+    result = await deduplicator.dedupe(
+        ToolResult(output="clicked", base64_image=screenshot("hello")), "2"
+    )
+    assert result.base64_image is None
+    assert result.output == (
+        "clicked\n(screen unchanged since tool_use 1, screenshot omitted)"
+    )
+
+    changed = ToolResult(base64_image=screenshot("goodbye"))
+    assert await deduplicator.dedupe(changed, "3") is changed
+
+
+async def test_dedupe_seeds_from_history():
+    deduplicator = ScreenshotDeduplicator()
+    await deduplicator.seed(
+        [
+            {"role": "user", "content": "Hello"},
+            {
+                "role": "user",
+                "content": [
+                    _make_api_tool_result(
+                        ToolResult(base64_image=screenshot("hello")), "1"
+                    )
+                ],
+            },
+        ]
+    )
+    result = await deduplicator.dedupe(
+        ToolResult(base64_image=screenshot("hello")), "2"
+    )
+    assert result.base64_image is None
+
+
+def test_image_store_externalize_and_materialize():
+    store = ImageStore()
+    image = screenshot("hello")
+    result = store.externalize(ToolResult(output="done", base64_image=image))
+    assert result.base64_image is None
+    assert store.get(result.image_key) == image
+
+    block = _make_api_tool_result(result, "1")
+    block["content"][-1]["cache_control"] = {"type": "ephemeral"}
+    messages = [
+        {"role": "user", "content": "Hello"},
+        {"role": "user", "content": [block]},
+    ]
+    materialized = store.materialize(messages)
+
+    assert materialized[0] is messages[0]
+    assert block["content"][1]["source"] == {
+        "type": "image_ref",
+        "key": result.image_key,
+    }
+    assert materialized[1]["content"][0]["content"][1] == {
+        "type": "image",
+        "source": {"type": "base64", "media_type": "image/png", "data": image},
+        "cache_control": {"type": "ephemeral"},
+    }
+
+
+def test_image_store_lru_and_disk(tmp_path):
+    first, second = screenshot("first"), screenshot("second")
+    store = ImageStore(max_memory_bytes=len(first) + 1)
+    first_key = store.put(first)
+    store.put(second)
+    assert first_key not in store
+    block = _make_api_tool_result(ToolResult(image_key=first_key), "1")
+    materialized = store.materialize([{"role": "user", "content": [block]}])
+    assert materialized[0]["content"][0]["content"] == [
+        {"type": "text", "text": MISSING_IMAGE_TEXT}
+    ]
+
+    store = ImageStore(tmp_path, max_memory_bytes=len(first) + 1)
+    first_key = store.put(first)
+    store.put(second)
+    assert store.get(first_key) == first
+    assert ImageStore(tmp_path).get(first_key) == first
+
+
+def image_history(images: int) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": f"toolu_{i}",
+                    "content": [
+                        {"type": "text", "text": "x" * 400},
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": "",
+                            },
+                        },
+                    ],
+                }
+            ],
+        }
+        for i in range(images)
+    ]
+
+
+def test_cache_aligned_eviction_waits_for_high_water_mark():
+    policy = CacheAlignedEviction(images_to_keep=3, max_images=6)
+    policy.record_request(now=0)
+    assert policy.images_to_evict(image_history(5), now=10) == 0
+    assert policy.images_to_evict(image_history(6), now=10) == 3
+
+    estimate = policy.estimate(image_history(6), now=10)
+    assert estimate.images == 3
+    # the text blocks of the three evicted results after the first image, plus the
+    # three kept results
+    assert estimate.rewrite_tokens == 5 * 100 + 3 * policy.tokens_per_image
+    assert estimate.rewrite_cost > 0
+    assert estimate.saved_per_turn == 3 * policy.tokens_per_image * 0.1
+    assert 0 < estimate.break_even_turns < float("inf")
+
+
+def test_cache_aligned_eviction_on_expired_cache():
+    policy = CacheAlignedEviction(images_to_keep=3, max_images=6, cache_ttl=300)
+    policy.record_request(now=0)
+    assert policy.images_to_evict(image_history(4), now=100) == 0
+    assert policy.images_to_evict(image_history(4), now=301) == 1
+    assert policy.last_estimate is not None
+    assert policy.last_estimate.cache_expired
+    assert policy.last_estimate.rewrite_cost == 0
+
+
+def count_images(messages: list) -> int:
+    return sum(
+        1
+        for message in messages
+        for block in message["content"]
+        for item in block["content"]
+        if item["type"] == "image"
+    )
+
+
+def test_image_index_prunes_incrementally():
+    messages = image_history(4)
+    index = ImageIndex()
+    _maybe_filter_to_n_most_recent_images(messages, 2, 2, image_index=index)
+    assert count_images(messages) == index.images == 2
+    assert messages[0]["content"][0]["content"] == [{"type": "text", "text": "x" * 400}]
+
+    messages.extend(image_history(3))
+    _maybe_filter_to_n_most_recent_images(messages, 2, 2, image_index=index)
+    # 5 images, removed in a chunk of 2
+    assert count_images(messages) == index.images == 3
+    assert [i for i, message in enumerate(messages) if count_images([message])] == [
+        4,
+        5,
+        6,
+    ]
+
+
+def test_image_index_resets_for_a_new_history():
+    index = ImageIndex()
+    index.update(image_history(4))
+    index.update(messages := image_history(1))
+    assert index.prune(0, 1) == 1
+    assert count_images(messages) == 0
+
+
+def test_cache_aligned_eviction_skips_estimate_below_high_water_mark():
+    policy = CacheAlignedEviction(images_to_keep=3, max_images=6)
+    index = ImageIndex()
+    assert policy.images_to_evict(image_history(5), image_index=index) == 0
+    assert policy.last_estimate is None
+
+
+async def test_image_store_aput_writes_to_disk(tmp_path):
+    image = screenshot("hello")
+    store = ImageStore(tmp_path)
+    result = await store.aexternalize(ToolResult(base64_image=image))
+    assert result.base64_image is None
+    assert (tmp_path / result.image_key).read_bytes() == base64.b64decode(image)
+    assert await store.aput(image) == result.image_key
+
+
+def test_image_store_for_session_removes_its_directory(tmp_path):
+    store = ImageStore.for_session(tmp_path)
+    key = store.put(screenshot("hello"))
+    directory = store.directory
+    assert directory is not None and directory.parent == tmp_path
+    assert (directory / key).exists()
+    other = ImageStore.for_session(tmp_path)
+    assert other.directory != directory
+
+    store.close()
+    assert not directory.exists()
+    del other
+    gc.collect()
+    assert list(tmp_path.iterdir()) == []
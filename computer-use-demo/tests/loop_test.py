@@ -1,13 +1,38 @@
+import asyncio
+import base64
+from typing import cast
 from unittest import mock
 
+import httpx
+import pytest
+from anthropic import APIConnectionError
 from anthropic.types import TextBlock, ToolUseBlock
-from anthropic.types.beta import BetaMessage, BetaMessageParam, BetaTextBlockParam
+from anthropic.types.beta import (
+    BetaMessage,
+    BetaMessageParam,
+    BetaTextBlockParam,
+    BetaToolUseBlock,
+    BetaUsage,
+)
 
-from computer_use_demo.loop import APIProvider, sampling_loop
+from computer_use_demo.cancellation import CancellationToken
+from computer_use_demo.clients import AsyncClient
+from computer_use_demo.images import CacheAlignedEviction
+from computer_use_demo.loop import APIProvider, _make_api_tool_result, sampling_loop
+from computer_use_demo.metrics import SessionMetrics
+from computer_use_demo.replay import RecordedToolCall, RecordedTurn, Recording, Replay
+from computer_use_demo.tools import (
+    ImageFormat,
+    ScreenshotEncoding,
+    ToolCancelled,
+    ToolCollection,
+    ToolResult,
+)
 
 
 async def test_loop():
     client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
     client.beta.messages.with_raw_response.create.return_value = mock.Mock()
     client.beta.messages.with_raw_response.create.return_value.parse.side_effect = [
         mock.Mock(
@@ -22,17 +47,21 @@ async def test_loop():
         mock.Mock(spec=BetaMessage, content=[TextBlock(type="text", text="Done!")]),
     ]
 
-    tool_collection = mock.AsyncMock()
-    tool_collection.run.return_value = mock.Mock(
-        output="Tool output", error=None, base64_image=None
+    tool_collection = mock.Mock()
+    tool_collection.run = mock.AsyncMock(
+        return_value=mock.Mock(output="Tool output", error=None, base64_image=None)
     )
+    tool_collection.run_many.side_effect = lambda calls, cancellation=None: [
+        asyncio.ensure_future(tool_collection.run(name=name, tool_input=tool_input))
+        for name, tool_input in calls
+    ]
 
     output_callback = mock.Mock()
     tool_output_callback = mock.Mock()
     api_response_callback = mock.Mock()
 
     with mock.patch(
-        "computer_use_demo.loop.Anthropic", return_value=client
+        "computer_use_demo.loop.get_client", return_value=client
     ), mock.patch(
         "computer_use_demo.loop.ToolCollection", return_value=tool_collection
     ):
@@ -65,3 +94,403 @@ async def test_loop():
         assert output_callback.call_count == 3
         assert tool_output_callback.call_count == 1
         assert api_response_callback.call_count == 2
+
+
+async def test_loop_records_metrics():
+    usage = BetaUsage(
+        input_tokens=10,
+        cache_read_input_tokens=100,
+        cache_creation_input_tokens=20,
+        output_tokens=5,
+    )
+    client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
+    client.beta.messages.with_raw_response.create.return_value = mock.Mock()
+    client.beta.messages.with_raw_response.create.return_value.parse.side_effect = [
+        mock.Mock(
+            spec=BetaMessage,
+            usage=usage,
+            content=[
+                ToolUseBlock(
+                    type="tool_use",
+                    id="1",
+                    name="computer",
+                    input={"action": "screenshot"},
+                ),
+            ],
+        ),
+        mock.Mock(
+            spec=BetaMessage,
+            usage=usage,
+            content=[TextBlock(type="text", text="Done!")],
+        ),
+    ]
+    tool_collection = mock.Mock()
+    tool_collection.run = mock.AsyncMock(
+        return_value=ToolResult(base64_image=base64.b64encode(b"png").decode())
+    )
+    tool_collection.run_many.side_effect = lambda calls, cancellation=None: [
+        asyncio.ensure_future(tool_collection.run(name=name, tool_input=tool_input))
+        for name, tool_input in calls
+    ]
+
+    metrics = SessionMetrics()
+    with mock.patch(
+        "computer_use_demo.loop.get_client", return_value=client
+    ), mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=tool_collection
+    ):
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=mock.Mock(),
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            screenshot_dedupe_threshold=None,
+            metrics=metrics,
+        )
+
+    first, second = metrics.turns
+    assert first.cache_read_input_tokens == 100
+    assert [(call.name, call.action) for call in first.tools] == [
+        ("computer", "screenshot")
+    ]
+    assert first.tools[0].image_bytes == 3
+    assert (first.images, second.images) == (0, 1)
+    assert second.tools == []
+    assert metrics.totals()["cache_hit_ratio"] == 200 / 260
+
+
+async def test_loop_streaming():
+    events_seen: list[str] = []
+    tool_use = BetaToolUseBlock(
+        type="tool_use", id="1", name="computer", input={"action": "test"}
+    )
+
+    class FakeStream:
+        def __init__(self, events, final_message):
+            self.events = events
+            self.final_message = final_message
+            self.response = mock.Mock()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def __aiter__(self):
+            for event in self.events:
+                yield event
+                # give dispatched tools a chance to start mid-stream
+                await asyncio.sleep(0)
+            events_seen.append("stream_end")
+
+        async def get_final_message(self):
+            return self.final_message
+
+    client = mock.Mock()
+    client.beta.messages.stream.side_effect = [
+        FakeStream(
+            [
+                mock.Mock(type="text", text="Hel"),
+                mock.Mock(type="text", text="lo"),
+                mock.Mock(type="content_block_stop", content_block=tool_use),
+                mock.Mock(type="text", text="More"),
+            ],
+            mock.Mock(
+                spec=BetaMessage,
+                content=[TextBlock(type="text", text="HelloMore"), tool_use],
+            ),
+        ),
+        FakeStream(
+            [mock.Mock(type="text", text="Done!")],
+            mock.Mock(spec=BetaMessage, content=[TextBlock(type="text", text="Done!")]),
+        ),
+    ]
+
+    async def run_tool(**kwargs):
+        events_seen.append("tool_run")
+        return mock.Mock(output="Tool output", error=None, base64_image=None)
+
+    tool_collection = mock.AsyncMock()
+    tool_collection.run.side_effect = run_tool
+
+    output_callback = mock.Mock()
+    tool_output_callback = mock.Mock()
+    api_response_callback = mock.Mock()
+
+    with mock.patch(
+        "computer_use_demo.loop.get_client", return_value=client
+    ), mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=tool_collection
+    ):
+        messages: list[BetaMessageParam] = [{"role": "user", "content": "Test message"}]
+        result = await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            api_response_callback=api_response_callback,
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            stream=True,
+        )
+
+    assert len(result) == 4
+    assert result[1]["content"][0] == BetaTextBlockParam(
+        type="text", text="HelloMore", citations=None
+    )
+    assert events_seen[:2] == ["tool_run", "stream_end"]
+    tool_collection.run.assert_called_once_with(
+        name="computer", tool_input={"action": "test"}, cancellation=None
+    )
+    assert output_callback.call_args_list[0] == mock.call(
+        BetaTextBlockParam(type="text", text="Hel")
+    )
+    assert output_callback.call_count == 5
+    assert tool_output_callback.call_count == 1
+    assert api_response_callback.call_count == 2
+
+
+def test_make_api_tool_result_media_type():
+    jpeg = base64.b64encode(b"\xff\xd8\xff\xe0" + b"\x00" * 16).decode()
+    block = _make_api_tool_result(ToolResult(base64_image=jpeg), "1")
+    assert block["content"][0]["source"]["media_type"] == "image/jpeg"
+
+
+async def test_loop_cancellation_stops_running_tools():
+    tool_use = {"type": "tool_use", "id": "1", "name": "bash", "input": {}}
+    recording = Recording(
+        model="test-model",
+        tools=[{"name": "bash", "type": "bash_20250124"}],
+        turns=[
+            RecordedTurn(
+                api_seconds=0,
+                response={
+                    "id": "msg",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": "test-model",
+                    "content": [tool_use],
+                    "stop_reason": "tool_use",
+                    "usage": {"input_tokens": 1, "output_tokens": 1},
+                },
+                tools=[
+                    RecordedToolCall(
+                        tool_use_id="1",
+                        name="bash",
+                        input={},
+                        seconds=30,
+                        result={"output": "too late"},
+                    )
+                ],
+            )
+        ],
+    )
+    session = Replay.from_recording(recording)
+    cancellation = CancellationToken()
+    tool_output_callback = mock.Mock()
+    asyncio.get_running_loop().call_later(0.05, cancellation.cancel)
+
+    messages = await asyncio.wait_for(
+        sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=tool_output_callback,
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            tool_collection=session.tool_collection,
+            client=cast(AsyncClient, session.client),
+            cancellation=cancellation,
+        ),
+        timeout=5,
+    )
+
+    assert [message["role"] for message in messages] == ["user", "assistant", "user"]
+    result = tool_output_callback.call_args.args[0]
+    assert isinstance(result, ToolCancelled)
+    assert session.client.requests == 1
+
+
+async def test_loop_builds_tools_with_screenshot_encoding():
+    client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
+    client.beta.messages.with_raw_response.create.return_value = mock.Mock()
+    client.beta.messages.with_raw_response.create.return_value.parse.return_value = (
+        mock.Mock(spec=BetaMessage, content=[TextBlock(type="text", text="Done!")])
+    )
+    encoding = ScreenshotEncoding(format=ImageFormat.JPEG)
+
+    with mock.patch(
+        "computer_use_demo.loop.ToolCollection", wraps=ToolCollection
+    ) as collection:
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=mock.Mock(),
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            screenshot_encoding=encoding,
+            client=client,
+        )
+
+    tools = {tool.name: tool for tool in collection.call_args.args}
+    assert tools["computer"].screenshot_encoding is encoding
+
+
+async def test_loop_streaming_cancels_tools_when_stream_fails():
+    tool_use = BetaToolUseBlock(
+        type="tool_use", id="1", name="computer", input={"action": "test"}
+    )
+    tool_started = asyncio.Event()
+    tool_cancelled = False
+
+    class FailingStream:
+        response = mock.Mock()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def __aiter__(self):
+            yield mock.Mock(type="content_block_stop", content_block=tool_use)
+            await tool_started.wait()
+            raise RuntimeError("connection reset")
+
+    async def run_tool(**kwargs):
+        nonlocal tool_cancelled
+        tool_started.set()
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            tool_cancelled = True
+            raise
+
+    client = mock.Mock()
+    client.beta.messages.stream.return_value = FailingStream()
+    tool_collection = mock.AsyncMock()
+    tool_collection.run.side_effect = run_tool
+
+    with mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=tool_collection
+    ), pytest.raises(RuntimeError, match="connection reset"):
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=mock.Mock(),
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            stream=True,
+            client=client,
+        )
+
+    assert tool_cancelled
+
+
+async def test_loop_cancels_remaining_tools_when_collecting_results_fails():
+    client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
+    client.beta.messages.with_raw_response.create.return_value = mock.Mock()
+    client.beta.messages.with_raw_response.create.return_value.parse.return_value = (
+        mock.Mock(
+            spec=BetaMessage,
+            content=[
+                ToolUseBlock(
+                    type="tool_use", id=tool_use_id, name="bash", input={"n": n}
+                )
+                for n, tool_use_id in enumerate(["1", "2"])
+            ],
+        )
+    )
+    tool_cancelled = False
+
+    async def run_tool(*, name, tool_input):
+        nonlocal tool_cancelled
+        if tool_input["n"] == 0:
+            return ToolResult(output="first")
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            tool_cancelled = True
+            raise
+
+    tool_collection = mock.Mock()
+    tool_collection.run_many.side_effect = lambda calls, cancellation=None: [
+        asyncio.ensure_future(run_tool(name=name, tool_input=tool_input))
+        for name, tool_input in calls
+    ]
+    tool_output_callback = mock.Mock(side_effect=RuntimeError("callback failed"))
+
+    with pytest.raises(RuntimeError, match="callback failed"):
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=tool_output_callback,
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            tool_collection=tool_collection,
+            client=cast(AsyncClient, client),
+        )
+
+    assert tool_cancelled
+
+
+async def test_loop_records_cache_writes_of_successful_requests_only():
+    client = mock.Mock()
+    create = client.beta.messages.with_raw_response.create = mock.AsyncMock()
+    create.side_effect = APIConnectionError(
+        request=httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    )
+    image_eviction = CacheAlignedEviction()
+
+    async def run():
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=mock.Mock(),
+            tool_output_callback=mock.Mock(),
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+            image_eviction=image_eviction,
+            tool_collection=ToolCollection(),
+            client=cast(AsyncClient, client),
+        )
+
+    await run()
+    assert image_eviction.last_request_at is None
+
+    create.side_effect = None
+    create.return_value = mock.Mock()
+    create.return_value.parse.return_value = mock.Mock(
+        spec=BetaMessage, content=[TextBlock(type="text", text="Done!")]
+    )
+    await run()
+    assert image_eviction.last_request_at is not None
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from anthropic.types.beta import BetaUsage
+
+from computer_use_demo.metrics import SessionMetrics
+from computer_use_demo.tools import ToolResult
+
+
+async def test_turn_metrics_track_tools():
+    metrics = SessionMetrics()
+    turn = metrics.start_turn()
+    future: asyncio.Future[ToolResult] = asyncio.get_running_loop().create_future()
+    turn.track_tool("toolu_1", "computer", {"action": "screenshot"}, future)
+    await asyncio.sleep(0.01)
+    future.set_result(ToolResult(base64_image="aGVsbG8="))
+    await asyncio.sleep(0)
+
+    (call,) = turn.tools
+    assert call.action == "screenshot"
+    assert call.seconds >= 0.01
+    assert call.image_bytes == 5
+
+
+def test_session_metrics_totals_and_jsonl(tmp_path):
+    turns = []
+    metrics = SessionMetrics(
+        jsonl_path=tmp_path / "metrics.jsonl", on_turn=turns.append
+    )
+    for cache_read in (0, 300):
+        turn = metrics.start_turn()
+        turn.record_usage(
+            BetaUsage(
+                input_tokens=50,
+                cache_creation_input_tokens=50,
+                cache_read_input_tokens=cache_read,
+                output_tokens=10,
+            ),
+            api_seconds=1.5,
+        )
+        metrics.finish_turn(turn)
+
+    totals = metrics.totals()
+    assert totals["turns"] == 2
+    assert totals["output_tokens"] == 20
+    assert totals["api_seconds"] == 3.0
+    assert totals["cache_hit_ratio"] == 300 / 500
+    assert [t.turn for t in turns] == [1, 2]
+    lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line)["cache_read_input_tokens"] for line in lines] == [0, 300]
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import httpx
+
+from computer_use_demo import ratelimit
+from computer_use_demo.ratelimit import RateLimiter, TokenBucket
+
+
+def test_token_bucket_refills_at_limit_per_minute():
+    bucket = TokenBucket(limit=60, tokens=0, updated=0.0)
+    assert bucket.delay(3, now=0.0) == 3.0
+    assert bucket.delay(3, now=3.0) == 0.0
+    bucket.take(3, now=3.0)
+    assert bucket.tokens == 0
+    # larger than the bucket: waits for a full bucket only
+    assert bucket.delay(1_000, now=3.0) == 60.0
+    assert TokenBucket().delay(1_000_000, now=0.0) == 0.0
+
+
+def test_observe_syncs_buckets_and_retry_after():
+    limiter = RateLimiter()
+    limiter.observe(
+        httpx.Headers(
+            {
+                "anthropic-ratelimit-requests-limit": "50",
+                "anthropic-ratelimit-requests-remaining": "49",
+                "anthropic-ratelimit-input-tokens-limit": "40000",
+                "anthropic-ratelimit-input-tokens-remaining": "0",
+                "anthropic-ratelimit-output-tokens-limit": "8000",
+                "anthropic-ratelimit-output-tokens-remaining": "8000",
+            }
+        )
+    )
+    assert (limiter.requests.limit, limiter.requests.tokens) == (50, 49)
+    assert limiter.input_tokens.tokens == 0
+    assert limiter.output_tokens.limit == 8000
+    assert limiter.blocked_until == 0.0
+
+    limiter.observe(httpx.Headers({"retry-after": "7"}), 429)
+    assert 6 < limiter.blocked_until - time.monotonic() <= 7
+
+
+async def test_sessions_are_served_in_turn():
+    # 6000 requests per minute, starting empty: one request every 10ms
+    limiter = RateLimiter(requests_per_minute=6_000)
+    limiter.requests.tokens = 0
+    order: list[str] = []
+
+    async def request(session: str, n: int):
+        await limiter.acquire(session)
+        order.append(f"{session}{n}")
+
+    await asyncio.gather(
+        request("a", 1),
+        request("a", 2),
+        request("a", 3),
+        request("b", 1),
+        request("c", 1),
+    )
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert limiter.waiting == 0
+
+
+async def test_requests_in_scope_wait_for_retry_after():
+    limiter = RateLimiter()
+    attempts: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            return httpx.Response(429, headers={"retry-after-ms": "100"})
+        return httpx.Response(200)
+
+    async with httpx.AsyncClient(
+        transport=httpx.MockTransport(handler),
+        event_hooks={
+            "request": [ratelimit.before_request],
+            "response": [ratelimit.after_response],
+        },
+    ) as client:
+        with limiter.request("a"):
+            assert (await client.get("https://api.example")).status_code == 429
+            assert (await client.get("https://api.example")).status_code == 200
+    assert attempts[1] - attempts[0] >= 0.09
@@ -0,0 +1,102 @@
+from typing import Any, cast
+
+import pytest
+
+from computer_use_demo import replay
+from computer_use_demo.clients import AsyncClient
+from computer_use_demo.loop import APIProvider, sampling_loop
+from computer_use_demo.replay import (
+    RecordedToolCall,
+    RecordedTurn,
+    Recording,
+    SessionRecorder,
+)
+
+TOOLS = [{"name": "bash", "type": "bash_20250124"}]
+
+
+def message(content: list[dict[str, Any]], stop_reason: str) -> dict[str, Any]:
+    return {
+        "id": "msg",
+        "type": "message",
+        "role": "assistant",
+        "model": "test-model",
+        "content": content,
+        "stop_reason": stop_reason,
+        "usage": {"input_tokens": 10, "output_tokens": 5},
+    }
+
+
+def recording() -> Recording:
+    return Recording(
+        model="test-model",
+        tools=TOOLS,
+        messages=[{"role": "user", "content": "List files"}],
+        turns=[
+            RecordedTurn(
+                api_seconds=0.01,
+                response=message(
+                    [
+                        {
+                            "type": "tool_use",
+                            "id": "toolu_1",
+                            "name": "bash",
+                            "input": {"command": "ls"},
+                        }
+                    ],
+                    "tool_use",
+                ),
+                tools=[
+                    RecordedToolCall(
+                        tool_use_id="toolu_1",
+                        name="bash",
+                        input={"command": "ls"},
+                        seconds=0.02,
+                        result={"output": "a.txt"},
+                    )
+                ],
+            ),
+            RecordedTurn(
+                api_seconds=0.01,
+                response=message([{"type": "text", "text": "Done"}], "end_turn"),
+            ),
+        ],
+    )
+
+
+@pytest.mark.parametrize("stream", [False, True])
+async def test_replay_can_be_recorded_again(tmp_path, stream):
+    path = tmp_path / "recording.jsonl"
+    recording().dump(path)
+    session = replay.Replay.from_recording(Recording.load(path), speed=0)
+    recorder = SessionRecorder(tmp_path / "again.jsonl")
+
+    messages = await sampling_loop(
+        model="test-model",
+        provider=APIProvider.ANTHROPIC,
+        system_prompt_suffix="",
+        messages=session.messages(),
+        output_callback=replay.output_callback,
+        tool_output_callback=recorder.wrap_tool_output(replay.tool_output_callback),
+        api_response_callback=recorder.wrap_api_response(replay.api_response_callback),
+        api_key="",
+        tool_version="computer_use_20250124",
+        stream=stream,
+        metrics=recorder.metrics,
+        tool_collection=session.tool_collection,
+        client=cast(AsyncClient, session.client),
+    )
+
+    assert [m["role"] for m in messages] == ["user", "assistant", "user", "assistant"]
+    tool_result = cast(list[Any], messages[2]["content"])[0]
+    assert tool_result["content"][0]["text"] == "a.txt"
+    assert session.client.requests == 2
+
+    again = Recording.load(tmp_path / "again.jsonl")
+    assert again.model == "test-model"
+    assert again.tools == TOOLS
+    assert [turn.response["content"] for turn in again.turns] == [
+        turn.response["content"] for turn in recording().turns
+    ]
+    assert again.turns[0].tools[0].result == {"output": "a.txt"}
+    assert again.turns[0].tools[0].input == {"command": "ls"}
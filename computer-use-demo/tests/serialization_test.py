@@ -0,0 +1,104 @@
+import json
+
+import httpx
+
+from computer_use_demo.clients import PreSerializingAnthropic
+from computer_use_demo.serialization import MessageSerializer
+
+
+def history() -> list:
+    return [
+        {"role": "user", "content": "Open the browser"},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "tool_use", "id": "toolu_1", "name": "computer", "input": {}}
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": "toolu_1",
+                    "content": [{"type": "text", "text": "done"}],
+                }
+            ],
+        },
+    ]
+
+
+def test_serializer_only_encodes_new_and_changed_messages():
+    serializer = MessageSerializer()
+    messages = history()
+    serializer.serialize(messages)
+    assert serializer.encoded == 3
+
+    serializer.serialize(messages)
+    assert serializer.encoded == 3
+
+    messages.append({"role": "assistant", "content": [{"type": "text", "text": "ok"}]})
+    messages[2]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+    serializer.serialize(messages)
+    assert serializer.encoded == 5
+
+    messages[2]["content"][-1]["content"] = []
+    serialized = serializer.serialize(messages)
+    assert serializer.encoded == 6
+    assert json.loads(serialized.render({"model": "m"})) == {
+        "messages": messages,
+        "model": "m",
+    }
+
+
+def test_serializer_materializes_on_encode():
+    serializer = MessageSerializer(
+        lambda messages: [{**message, "role": "user"} for message in messages]
+    )
+    serialized = serializer.serialize(history())
+    assert json.loads(serialized.render({}))["messages"][1]["role"] == "user"
+
+
+async def test_client_sends_serialized_messages():
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_1",
+                "type": "message",
+                "role": "assistant",
+                "model": "model",
+                "content": [],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": 1, "output_tokens": 1},
+            },
+        )
+
+    client = PreSerializingAnthropic(
+        api_key="key",
+        base_url="https://api.anthropic.test",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    messages = history()
+    await client.beta.messages.create(
+        max_tokens=10,
+        messages=MessageSerializer().serialize(messages),  # type: ignore
+        model="model",
+        betas=["computer-use-2025-01-24"],
+        extra_body={"thinking": {"type": "enabled", "budget_tokens": 5}},
+    )
+
+    (request,) = requests
+    assert request.headers["anthropic-beta"] == "computer-use-2025-01-24"
+    assert int(request.headers["content-length"]) == len(request.content)
+    assert json.loads(request.content) == {
+        "messages": messages,
+        "max_tokens": 10,
+        "model": "model",
+        "thinking": {"type": "enabled", "budget_tokens": 5},
+    }
+    await client.close()
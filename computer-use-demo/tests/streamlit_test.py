@@ -1,10 +1,15 @@
+import gc
+import time
 from unittest import mock
 
+import httpx
 import pytest
 from anthropic.types import TextBlockParam
 from streamlit.testing.v1 import AppTest
 
-from computer_use_demo.streamlit import Sender
+from computer_use_demo.clients import CLIENT_REGISTRY, APIProvider
+from computer_use_demo.streamlit import Sender, SessionLoop
+from computer_use_demo.tools import ScreenshotEncoding
 
 
 @pytest.fixture
@@ -18,6 +23,8 @@ def test_streamlit(streamlit_app: AppTest):
     with mock.patch("computer_use_demo.loop.sampling_loop") as patch:
         streamlit_app.chat_input[0].set_value("Hello").run()
         assert patch.called
+        assert patch.call_args.kwargs["screenshot_encoding"] == ScreenshotEncoding()
+        assert patch.call_args.kwargs["stream"] is True
         assert patch.call_args.kwargs["messages"] == [
             {
                 "role": Sender.USER,
@@ -25,3 +32,80 @@ def test_streamlit(streamlit_app: AppTest):
             }
         ]
         assert not streamlit_app.exception
+
+
+def test_streamlit_keeps_event_loop_across_reruns(streamlit_app: AppTest):
+    streamlit_app.run()
+    session_loop = streamlit_app.session_state["event_loop"]
+    streamlit_app.run()
+    assert streamlit_app.session_state["event_loop"] is session_loop
+    assert not session_loop.loop.is_closed()
+
+
+def test_session_loop_closes_its_clients_when_dropped():
+    session_loop = SessionLoop()
+
+    async def get_client():
+        return CLIENT_REGISTRY.get(APIProvider.ANTHROPIC, api_key="key")
+
+    client = session_loop.run(get_client())
+    assert session_loop.run(get_client()) is client
+    loop = session_loop.loop
+
+    del session_loop
+    gc.collect()
+    deadline = time.monotonic() + 5
+    while not loop.is_closed() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert loop.is_closed()
+    assert client._client.is_closed
+    assert loop not in CLIENT_REGISTRY._entries
+
+
+def test_streamlit_keeps_no_screenshots_in_stored_requests(streamlit_app: AppTest):
+    screenshot = "iVBORw0KGgo" + "A" * 1000
+    body = {
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": "toolu_1",
+                        "content": [
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": "image/png",
+                                    "data": screenshot,
+                                },
+                            }
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+    def sampling_loop(*, messages, api_response_callback, **kwargs):
+        request = httpx.Request(
+            "POST", "https://api.anthropic.com/v1/messages", json=body
+        )
+        response = httpx.Response(200, json={"content": []}, request=request)
+        api_response_callback(request, response, None)
+        return messages
+
+    streamlit_app.run()
+    streamlit_app.text_input[1].set_value("sk-ant-0000000000000").run()
+    with mock.patch("computer_use_demo.loop.sampling_loop", side_effect=sampling_loop):
+        for turn in range(3):
+            streamlit_app.chat_input[0].set_value(f"turn {turn}").run()
+
+    exchanges = list(streamlit_app.session_state["responses"].values())
+    assert len(exchanges) == 3
+    for request, response in exchanges:
+        assert screenshot not in request.read().decode()
+        assert response.request is request
+        assert b'"type": "image_ref"' in request.read()
+    assert not streamlit_app.exception
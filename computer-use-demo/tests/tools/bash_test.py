@@ -1,11 +1,22 @@
+import asyncio
+import re
+import time
+
 import pytest
 
-from computer_use_demo.tools.bash import BashTool20241022, BashTool20250124, ToolError
+from computer_use_demo.tools.bash import (
+    BashSessionPool,
+    BashTool20241022,
+    BashTool20250124,
+    ToolError,
+)
 
 
 @pytest.fixture(params=[BashTool20241022, BashTool20250124])
-def bash_tool(request):
-    return request.param()
+async def bash_tool(request):
+    tool = request.param()
+    yield tool
+    await tool.pool.aclose()
 
 
 @pytest.mark.asyncio
@@ -33,8 +44,8 @@ async def test_bash_tool_no_command(bash_tool):
 
 @pytest.mark.asyncio
 async def test_bash_tool_session_creation(bash_tool):
-    result = await bash_tool(command="echo 'Session created'")
-    assert bash_tool._session is not None
+    result = await bash_tool(command="printf 'Session created'")
+    assert bash_tool.pool.names == ["default"]
     assert "Session created" in result.output
 
 
@@ -58,14 +69,308 @@ async def test_bash_tool_non_zero_exit(bash_tool):
     result = await bash_tool(command="bash -c 'exit 1'")
     assert result.error.strip() == ""
     assert result.output.strip() == ""
+    assert re.fullmatch(r"exit status 1 after \d+\.\d\ds", result.system)
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_timeout_interrupts_command(bash_tool):
+    await bash_tool(command="cd /tmp && x=kept")
+    bash_tool.pool._sessions[
+        "default"
+    ]._timeout = 0.1  # Set a very short timeout for testing
+    started = time.perf_counter()
+    result = await bash_tool(command="echo started; sleep 10")
+    assert time.perf_counter() - started < 1
+    assert result.output == "started"
+    assert re.fullmatch(
+        r"command timed out after 0\.1 seconds and was interrupted "
+        r"\(exit status 130 after 0\.\d\ds\)",
+        result.system,
+    )
+    # the shell survives with its state
+    result = await bash_tool(command="echo $x $PWD", timeout=5)
+    assert result.output == "kept /tmp"
+    assert re.fullmatch(r"exit status 0 after \d+\.\d\ds", result.system)
 
 
 @pytest.mark.asyncio
-async def test_bash_tool_timeout(bash_tool):
-    await bash_tool(command="echo 'Hello, World!'")
-    bash_tool._session._timeout = 0.1  # Set a very short timeout for testing
+async def test_bash_tool_timeout_of_uninterruptible_command(bash_tool):
+    await bash_tool(command="true")
+    bash_tool.pool._sessions["default"]._interrupt_grace = 0.1
     with pytest.raises(
         ToolError,
         match="timed out: bash has not returned in 0.1 seconds and must be restarted",
     ):
-        await bash_tool(command="sleep 1")
+        await bash_tool(command="trap '' INT; sleep 10", timeout=0.1)
+    # later commands report the timeout that fired, not the default one
+    with pytest.raises(ToolError, match="not returned in 0.1 seconds"):
+        await bash_tool(command="true")
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_cancelled_command_is_killed(bash_tool, tmp_path):
+    pid_file = tmp_path / "pid"
+    task = asyncio.ensure_future(
+        bash_tool(command=f"sleep 30 & echo $! > {pid_file}; wait")
+    )
+    for _ in range(500):
+        if pid_file.exists() and pid_file.read_text().strip():
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert not await _alive(int(pid_file.read_text()))
+    # the next command gets a fresh shell
+    result = await bash_tool(command="echo 'after cancel'")
+    assert result.output.strip() == "after cancel"
+
+
+async def _alive(pid: int) -> bool:
+    """Whether `pid` is still running, allowing a moment for it to be reaped."""
+    for _ in range(100):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # zombies are dead, only waiting for their parent
+                if f.read().rsplit(")", 1)[1].split()[0] == "Z":
+                    return False
+        except FileNotFoundError:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_returns_as_soon_as_command_finishes(bash_tool):
+    await bash_tool(command="true")
+    started = time.perf_counter()
+    result = await bash_tool(command="echo fast")
+    assert time.perf_counter() - started < 0.1
+    assert result.output == "fast"
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_large_output_and_stderr(bash_tool):
+    result = await bash_tool(
+        command="head -c 1000000 /dev/zero | tr '\\0' a; echo; echo oops >&2"
+    )
+    assert result.output and result.error == "oops"
+    head, note, tail = result.output.split("\n")
+    # the tail loses the trailing newline like any output
+    assert head == "a" * 8000 and tail == "a" * 7999
+    spill_path = note.rsplit(" ", 1)[1].rstrip(">")
+    assert note.startswith("<output clipped: 984001 characters omitted")
+    with open(spill_path) as f:
+        assert f.read() == "a" * 1_000_000 + "\n"
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_streams_output_to_callback():
+    chunks: list[tuple[str, str]] = []
+    tool = BashTool20250124(
+        on_output=lambda stream, text: chunks.append((stream, text))
+    )
+    result = await tool(command="echo out; echo err >&2")
+    await tool.pool.aclose()
+    assert result.output == "out"
+    assert "".join(text for stream, text in chunks if stream == "stdout") == "out\n"
+    assert "".join(text for stream, text in chunks if stream == "stderr") == "err\n"
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_exit(bash_tool):
+    result = await bash_tool(command="exit 3")
+    assert result.error == "bash has exited with returncode 3"
+    assert result.system == "tool must be restarted"
+
+
+@pytest.mark.asyncio
+async def test_bash_session_pool_named_sessions_run_concurrently():
+    pool = BashSessionPool()
+    tool = BashTool20250124(pool=pool)
+    await tool(command="x=default")
+    async with pool.use("build") as build:
+        await build.run("x=build")
+
+    async def run(name: str, command: str):
+        async with pool.use(name) as session:
+            return await session.run(command)
+
+    started = time.perf_counter()
+    slow, quick = await asyncio.gather(
+        run("build", "sleep 0.5; echo $x"), tool(command="echo $x")
+    )
+    assert (slow.output, quick.output) == ("build", "default")
+    assert time.perf_counter() - started < 0.9
+    await pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bash_session_pool_restarts_into_warm_shell():
+    pool = BashSessionPool()
+    tool = BashTool20250124(pool=pool)
+    await tool(command="x=1")
+    await pool.prewarm()
+    assert pool.size == 2
+
+    started = time.perf_counter()
+    await tool(restart=True)
+    result = await tool(command="echo ${x:-unset}")
+    assert time.perf_counter() - started < 0.1
+    assert result.output == "unset"
+    await pool.aclose()
+    assert pool.size == 0
+
+
+@pytest.mark.asyncio
+async def test_bash_session_pool_evicts_idle_sessions():
+    pool = BashSessionPool(warm=0, max_sessions=2, idle_timeout=0.1)
+    async with pool.use("a"):
+        pass
+    async with pool.use("b"):
+        # at the limit, the least recently used idle session makes room
+        async with pool.use("c"):
+            assert pool.names == ["b", "c"]
+            with pytest.raises(ToolError, match="all 2 shells are in use"):
+                async with pool.use("d"):
+                    pass
+    async with pool.use():
+        pass
+    # releases share a single timer
+    reaper = pool._reaper
+    async with pool.use("b"):
+        pass
+    assert pool._reaper is reaper
+    await asyncio.sleep(0.15)
+    # named sessions are stopped once idle, the default one is kept
+    assert pool.names == ["default"]
+    await pool.aclose()
+
+
+@pytest.fixture
+async def pty_tool():
+    tool = BashTool20250124(pty=True)
+    yield tool
+    await tool.pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_pty_streams_lines_and_strips_escapes():
+    chunks: list[tuple[float, str]] = []
+    tool = BashTool20250124(
+        pty=True,
+        on_output=lambda stream, text: chunks.append((time.perf_counter(), text)),
+    )
+    # python block-buffers its output into a pipe, but not into a terminal
+    started = time.perf_counter()
+    result = await tool(
+        command="python3 -c 'import time; print(1); time.sleep(0.5); print(2)'"
+    )
+    assert result.output == "1\n2"
+    assert chunks[0][1].startswith("1") and chunks[0][0] - started < 0.4
+
+    result = await tool(command="tty; printf '\\033[1;31mred\\033[0m\\n'")
+    terminal, text = result.output.split("\n")
+    assert terminal.startswith("/dev/pts/") and text == "red"
+    await tool.pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_pty_interrupts_command_waiting_for_input(pty_tool):
+    await pty_tool(command="x=kept")
+    pty_tool.pool._sessions["default"]._prompt_delay = 0.2
+    started = time.perf_counter()
+    result = await pty_tool(command="python3 -c 'input(\"Password: \")'")
+    assert time.perf_counter() - started < 1
+    assert re.fullmatch(
+        r"command was waiting for input at 'Password:' and was interrupted "
+        r"\(exit status 130 after 0\.\d\ds\)",
+        result.system,
+    )
+    # output that only pauses is left alone
+    result = await pty_tool(command="echo -n 'Loading: '; sleep 0.5; echo done $x")
+    assert result.output == "Loading: done kept"
+    # the pause is part of the reported time
+    seconds = float(re.fullmatch(r"exit status 0 after (\d+\.\d\d)s", result.system)[1])
+    assert seconds >= 0.5
+
+
+@pytest.mark.asyncio
+async def test_bash_session_pool_keeps_default_session_and_limit():
+    pool = BashSessionPool(warm=0, max_sessions=2)
+    async with pool.use():
+        pass
+    async with pool.use("a"):
+        pass
+    # the default session is the least recently used, but is never evicted
+    async with pool.use("b"):
+        assert pool.names == ["default", "b"]
+    async with pool.use("a"):
+        pass
+    await pool.aclose()
+
+    # spares that are still starting count towards the limit
+    pool = BashSessionPool(warm=1, max_sessions=2)
+    async with pool.use("a"):
+        pass
+    async with pool.use("b"):
+        assert pool.size <= 2
+    await pool.prewarm()
+    assert pool.size <= 2
+    await pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bash_session_pool_starts_a_new_name_once():
+    pool = BashSessionPool(warm=0)
+
+    async def run(command: str):
+        async with pool.use("build") as session:
+            return session, await session.run(command)
+
+    (first, a), (second, b) = await asyncio.gather(run("echo a"), run("echo b"))
+    assert first is second
+    assert (a.output, b.output) == ("a", "b")
+    assert pool.size == 1
+    await pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_read_only_commands():
+    tool = BashTool20250124()
+    for command in ["ls -la /tmp", "cat a.txt | grep -c 'x y' | wc -l", "pwd"]:
+        assert tool.is_read_only(command)
+        assert tool.resource_access({"command": command}).read_only
+    for command in [
+        "rm -rf /tmp/x",
+        "ls > out.txt",
+        "cat a; rm a",
+        "ls && touch a",
+        "echo $(touch a)",
+        "grep 'x|y' a",
+        "ls ||",
+    ]:
+        assert not tool.is_read_only(command)
+        assert tool.resource_access({"command": command}).barrier
+    assert tool.resource_access({"command": "ls", "restart": True}).barrier
+    assert not BashTool20250124(read_only_commands=()).is_read_only("ls")
+
+
+@pytest.mark.asyncio
+async def test_bash_tool_read_only_command_runs_outside_the_shell(tmp_path):
+    (tmp_path / "a.txt").write_text("one\ntwo\n")
+    tool = BashTool20250124()
+    # no shell is started for a read-only command
+    result = await tool(command=f"cat {tmp_path}/a.txt | wc -l")
+    assert result.output == "2"
+    assert re.fullmatch(r"exit status 0 after \d+\.\d\ds", result.system)
+    assert tool.pool.names == []
+    # but it sees the shell's working directory
+    await tool(command=f"cd {tmp_path}")
+    result = await tool(command="cat a.txt | head -1")
+    assert result.output == "one"
+    result = await tool(command="cat missing.txt")
+    assert "No such file" in result.error
+    assert result.system.startswith("exit status 1 after ")
+    await tool.pool.aclose()
@@ -0,0 +1,214 @@
+import asyncio
+import time
+from typing import Any
+from unittest.mock import patch
+
+from computer_use_demo.cancellation import CancellationToken
+from computer_use_demo.tools.base import (
+    BaseAnthropicTool,
+    ResourceAccess,
+    ToolCancelled,
+    ToolError,
+    ToolResult,
+)
+from computer_use_demo.tools.bash import BashTool20250124
+from computer_use_demo.tools.collection import ToolCollection
+from computer_use_demo.tools.computer import ComputerTool20250124
+from computer_use_demo.tools.edit import EditTool20250124
+
+
+class RecordingTool(BaseAnthropicTool):
+    """A tool that records when each call starts and finishes."""
+
+    def __init__(self, name: str, log: list[str]):
+        self.name = name
+        self.log = log
+
+    def to_params(self) -> Any:
+        return {"name": self.name, "type": "custom"}
+
+    def resource_access(self, tool_input: dict[str, Any]) -> ResourceAccess:
+        return ResourceAccess(
+            resource=tool_input.get("resource", self.name),
+            read_only=tool_input.get("read_only", False),
+            barrier=tool_input.get("barrier", False),
+        )
+
+    async def __call__(self, *, call: str, delay: float = 0.01, **kwargs):
+        self.log.append(f"start {call}")
+        await asyncio.sleep(delay)
+        self.log.append(f"end {call}")
+        if kwargs.get("fail"):
+            raise ToolError(f"{call} failed")
+        return ToolResult(output=call)
+
+
+async def run_all(collection: ToolCollection, *calls: dict[str, Any]):
+    return await asyncio.gather(
+        *(collection.run(name="tool", tool_input=call) for call in calls)
+    )
+
+
+async def test_read_only_calls_run_concurrently():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    results = await run_all(
+        collection,
+        {"call": "a", "read_only": True},
+        {"call": "b", "read_only": True},
+    )
+    assert [result.output for result in results] == ["a", "b"]
+    assert log[:2] == ["start a", "start b"]
+
+
+async def test_mutating_calls_are_serialized_in_order():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    results = await run_all(
+        collection,
+        {"call": "a", "read_only": True},
+        {"call": "b", "delay": 0.02},
+        {"call": "c", "read_only": True},
+        {"call": "d"},
+    )
+    assert [result.output for result in results] == ["a", "b", "c", "d"]
+    assert log == [
+        "start a",
+        "end a",
+        "start b",
+        "end b",
+        "start c",
+        "end c",
+        "start d",
+        "end d",
+    ]
+
+
+async def test_different_resources_do_not_conflict():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    await run_all(
+        collection,
+        {"call": "a", "resource": "file:/a"},
+        {"call": "b", "resource": "file:/b"},
+    )
+    assert log[:2] == ["start a", "start b"]
+
+
+async def test_barrier_is_ordered_against_every_resource():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    await run_all(
+        collection,
+        {"call": "a", "resource": "file:/a"},
+        {"call": "b", "resource": "display", "read_only": True},
+        {"call": "c", "barrier": True},
+        {"call": "d", "resource": "file:/d", "read_only": True},
+    )
+    assert log[:2] == ["start a", "start b"]
+    assert set(log[2:4]) == {"end a", "end b"}
+    assert log[4:] == ["start c", "end c", "start d", "end d"]
+
+
+async def test_bash_command_is_ordered_before_editor_view(tmp_path):
+    path = tmp_path / "file.txt"
+    bash = BashTool20250124()
+    collection = ToolCollection(bash, EditTool20250124())
+    futures = collection.run_many(
+        [
+            ("bash", {"command": f"sleep 0.3; echo hi > {path}"}),
+            ("str_replace_editor", {"command": "view", "path": str(path)}),
+        ]
+    )
+    results = [await future for future in futures]
+    await bash.pool.aclose()
+    assert results[1].error is None
+    assert results[1].output and "hi" in results[1].output
+
+
+async def test_read_only_bash_commands_run_next_to_a_screenshot(tmp_path):
+    bash = BashTool20250124(read_only_commands={"sleep", "pwd"})
+    await bash(command=f"cd {tmp_path}")
+    computer = ComputerTool20250124()
+
+    async def screenshot():
+        await asyncio.sleep(0.5)
+        return ToolResult(base64_image="screenshot")
+
+    collection = ToolCollection(bash, computer)
+    with patch.object(computer, "screenshot", side_effect=screenshot):
+        started = time.perf_counter()
+        futures = collection.run_many(
+            [
+                ("bash", {"command": "sleep 0.5"}),
+                ("computer", {"action": "screenshot"}),
+                ("bash", {"command": "sleep 0.5 | pwd"}),
+            ]
+        )
+        results = [await future for future in futures]
+        elapsed = time.perf_counter() - started
+    await bash.pool.aclose()
+    assert elapsed < 1
+    assert results[1].base64_image == "screenshot"
+    # read-only commands run in the shell's working directory
+    assert results[2].output == str(tmp_path)
+
+
+async def test_failed_call_releases_resource():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    results = await run_all(collection, {"call": "a", "fail": True}, {"call": "b"})
+    assert results[0].error == "a failed"
+    assert results[1].output == "b"
+
+
+class FusingTool(RecordingTool):
+    def can_fuse(self, tool_input: dict[str, Any]) -> bool:
+        return tool_input.get("fusable", False)
+
+    async def run_fused(self, tool_inputs: list[dict[str, Any]]) -> list[ToolResult]:
+        self.log.append("fused " + ",".join(i["call"] for i in tool_inputs))
+        return [ToolResult(output=i["call"]) for i in tool_inputs]
+
+
+async def test_run_many_fuses_consecutive_calls():
+    log: list[str] = []
+    collection = ToolCollection(FusingTool("tool", log))
+    futures = collection.run_many(
+        [
+            ("tool", {"call": "a", "fusable": True}),
+            ("tool", {"call": "b", "fusable": True}),
+            ("tool", {"call": "c"}),
+            ("tool", {"call": "d", "fusable": True}),
+        ]
+    )
+    results = [await future for future in futures]
+    assert [result.output for result in results] == ["a", "b", "c", "d"]
+    assert log == ["fused a,b", "start c", "end c", "start d", "end d"]
+
+
+async def test_cancellation_stops_running_and_queued_calls():
+    log: list[str] = []
+    collection = ToolCollection(RecordingTool("tool", log))
+    token = CancellationToken()
+    calls = [
+        asyncio.ensure_future(
+            collection.run(
+                name="tool",
+                tool_input={"call": call, "delay": 10},
+                cancellation=token,
+            )
+        )
+        for call in ("a", "b")
+    ]
+    await asyncio.sleep(0.01)
+    token.cancel()
+    results = await asyncio.wait_for(asyncio.gather(*calls), timeout=1)
+
+    assert all(isinstance(result, ToolCancelled) for result in results)
+    # b was still queued behind a and never started
+    assert log == ["start a"]
+    result = await collection.run(
+        name="tool", tool_input={"call": "c"}, cancellation=token
+    )
+    assert isinstance(result, ToolCancelled)
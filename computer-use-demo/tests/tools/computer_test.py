@@ -1,13 +1,22 @@
+import asyncio
+import base64
+import io
 from unittest.mock import AsyncMock, patch
 
 import pytest
+from PIL import Image
 
+from computer_use_demo.tools.base import ToolFailure
 from computer_use_demo.tools.computer import (
+    FUSED_ACTION_DONE,
     ComputerTool20241022,
     ComputerTool20250124,
+    ImageFormat,
     ScalingSource,
+    ScreenshotEncoding,
     ToolError,
     ToolResult,
+    encode_image,
 )
 
 
@@ -22,7 +31,7 @@ async def test_computer_tool_mouse_move(computer_tool):
         mock_shell.return_value = ToolResult(output="Mouse moved")
         result = await computer_tool(action="mouse_move", coordinate=[100, 200])
         mock_shell.assert_called_once_with(
-            f"{computer_tool.xdotool} mousemove --sync 100 200"
+            f"{computer_tool.xdotool} mousemove --sync 100 200", wait_for_change=None
         )
         assert result.output == "Mouse moved"
 
@@ -138,3 +147,220 @@ async def test_computer_tool_missing_coordinate(computer_tool):
 async def test_computer_tool_missing_text(computer_tool):
     with pytest.raises(ToolError, match="text is required for type"):
         await computer_tool(action="type")
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_can_fuse(computer_tool):
+    assert computer_tool.can_fuse({"action": "mouse_move", "coordinate": [1, 2]})
+    assert computer_tool.can_fuse({"action": "key", "text": "Return"})
+    assert not computer_tool.can_fuse({"action": "screenshot"})
+    assert not computer_tool.can_fuse({"action": "mouse_move"})
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_run_fused(computer_tool):
+    done = f"{FUSED_ACTION_DONE}\n"
+    with patch.object(computer_tool, "shell", new_callable=AsyncMock) as mock_shell:
+        mock_shell.return_value = ToolResult(
+            output=done * 4, base64_image="base64_screenshot"
+        )
+        results = await computer_tool.run_fused(
+            [
+                {"action": "mouse_move", "coordinate": [100, 200]},
+                {"action": "left_click_drag", "coordinate": [10, 20]},
+                {"action": "type", "text": "hi"},
+                {"action": "key", "text": "Return"},
+            ]
+        )
+        xdotool = computer_tool.xdotool
+        mock_shell.assert_called_once_with(
+            f"{xdotool} mousemove --sync 100 200 && echo '{FUSED_ACTION_DONE}'"
+            f" && {xdotool} mousedown 1 mousemove --sync 10 20 mouseup 1"
+            f" && echo '{FUSED_ACTION_DONE}'"
+            f" && {xdotool} type --delay 12 -- hi && echo '{FUSED_ACTION_DONE}'"
+            f" && {xdotool} key -- Return && echo '{FUSED_ACTION_DONE}'",
+            wait_for_change=None,
+        )
+        assert len(results) == 4
+        assert all(result.base64_image is None for result in results[:3])
+        assert "mouse_move done" in results[0].output
+        assert results[3] == ToolResult(base64_image="base64_screenshot")
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_run_fused_reports_failing_action(computer_tool, tmp_path):
+    xdotool = tmp_path / "xdotool"
+    xdotool.write_text(
+        '#!/bin/sh\n[ "$1" = ok ] || { echo "cannot $1" >&2; exit 1; }\n'
+    )
+    xdotool.chmod(0o755)
+    computer_tool.xdotool = str(xdotool)
+    computer_tool._in_process_capture = False
+    computer_tool._screenshot_delay = 0
+    with (
+        patch.object(
+            computer_tool,
+            "xdotool_commands",
+            side_effect=lambda action, **kwargs: [action],
+        ),
+        patch.object(computer_tool, "screenshot", new_callable=AsyncMock),
+    ):
+        results = await computer_tool.run_fused(
+            [{"action": "ok"}, {"action": "fail"}, {"action": "ok"}]
+        )
+    assert "ok done" in results[0].output
+    assert isinstance(results[1], ToolFailure)
+    assert results[1].error == "cannot fail\n"
+    assert isinstance(results[2], ToolFailure)
+    assert results[2].error == "ok was not run because fail failed"
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_screenshot_in_process(computer_tool):
+    computer_tool.width = 1920
+    computer_tool.height = 1080
+    with (
+        patch(
+            "computer_use_demo.tools.computer.ImageGrab.grab",
+            return_value=Image.new("RGB", (1920, 1080)),
+        ) as mock_grab,
+        patch.object(computer_tool, "shell", new_callable=AsyncMock) as mock_shell,
+    ):
+        result = await computer_tool.screenshot()
+        mock_grab.assert_called_once_with(xdisplay=":1")
+        mock_shell.assert_not_called()
+        image = Image.open(io.BytesIO(base64.b64decode(result.base64_image)))
+        assert image.format == "PNG"
+        assert image.size == (1366, 768)
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_screenshot_falls_back_to_subprocess(computer_tool):
+    with (
+        patch(
+            "computer_use_demo.tools.computer.ImageGrab.grab",
+            side_effect=OSError("Pillow was built without XCB support"),
+        ) as mock_grab,
+        patch.object(computer_tool, "shell", new_callable=AsyncMock) as mock_shell,
+    ):
+        mock_shell.return_value = ToolResult()
+        with pytest.raises(ToolError, match="Failed to take screenshot"):
+            await computer_tool.screenshot()
+        assert mock_shell.called
+        # the next screenshot skips in-process capture until it is due for a retry
+        with pytest.raises(ToolError, match="Failed to take screenshot"):
+            await computer_tool.screenshot()
+        assert mock_grab.call_count == 1
+
+        computer_tool._in_process_retry_after = 0
+        mock_grab.side_effect = None
+        mock_grab.return_value = Image.new("RGB", (1366, 768))
+        mock_shell.reset_mock()
+        result = await computer_tool.screenshot()
+        assert result.base64_image
+        mock_shell.assert_not_called()
+        assert computer_tool._in_process_failed_at is None
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_settles_early_on_stable_screen(computer_tool):
+    computer_tool._screenshot_delay = 5
+    computer_tool._settle_window = 0.05
+    computer_tool._settle_interval = 0.01
+    with patch.object(
+        computer_tool, "_grab_signature", return_value=b"frame"
+    ) as mock_grab:
+        await asyncio.wait_for(computer_tool.wait_for_settle(), timeout=1)
+        assert mock_grab.call_count >= 2
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_settle_is_capped(computer_tool):
+    computer_tool._screenshot_delay = 0.1
+    computer_tool._settle_interval = 0.01
+    frames = (str(i).encode() for i in range(1000))
+    with patch.object(
+        computer_tool, "_grab_signature", side_effect=lambda bbox: next(frames)
+    ):
+        await asyncio.wait_for(computer_tool.wait_for_settle(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_settle_without_capture_sleeps(computer_tool):
+    computer_tool._in_process_capture = False
+    with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+        await computer_tool.wait_for_settle()
+        mock_sleep.assert_called_once()
+        assert mock_sleep.call_args[0][0] == pytest.approx(2.0, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_wait_for_change(computer_tool):
+    computer_tool._settle_interval = 0.01
+    frames = iter([b"before", b"before", b"after"])
+    with patch.object(
+        computer_tool, "_grab_signature", side_effect=lambda bbox: next(frames)
+    ) as mock_grab:
+        assert await computer_tool.wait_for_change((0, 0, 10, 10))
+        assert mock_grab.call_args[0][0] == (0, 0, 10, 10)
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_screenshots_once_change_region_changes(computer_tool):
+    computer_tool.change_region = (0, 0, 10, 10)
+    computer_tool._settle_interval = 0.01
+    frames = iter([b"before", b"before", b"after"])
+    with (
+        patch(
+            "computer_use_demo.tools.computer.run",
+            new_callable=AsyncMock,
+            return_value=(0, "", ""),
+        ) as mock_run,
+        patch.object(
+            computer_tool, "_grab_signature", side_effect=lambda bbox: next(frames)
+        ) as mock_grab,
+        patch.object(computer_tool, "wait_for_settle") as mock_settle,
+        patch.object(
+            computer_tool,
+            "screenshot",
+            new_callable=AsyncMock,
+            return_value=ToolResult(base64_image="base64_screenshot"),
+        ),
+    ):
+        result = await computer_tool(action="left_click")
+    mock_run.assert_called_once_with(f"{computer_tool.xdotool} click 1")
+    assert mock_grab.call_count == 3
+    assert all(call.args[0] == (0, 0, 10, 10) for call in mock_grab.call_args_list)
+    mock_settle.assert_not_called()
+    assert result.base64_image == "base64_screenshot"
+
+
+@pytest.mark.parametrize(
+    "encoding,media_type,mode",
+    [
+        (ScreenshotEncoding(), "image/png", "RGB"),
+        (ScreenshotEncoding(colors=16), "image/png", "P"),
+        (ScreenshotEncoding(grayscale=True, png_compress_level=1), "image/png", "L"),
+        (ScreenshotEncoding(format=ImageFormat.JPEG, quality=50), "image/jpeg", "RGB"),
+        (ScreenshotEncoding(format=ImageFormat.WEBP), "image/webp", "RGB"),
+    ],
+)
+def test_encode_image(encoding, media_type, mode):
+    data = encode_image(Image.new("RGBA", (64, 48), (10, 120, 200, 255)), encoding)
+    result = ToolResult(base64_image=base64.b64encode(data).decode())
+    assert result.image_media_type == media_type
+    assert result.image_size == len(data)
+    assert Image.open(io.BytesIO(data)).mode == mode
+
+
+@pytest.mark.asyncio
+async def test_computer_tool_screenshot_encoding():
+    computer_tool = ComputerTool20250124(
+        screenshot_encoding=ScreenshotEncoding(format=ImageFormat.JPEG)
+    )
+    with patch(
+        "computer_use_demo.tools.computer.ImageGrab.grab",
+        return_value=Image.new("RGB", (1024, 768)),
+    ):
+        result = await computer_tool.screenshot()
+    assert result.image_media_type == "image/jpeg"
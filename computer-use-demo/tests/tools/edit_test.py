@@ -321,3 +321,17 @@ async def test_validate_path(edit_tool):
         "pathlib.Path.is_dir", return_value=True
     ):
         edit_tool.validate_path("view", Path("/directory/path"))
+
+
+def test_resource_access_resolves_path(edit_tool, tmp_path):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "link").symlink_to(tmp_path / "dir")
+    keys = {
+        edit_tool.resource_access({"command": "view", "path": str(path)}).resource
+        for path in [
+            tmp_path / "dir" / "file.txt",
+            tmp_path / "dir" / ".." / "dir" / "file.txt",
+            tmp_path / "link" / "file.txt",
+        ]
+    }
+    assert keys == {f"file:{(tmp_path / 'dir' / 'file.txt').resolve()}"}
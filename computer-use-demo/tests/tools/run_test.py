@@ -0,0 +1,29 @@
+from computer_use_demo.tools.run import OutputCapture
+
+
+def test_output_capture_keeps_small_output_in_memory(tmp_path):
+    capture = OutputCapture("test", head_size=4, tail_size=4, output_dir=tmp_path)
+    capture.write("abc")
+    capture.write("defgh")
+    capture.close()
+    assert capture.getvalue() == "abcdefgh"
+    assert capture.spill_path is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_output_capture_spills_long_output(tmp_path):
+    chunks: list[str] = []
+    capture = OutputCapture(
+        "test", head_size=4, tail_size=4, output_dir=tmp_path, on_chunk=chunks.append
+    )
+    for i in range(100):
+        capture.write(f"{i:03d}")
+    capture.close()
+    text = "".join(f"{i:03d}" for i in range(100))
+    assert chunks == [f"{i:03d}" for i in range(100)]
+    assert capture.spill_path is not None
+    assert capture.spill_path.read_text() == text
+    assert capture.getvalue() == (
+        f"0000\n<output clipped: 292 characters omitted, the full output is in "
+        f"{capture.spill_path}>\n8099"
+    )
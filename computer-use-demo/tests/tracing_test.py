@@ -0,0 +1,73 @@
+import asyncio
+import gc
+import json
+
+from computer_use_demo import tracing
+from computer_use_demo.tools import ToolCollection
+from computer_use_demo.tools.base import BaseAnthropicTool, ToolResult
+
+
+class SleepTool(BaseAnthropicTool):
+    name = "sleep"
+
+    def to_params(self):
+        return {"name": self.name}  # type: ignore
+
+    async def __call__(self, **kwargs):
+        await asyncio.to_thread(self.work)
+        return ToolResult(output="done")
+
+    def work(self):
+        with tracing.span("work"):
+            pass
+
+
+def test_span_is_a_noop_without_tracer():
+    assert tracing.span("a") is tracing.span("b")
+    with tracing.span("a"):
+        pass
+
+
+async def test_tracer_records_spans_per_task(tmp_path):
+    path = tmp_path / "trace.json"
+    tools = ToolCollection(SleepTool())
+    with tracing.Tracer(path).activate():
+        await asyncio.gather(
+            tools.run(name="sleep", tool_input={}),
+            tools.run(name="sleep", tool_input={}),
+        )
+    assert tracing.span("after") is tracing.span("again")
+
+    events = json.loads(path.read_text())["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    assert sorted(event["name"] for event in spans) == [
+        "tool sleep",
+        "tool sleep",
+        "work",
+        "work",
+    ]
+    # concurrent tool calls get their own tracks, worker threads another one
+    tool_tracks = {event["tid"] for event in spans if event["name"] == "tool sleep"}
+    work_tracks = {event["tid"] for event in spans if event["name"] == "work"}
+    assert len(tool_tracks) == 2
+    assert not tool_tracks & work_tracks
+    assert all(event["dur"] >= 0 for event in spans)
+
+
+async def test_tracer_forgets_finished_tasks():
+    tracer = tracing.Tracer()
+
+    async def traced():
+        with tracer.span("step"):
+            await asyncio.sleep(0)
+
+    with tracer.activate():
+        for _ in range(3):
+            await asyncio.create_task(traced())
+    # let the loop drop its last reference to the finished task
+    await asyncio.sleep(0)
+    gc.collect()
+
+    assert len(tracer._task_tracks) == 0
+    tids = [event["tid"] for event in tracer.events if event["ph"] == "M"]
+    assert len(set(tids)) == len(tids) == 3